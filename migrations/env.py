@@ -8,8 +8,22 @@ import gameplay_computer.web
 from gameplay_computer.agents.tables import agents
 from gameplay_computer.common.tables import game
 from gameplay_computer.matches.tables import match_players, match_turns, matches
-
-tables = [game, agents, matches, match_players, match_turns]
+from gameplay_computer.tournaments.tables import (
+    tournament_agents,
+    tournament_matches,
+    tournaments,
+)
+
+tables = [
+    game,
+    agents,
+    matches,
+    match_players,
+    match_turns,
+    tournaments,
+    tournament_agents,
+    tournament_matches,
+]
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -0,0 +1,35 @@
+"""agent transport
+
+Revision ID: 0a7d3c5e1b92
+Revises: f8b16d2e9a04
+Create Date: 2026-10-19 14:22:48.390127
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0a7d3c5e1b92"
+down_revision = "f8b16d2e9a04"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "agent_deployment",
+        sa.Column("transport", sa.String(), server_default="http", nullable=False),
+    )
+    op.add_column(
+        "agent_deployment", sa.Column("token_hash", sa.String(), nullable=True)
+    )
+    op.alter_column("agent_deployment", "url", existing_type=sa.String(), nullable=True)
+
+
+def downgrade() -> None:
+    op.execute("DELETE FROM agent_deployment WHERE url IS NULL")
+    op.alter_column(
+        "agent_deployment", "url", existing_type=sa.String(), nullable=False
+    )
+    op.drop_column("agent_deployment", "token_hash")
+    op.drop_column("agent_deployment", "transport")
@@ -0,0 +1,45 @@
+"""position hash
+
+Revision ID: 3c9a1f0e7b52
+Revises: ecc49f9f55bc
+Create Date: 2026-10-19 09:12:40.118203
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3c9a1f0e7b52"
+down_revision = "ecc49f9f55bc"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("match_turns", sa.Column("position", sa.String(), nullable=True))
+    # Same as common.position_hash, the board column by column, bottom to top
+    # with "." for empty spaces, prefixed with the game.
+    op.execute(
+        """
+        UPDATE match_turns mt SET position = md5(
+            'connect4:' || translate((
+                SELECT string_agg(
+                    space.value #>> '{}', '' ORDER BY col.n, space.n
+                )
+                FROM json_array_elements(mt.state) WITH ORDINALITY AS col(value, n),
+                     json_array_elements(col.value) WITH ORDINALITY AS space(value, n)
+            ), ' ', '.')
+        )
+        FROM matches m
+        WHERE m.id = mt.match_id AND m.game = 'connect4'
+        """
+    )
+    op.alter_column("match_turns", "position", nullable=False)
+    op.create_index(
+        op.f("ix_match_turns_position"), "match_turns", ["position"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_match_turns_position"), table_name="match_turns")
+    op.drop_column("match_turns", "position")
@@ -0,0 +1,103 @@
+"""tournaments
+
+Revision ID: 3d7e9f1a2b64
+Revises: 9b2c5d8e4f61
+Create Date: 2026-10-19 16:32:41.508217
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "3d7e9f1a2b64"
+down_revision = "9b2c5d8e4f61"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "tournaments",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "game",
+            postgresql.ENUM("connect4", name="game", create_type=False),
+            nullable=False,
+        ),
+        sa.Column(
+            "format",
+            sa.Enum("round_robin", "swiss", "gauntlet", name="tournament_format"),
+            nullable=False,
+        ),
+        sa.Column(
+            "status",
+            sa.Enum("running", "finished", name="tournament_status"),
+            nullable=False,
+        ),
+        sa.Column("rounds", sa.Integer(), nullable=False),
+        sa.Column("round", sa.Integer(), nullable=False),
+        sa.Column("games_per_pairing", sa.Integer(), nullable=False),
+        sa.Column("max_matches_per_agent", sa.Integer(), nullable=False),
+        sa.Column("champion_agent_id", sa.BigInteger(), nullable=True),
+        sa.Column("created_by", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("finished_at", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "tournament_agents",
+        sa.Column("tournament_id", sa.BigInteger(), nullable=False),
+        sa.Column("agent_id", sa.BigInteger(), nullable=False),
+        sa.Column("wins", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("losses", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("draws", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("errors", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("byes", sa.Integer(), server_default="0", nullable=False),
+        sa.ForeignKeyConstraint(
+            ["tournament_id"],
+            ["tournaments.id"],
+        ),
+        sa.PrimaryKeyConstraint("tournament_id", "agent_id"),
+    )
+    op.create_table(
+        "tournament_matches",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("tournament_id", sa.BigInteger(), nullable=False),
+        sa.Column("round", sa.Integer(), nullable=False),
+        sa.Column("agent_id_0", sa.BigInteger(), nullable=False),
+        sa.Column("agent_id_1", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("pending", "running", "finished", name="tournament_match_status"),
+            nullable=False,
+        ),
+        sa.Column("match_id", sa.BigInteger(), nullable=True),
+        sa.Column("shard", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["match_id"],
+            ["matches.id"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["tournament_id"],
+            ["tournaments.id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("match_id"),
+    )
+    op.create_index(
+        "tournament_matches_status",
+        "tournament_matches",
+        ["tournament_id", "status"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("tournament_matches_status", table_name="tournament_matches")
+    op.drop_table("tournament_matches")
+    op.drop_table("tournament_agents")
+    op.drop_table("tournaments")
+    sa.Enum(name="tournament_match_status").drop(op.get_bind())
+    sa.Enum(name="tournament_status").drop(op.get_bind())
+    sa.Enum(name="tournament_format").drop(op.get_bind())
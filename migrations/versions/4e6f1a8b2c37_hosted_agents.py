@@ -0,0 +1,24 @@
+"""hosted agents
+
+Revision ID: 4e6f1a8b2c37
+Revises: 0a7d3c5e1b92
+Create Date: 2026-10-19 15:03:19.557840
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4e6f1a8b2c37"
+down_revision = "0a7d3c5e1b92"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("agent_deployment", sa.Column("source", sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    op.execute("DELETE FROM agent_deployment WHERE transport = 'hosted'")
+    op.drop_column("agent_deployment", "source")
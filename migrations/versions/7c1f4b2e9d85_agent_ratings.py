@@ -0,0 +1,52 @@
+"""agent ratings
+
+Revision ID: 7c1f4b2e9d85
+Revises: 3d7e9f1a2b64
+Create Date: 2026-10-19 17:05:12.734590
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "7c1f4b2e9d85"
+down_revision = "3d7e9f1a2b64"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "agent_ratings",
+        sa.Column("agent_id", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "game",
+            postgresql.ENUM("connect4", name="game", create_type=False),
+            nullable=False,
+        ),
+        sa.Column("rating", sa.Float(), nullable=False),
+        sa.Column("games", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["agent_id"],
+            ["agents.id"],
+        ),
+        sa.PrimaryKeyConstraint("agent_id"),
+    )
+    op.create_index(
+        "agent_ratings_leaderboard",
+        "agent_ratings",
+        ["game", sa.text("rating desc")],
+        unique=False,
+    )
+    op.create_index(
+        "matches_finished_at", "matches", ["finished_at", "id"], unique=False
+    )
+    # The ratings of past matches come from gameplay_recompute_ratings.
+
+
+def downgrade() -> None:
+    op.drop_index("matches_finished_at", table_name="matches")
+    op.drop_index("agent_ratings_leaderboard", table_name="agent_ratings")
+    op.drop_table("agent_ratings")
@@ -0,0 +1,26 @@
+"""agent protocol
+
+Revision ID: 8d4e2b6a1c07
+Revises: 3c9a1f0e7b52
+Create Date: 2026-10-19 10:02:11.532870
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8d4e2b6a1c07"
+down_revision = "3c9a1f0e7b52"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "agent_deployment",
+        sa.Column("protocol", sa.String(), server_default="match", nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("agent_deployment", "protocol")
@@ -0,0 +1,47 @@
+"""agent stats
+
+Revision ID: 9b2c5d8e4f61
+Revises: 4e6f1a8b2c37
+Create Date: 2026-10-19 15:47:05.216384
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9b2c5d8e4f61"
+down_revision = "4e6f1a8b2c37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "agent_calls",
+        sa.Column("agent_id", sa.BigInteger(), nullable=False),
+        sa.Column("calls", sa.BigInteger(), nullable=False),
+        sa.Column("timeouts", sa.BigInteger(), nullable=False),
+        sa.Column("errors", sa.BigInteger(), nullable=False),
+        sa.Column("total_seconds", sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["agent_id"],
+            ["agents.id"],
+        ),
+        sa.PrimaryKeyConstraint("agent_id"),
+    )
+    op.create_table(
+        "agent_latency",
+        sa.Column("agent_id", sa.BigInteger(), nullable=False),
+        sa.Column("le_ms", sa.Integer(), nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["agent_id"],
+            ["agents.id"],
+        ),
+        sa.PrimaryKeyConstraint("agent_id", "le_ms"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("agent_latency")
+    op.drop_table("agent_calls")
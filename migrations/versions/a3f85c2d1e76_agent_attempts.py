@@ -0,0 +1,30 @@
+"""agent attempts
+
+Revision ID: a3f85c2d1e76
+Revises: 7c1f4b2e9d85
+Create Date: 2026-10-19 19:12:41.508213
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a3f85c2d1e76"
+down_revision = "7c1f4b2e9d85"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "matches",
+        sa.Column("agent_attempts", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column("matches", sa.Column("agent_attempt_turn", sa.Integer()))
+    op.add_column("matches", sa.Column("agent_retry_at", sa.DateTime(timezone=True)))
+
+
+def downgrade() -> None:
+    op.drop_column("matches", "agent_retry_at")
+    op.drop_column("matches", "agent_attempt_turn")
+    op.drop_column("matches", "agent_attempts")
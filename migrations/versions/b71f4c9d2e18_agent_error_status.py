@@ -0,0 +1,30 @@
+"""agent error status
+
+Revision ID: b71f4c9d2e18
+Revises: 8d4e2b6a1c07
+Create Date: 2026-10-19 11:26:54.204417
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b71f4c9d2e18"
+down_revision = "8d4e2b6a1c07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TYPE match_status ADD VALUE 'agent_error'")
+
+
+def downgrade() -> None:
+    # Postgres can't drop an enum value, rebuild the type without it.
+    op.execute("UPDATE matches SET status = 'finished' WHERE status = 'agent_error'")
+    op.execute("ALTER TYPE match_status RENAME TO match_status_old")
+    op.execute("CREATE TYPE match_status AS ENUM('in_progress', 'finished')")
+    op.execute(
+        "ALTER TABLE matches ALTER COLUMN status TYPE match_status "
+        "USING status::text::match_status"
+    )
+    op.execute("DROP TYPE match_status_old")
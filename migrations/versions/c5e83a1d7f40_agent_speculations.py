@@ -0,0 +1,44 @@
+"""agent speculations
+
+Revision ID: c5e83a1d7f40
+Revises: b71f4c9d2e18
+Create Date: 2026-10-19 12:14:03.671925
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c5e83a1d7f40"
+down_revision = "b71f4c9d2e18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "agent_deployment",
+        sa.Column("speculative", sa.Boolean(), server_default="false", nullable=False),
+    )
+    op.create_table(
+        "agent_speculations",
+        sa.Column("match_id", sa.BigInteger(), nullable=False),
+        sa.Column("position", sa.String(), nullable=False),
+        sa.Column("agent_id", sa.BigInteger(), nullable=False),
+        sa.Column("action", sa.JSON(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["match_id"],
+            ["matches.id"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["agent_id"],
+            ["agents.id"],
+        ),
+        sa.PrimaryKeyConstraint("match_id", "position"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("agent_speculations")
+    op.drop_column("agent_deployment", "speculative")
@@ -0,0 +1,47 @@
+"""agent responses
+
+Revision ID: e29a4b7c0d53
+Revises: c5e83a1d7f40
+Create Date: 2026-10-19 12:58:37.104662
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e29a4b7c0d53"
+down_revision = "c5e83a1d7f40"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "agent_deployment",
+        sa.Column(
+            "deterministic", sa.Boolean(), server_default="false", nullable=False
+        ),
+    )
+    op.add_column(
+        "agent_deployment",
+        sa.Column("version", sa.String(), server_default="", nullable=False),
+    )
+    op.create_table(
+        "agent_responses",
+        sa.Column("agent_id", sa.BigInteger(), nullable=False),
+        sa.Column("version", sa.String(), nullable=False),
+        sa.Column("position", sa.String(), nullable=False),
+        sa.Column("action", sa.JSON(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["agent_id"],
+            ["agents.id"],
+        ),
+        sa.PrimaryKeyConstraint("agent_id", "version", "position"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("agent_responses")
+    op.drop_column("agent_deployment", "version")
+    op.drop_column("agent_deployment", "deterministic")
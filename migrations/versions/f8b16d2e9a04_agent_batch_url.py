@@ -0,0 +1,25 @@
+"""agent batch url
+
+Revision ID: f8b16d2e9a04
+Revises: e29a4b7c0d53
+Create Date: 2026-10-19 13:41:12.859310
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f8b16d2e9a04"
+down_revision = "e29a4b7c0d53"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "agent_deployment", sa.Column("batch_url", sa.String(), nullable=True)
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("agent_deployment", "batch_url")
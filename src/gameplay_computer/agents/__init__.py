@@ -1,22 +1,104 @@
-from .schemas import AgentDeployment, AgentHistory
+from .bulkhead import bulkhead_metrics
+from .cache import response_cache_metrics
+from .client import (
+    agent_client_metrics,
+    close_agent_client,
+    get_agent_client,
+    open_agent_client,
+)
+from .errors import AgentBusy, AgentError
+from .ratings import Ratings
+from .repo import invalidate_agent_deployment
+from .sandbox import HostedAgentError, close_sandbox, hosted_agents_enabled
+from .schemas import (
+    AgentCallStats,
+    AgentClientMetrics,
+    AgentDeployment,
+    AgentHistory,
+    AgentRating,
+    AgentStats,
+    BulkheadMetrics,
+    ResponseCacheMetrics,
+)
 from .service import (
+    agent_request,
+    compact_match,
     create_agent,
     delete_agent,
+    flush_agent_stats,
     get_agent_action,
     get_agent_by_id,
     get_agent_by_username_and_agentname,
+    get_agent_deployment,
     get_agent_id_for_username_and_agentname,
+    get_agent_stats,
+    get_speculated_action,
+    list_agent_ratings,
+    list_agent_stats,
     list_agents,
+    lock_agent_ratings,
+    probe_agent,
+    probe_hosted_agent,
+    probe_unhealthy_agents,
+    replace_agent_ratings,
+    speculate_agent_replies,
+    update_agent_ratings,
+)
+from .sockets import (
+    AgentSocketError,
+    forward_socket_request,
+    new_agent_token,
+    resolve_socket_response,
+    serve_agent_socket,
 )
 
 __all__ = [
+    "AgentBusy",
+    "AgentCallStats",
+    "AgentClientMetrics",
+    "AgentError",
     "AgentDeployment",
     "AgentHistory",
+    "AgentRating",
+    "AgentSocketError",
+    "AgentStats",
+    "BulkheadMetrics",
+    "HostedAgentError",
+    "Ratings",
+    "ResponseCacheMetrics",
+    "agent_client_metrics",
+    "agent_request",
+    "bulkhead_metrics",
+    "compact_match",
+    "close_agent_client",
+    "close_sandbox",
+    "get_agent_client",
+    "open_agent_client",
     "create_agent",
     "delete_agent",
+    "flush_agent_stats",
+    "forward_socket_request",
     "get_agent_by_id",
     "get_agent_by_username_and_agentname",
+    "get_agent_deployment",
     "get_agent_id_for_username_and_agentname",
     "get_agent_action",
+    "get_agent_stats",
+    "get_speculated_action",
+    "hosted_agents_enabled",
+    "invalidate_agent_deployment",
+    "list_agent_ratings",
+    "list_agent_stats",
     "list_agents",
+    "lock_agent_ratings",
+    "new_agent_token",
+    "probe_agent",
+    "probe_hosted_agent",
+    "probe_unhealthy_agents",
+    "replace_agent_ratings",
+    "resolve_socket_response",
+    "response_cache_metrics",
+    "serve_agent_socket",
+    "speculate_agent_replies",
+    "update_agent_ratings",
 ]
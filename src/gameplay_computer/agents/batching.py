@@ -0,0 +1,106 @@
+import asyncio
+import os
+from typing import Any
+
+import httpx
+
+from .bulkhead import agent_bulkhead
+
+
+class AgentBatcher:
+    """
+    Collects the requests for one agent across matches and sends them to its
+    batch url together. The agent gets a json list of requests and answers
+    with a json list of actions in the same order.
+    A batch is sent window seconds after its first request, or as soon as it
+    has max_size requests.
+    """
+
+    def __init__(self, agent_id: int, url: str, window: float, max_size: int):
+        self.agent_id = agent_id
+        self.url = url
+        self.window = window
+        self.max_size = max_size
+        self.pending: list[tuple[dict[str, Any], asyncio.Future[Any]]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.sending: set[asyncio.Task[None]] = set()
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(
+        self, client: httpx.AsyncClient, request: dict[str, Any]
+    ) -> tuple[Any, httpx.Headers]:
+        """
+        The agent's action for the request and the headers of the batch
+        response.
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Any] = loop.create_future()
+        self.pending.append((request, future))
+        if len(self.pending) >= self.max_size:
+            self._flush(client)
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._flush, client)
+        result: tuple[Any, httpx.Headers] = await future
+        return result
+
+    def _flush(self, client: httpx.AsyncClient) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._send(client, batch))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def _send(
+        self,
+        client: httpx.AsyncClient,
+        batch: list[tuple[dict[str, Any], asyncio.Future[Any]]],
+    ) -> None:
+        self.batches += 1
+        self.requests += len(batch)
+        try:
+            async with agent_bulkhead(self.agent_id, httpx.URL(self.url).host):
+                response = await client.post(
+                    self.url, json=[request for request, _ in batch]
+                )
+            response.raise_for_status()
+            actions = response.json()
+            if not isinstance(actions, list) or len(actions) != len(batch):
+                raise ValueError(f"Expected a list of {len(batch)} actions.")
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            # Every match in the batch fails the same way.
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), action in zip(batch, actions):
+            if not future.done():
+                future.set_result((action, response.headers))
+
+
+_batchers: dict[int, AgentBatcher] = {}
+
+
+def get_agent_batcher(agent_id: int, url: str) -> AgentBatcher:
+    """
+    Configured with environment variables.
+        AGENT_BATCH_WINDOW_MS: how long to wait for more requests, default 20
+        AGENT_BATCH_MAX_SIZE: most requests in one batch, default 32
+    """
+    batcher = _batchers.get(agent_id)
+    if batcher is None or batcher.url != url:
+        batcher = _batchers[agent_id] = AgentBatcher(
+            agent_id,
+            url,
+            window=float(os.environ.get("AGENT_BATCH_WINDOW_MS", "20")) / 1000,
+            max_size=int(os.environ.get("AGENT_BATCH_MAX_SIZE", "32")),
+        )
+    return batcher
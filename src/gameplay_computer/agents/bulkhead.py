@@ -0,0 +1,93 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from .errors import AgentBusy
+from .schemas import BulkheadMetrics
+
+
+class Bulkhead:
+    """
+    Caps the number of concurrent requests to one agent or host, so a slow
+    agent only ties up its own share of the worker.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def acquire(self, timeout: float) -> AsyncIterator[None]:
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise AgentBusy(self.name)
+        finally:
+            self.waiting -= 1
+            self.wait_seconds += time.monotonic() - start
+        self.acquired += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    def metrics(self) -> BulkheadMetrics:
+        return BulkheadMetrics(
+            name=self.name,
+            limit=self.limit,
+            in_flight=self.in_flight,
+            waiting=self.waiting,
+            acquired=self.acquired,
+            rejected=self.rejected,
+            wait_seconds=self.wait_seconds,
+        )
+
+
+_agent_bulkheads: dict[int, Bulkhead] = {}
+_host_bulkheads: dict[str, Bulkhead] = {}
+
+
+@asynccontextmanager
+async def agent_bulkhead(agent_id: int, host: str) -> AsyncIterator[None]:
+    """
+    Hold a slot for the agent and for its host while calling it.
+    Configured with environment variables.
+        AGENT_MAX_IN_FLIGHT: requests per agent deployment, default 4
+        AGENT_MAX_CONNECTIONS_PER_HOST: requests per host, default 10
+        AGENT_BULKHEAD_WAIT: seconds to wait for a slot before raising
+            AgentBusy, default 2
+    """
+    timeout = float(os.environ.get("AGENT_BULKHEAD_WAIT", "2"))
+
+    agent = _agent_bulkheads.get(agent_id)
+    if agent is None:
+        limit = int(os.environ.get("AGENT_MAX_IN_FLIGHT", "4"))
+        agent = _agent_bulkheads[agent_id] = Bulkhead(f"agent {agent_id}", limit)
+
+    host_bulkhead = _host_bulkheads.get(host)
+    if host_bulkhead is None:
+        limit = int(os.environ.get("AGENT_MAX_CONNECTIONS_PER_HOST", "10"))
+        host_bulkhead = _host_bulkheads[host] = Bulkhead(f"host {host}", limit)
+
+    async with agent.acquire(timeout), host_bulkhead.acquire(timeout):
+        yield
+
+
+def bulkhead_metrics() -> list[BulkheadMetrics]:
+    return [
+        bulkhead.metrics()
+        for bulkhead in [*_agent_bulkheads.values(), *_host_bulkheads.values()]
+    ]
@@ -0,0 +1,83 @@
+import os
+from collections import OrderedDict
+
+from databases import Database
+
+from gameplay_computer.gameplay import Action, Game
+
+from . import repo
+from .schemas import ResponseCacheMetrics
+
+# (agent id, agent version, position hash)
+CacheKey = tuple[int, str, str]
+
+
+class ResponseCache:
+    """
+    Least recently used actions of deterministic agents, by position.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.actions: OrderedDict[CacheKey, Action] = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, key: CacheKey) -> Action | None:
+        action = self.actions.get(key)
+        if action is not None:
+            self.actions.move_to_end(key)
+        return action
+
+    def put(self, key: CacheKey, action: Action) -> None:
+        self.actions[key] = action
+        self.actions.move_to_end(key)
+        while len(self.actions) > self.max_size:
+            self.actions.popitem(last=False)
+
+    def metrics(self) -> ResponseCacheMetrics:
+        lookups = self.hits + self.shared_hits + self.misses
+        return ResponseCacheMetrics(
+            size=len(self.actions),
+            max_size=self.max_size,
+            hits=self.hits,
+            shared_hits=self.shared_hits,
+            misses=self.misses,
+            hit_rate=(self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        )
+
+
+# AGENT_RESPONSE_CACHE_SIZE: actions kept in memory per process, default 10000
+_cache = ResponseCache(int(os.environ.get("AGENT_RESPONSE_CACHE_SIZE", "10000")))
+
+
+async def get_cached_action(
+    database: Database, agent_id: int, version: str, game: Game, position: str
+) -> Action | None:
+    """
+    Look in this process first, then in the responses every process saved.
+    """
+    key = (agent_id, version, position)
+    action = _cache.get(key)
+    if action is not None:
+        _cache.hits += 1
+        return action
+    action = await repo.get_agent_response(database, agent_id, version, game, position)
+    if action is not None:
+        _cache.shared_hits += 1
+        _cache.put(key, action)
+        return action
+    _cache.misses += 1
+    return None
+
+
+async def cache_action(
+    database: Database, agent_id: int, version: str, position: str, action: Action
+) -> None:
+    _cache.put((agent_id, version, position), action)
+    await repo.save_agent_response(database, agent_id, version, position, action)
+
+
+def response_cache_metrics() -> ResponseCacheMetrics:
+    return _cache.metrics()
@@ -0,0 +1,117 @@
+import os
+from collections import defaultdict
+
+import httpx
+
+from .schemas import AgentClientMetrics
+
+# One client per process, shared by every agent call so connections to agent
+# hosts get reused across turns and matches instead of paying for a new tcp
+# (and tls) handshake every time.
+_client: httpx.AsyncClient | None = None
+_transport: "_CountingTransport | None" = None
+
+
+class _CountingTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the pooled transport to count what goes through it per agent host.
+    Limiting requests per host is done by agents.bulkhead.
+    """
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self.transport = transport
+        self.in_flight: dict[str, int] = defaultdict(int)
+        self.requests = 0
+        self.errors = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.netloc.decode()
+        self.requests += 1
+        self.in_flight[host] += 1
+        try:
+            # This covers the request up to the response headers, the
+            # body (a single action) is read by the client after.
+            return await self.transport.handle_async_request(request)
+        except httpx.TransportError:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight[host] -= 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def open_agent_client() -> httpx.AsyncClient:
+    """
+    Create the process wide agent client. Call this once at startup.
+    Configured with environment variables.
+        AGENT_CONNECT_TIMEOUT: seconds, default 5
+        AGENT_READ_TIMEOUT: seconds, default 10
+        AGENT_MAX_CONNECTIONS: total open connections, default 100
+        AGENT_KEEPALIVE_EXPIRY: seconds to keep idle connections, default 30
+        AGENT_HTTP2: set to 1 to use http2 where agents support it, needs
+            the http2 extra installed.
+    """
+    global _client
+    global _transport
+    assert _client is None, "agent client already open"
+
+    connect_timeout = float(os.environ.get("AGENT_CONNECT_TIMEOUT", "5"))
+    read_timeout = float(os.environ.get("AGENT_READ_TIMEOUT", "10"))
+    max_connections = int(os.environ.get("AGENT_MAX_CONNECTIONS", "100"))
+    keepalive_expiry = float(os.environ.get("AGENT_KEEPALIVE_EXPIRY", "30"))
+    http2 = os.environ.get("AGENT_HTTP2") == "1"
+
+    _transport = _CountingTransport(
+        httpx.AsyncHTTPTransport(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        ),
+    )
+    _client = httpx.AsyncClient(
+        transport=_transport,
+        timeout=httpx.Timeout(
+            read_timeout, connect=connect_timeout, pool=connect_timeout
+        ),
+    )
+    return _client
+
+
+async def close_agent_client() -> None:
+    global _client
+    global _transport
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _transport = None
+
+
+def get_agent_client() -> httpx.AsyncClient:
+    assert _client is not None, "agent client is not open, call open_agent_client"
+    return _client
+
+
+def agent_client_metrics() -> AgentClientMetrics:
+    if _transport is None:
+        return AgentClientMetrics(
+            requests=0,
+            errors=0,
+            in_flight={},
+            connections=0,
+            idle_connections=0,
+        )
+    # httpcore doesn't have a public api for pool stats.
+    pool = getattr(_transport.transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    return AgentClientMetrics(
+        requests=_transport.requests,
+        errors=_transport.errors,
+        in_flight={host: n for host, n in _transport.in_flight.items() if n > 0},
+        connections=len(connections),
+        idle_connections=sum(1 for c in connections if c.is_idle()),
+    )
@@ -0,0 +1,21 @@
+class AgentBusy(Exception):
+    """
+    Raised when an agent (or its host) already has as many requests in flight
+    as it's allowed and a slot didn't free up in time. The caller should try
+    again later instead of holding a worker slot.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} is busy")
+        self.name = name
+
+
+class AgentError(Exception):
+    """
+    Raised when an agent call fails or the agent is known to be down.
+    turn is the match turn the agent was asked to play from.
+    """
+
+    def __init__(self, message: str, turn: int):
+        super().__init__(message)
+        self.turn = turn
@@ -0,0 +1,125 @@
+import os
+import time
+from collections import deque
+from enum import StrEnum
+
+
+class CircuitState(StrEnum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Tracks the recent error rate of calls to one agent.
+    closed: calls go through. Opens when, over the last window seconds, there
+        were at least min_requests calls and error_rate of them failed.
+    open: calls fail fast. After cooldown seconds it lets one trial call
+        through (half_open).
+    half_open: the trial call closes it on success and opens it again on
+        failure.
+    record_success and record_failure return True when the state flips
+    between healthy and unhealthy so callers can persist it.
+    """
+
+    def __init__(
+        self,
+        window: float,
+        min_requests: int,
+        error_rate: float,
+        cooldown: float,
+    ):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = CircuitState.CLOSED
+        self.opened_at = 0.0
+        self.calls: deque[tuple[float, bool]] = deque()
+
+    def _trim(self, now: float) -> None:
+        while self.calls and now - self.calls[0][0] > self.window:
+            self.calls.popleft()
+
+    def allow_request(self) -> bool:
+        match self.state:
+            case CircuitState.CLOSED:
+                return True
+            case CircuitState.OPEN | CircuitState.HALF_OPEN:
+                # Only one trial call per cooldown, another one is let through
+                # if the last trial never reported back.
+                now = time.monotonic()
+                if now - self.opened_at >= self.cooldown:
+                    self.state = CircuitState.HALF_OPEN
+                    self.opened_at = now
+                    return True
+                return False
+
+    def trip(self) -> None:
+        """
+        Open the breaker, for when another process already found the agent
+        unhealthy.
+        """
+        if self.state == CircuitState.CLOSED:
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+
+    def reset(self) -> None:
+        self.state = CircuitState.CLOSED
+        self.calls.clear()
+
+    def record_success(self) -> bool:
+        now = time.monotonic()
+        if self.state != CircuitState.CLOSED:
+            self.reset()
+            return True
+        self.calls.append((now, True))
+        self._trim(now)
+        return False
+
+    def record_failure(self) -> bool:
+        now = time.monotonic()
+        match self.state:
+            case CircuitState.HALF_OPEN:
+                self.state = CircuitState.OPEN
+                self.opened_at = now
+                return False
+            case CircuitState.OPEN:
+                return False
+            case CircuitState.CLOSED:
+                self.calls.append((now, False))
+                self._trim(now)
+                failures = sum(1 for _, ok in self.calls if not ok)
+                if (
+                    len(self.calls) >= self.min_requests
+                    and failures / len(self.calls) >= self.error_rate
+                ):
+                    self.state = CircuitState.OPEN
+                    self.opened_at = now
+                    return True
+                return False
+
+
+_breakers: dict[int, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(agent_id: int) -> CircuitBreaker:
+    """
+    The breaker for an agent. Configured with environment variables.
+        AGENT_BREAKER_WINDOW: seconds of calls to look at, default 60
+        AGENT_BREAKER_MIN_REQUESTS: calls in the window before it can open,
+            default 5
+        AGENT_BREAKER_ERROR_RATE: failed fraction that opens it, default 0.5
+        AGENT_BREAKER_COOLDOWN: seconds before a trial call, default 30
+    """
+    breaker = _breakers.get(agent_id)
+    if breaker is None:
+        breaker = CircuitBreaker(
+            window=float(os.environ.get("AGENT_BREAKER_WINDOW", "60")),
+            min_requests=int(os.environ.get("AGENT_BREAKER_MIN_REQUESTS", "5")),
+            error_rate=float(os.environ.get("AGENT_BREAKER_ERROR_RATE", "0.5")),
+            cooldown=float(os.environ.get("AGENT_BREAKER_COOLDOWN", "30")),
+        )
+        _breakers[agent_id] = breaker
+    return breaker
@@ -0,0 +1,46 @@
+"""
+Elo ratings for agents, from their agent vs agent matches. Matches against
+users and agents playing themselves don't count.
+
+Configured with environment variables.
+    RATING_INITIAL: a new agent's rating, default 1500
+    RATING_K: the most a rating moves in one match, default 32
+"""
+import os
+
+initial_rating = float(os.environ.get("RATING_INITIAL", "1500"))
+k_factor = float(os.environ.get("RATING_K", "32"))
+
+
+def expected_score(rating: float, opponent_rating: float) -> float:
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def elo_update(
+    rating_0: float, rating_1: float, winner: int | None
+) -> tuple[float, float]:
+    """
+    The players' new ratings, winner None is a draw.
+    """
+    score_0 = 0.5 if winner is None else 1.0 if winner == 0 else 0.0
+    change = k_factor * (score_0 - expected_score(rating_0, rating_1))
+    return rating_0 + change, rating_1 - change
+
+
+class Ratings:
+    """
+    Ratings in memory, for recomputing them from every match in order.
+    """
+
+    def __init__(self) -> None:
+        # agent id to (game, rating, games)
+        self.ratings: dict[int, tuple[str, float, int]] = {}
+
+    def add_match(
+        self, game: str, agent_id_0: int, agent_id_1: int, winner: int | None
+    ) -> None:
+        _, rating_0, games_0 = self.ratings.get(agent_id_0, (game, initial_rating, 0))
+        _, rating_1, games_1 = self.ratings.get(agent_id_1, (game, initial_rating, 0))
+        rating_0, rating_1 = elo_update(rating_0, rating_1, winner)
+        self.ratings[agent_id_0] = (game, rating_0, games_0 + 1)
+        self.ratings[agent_id_1] = (game, rating_1, games_1 + 1)
@@ -1,15 +1,59 @@
+import datetime
+import json
+import os
+from collections import defaultdict
+from typing import Any
+
 import sqlalchemy
 from databases import Database
 
-from gameplay_computer import users
-from gameplay_computer.gameplay import Agent
+from gameplay_computer import common, users
+from gameplay_computer.gameplay import (
+    Action,
+    Agent,
+    AgentProtocol,
+    AgentTransport,
+    Game,
+)
+
+from . import ratings, stats, tables
+from .schemas import AgentDeployment, AgentHistory, AgentRating, AgentStats
+
+# Deployments by agent id. An agent's url almost never changes so this saves
+# a query on every agent turn. Entries are dropped when an agent is created
+# or deleted, in this process directly and in the others through a notify on
+# the agent_deployments channel (see invalidate_agent_deployment).
+_deployment_cache: dict[int, tuple[datetime.datetime, AgentDeployment]] = {}
+_deployment_cache_ttl = datetime.timedelta(
+    seconds=int(os.environ.get("AGENT_DEPLOYMENT_CACHE_TTL", "60"))
+)
+
 
-from . import tables
-from .schemas import AgentDeployment
+def invalidate_agent_deployment(agent_id: int) -> None:
+    _deployment_cache.pop(agent_id, None)
+
+
+async def _notify_agent_deployment_changed(database: Database, agent_id: int) -> None:
+    await database.execute(
+        query="select pg_notify('agent_deployments', :agent_id)",
+        values={"agent_id": str(agent_id)},
+    )
 
 
 async def create_agent(
-    database: Database, created_by_user_id: str, game: str, agentname: str, url: str
+    database: Database,
+    created_by_user_id: str,
+    game: str,
+    agentname: str,
+    url: str | None,
+    protocol: AgentProtocol = "match",
+    speculative: bool = False,
+    deterministic: bool = False,
+    batch_url: str | None = None,
+    transport: AgentTransport = "http",
+    token_hash: str | None = None,
+    source: str | None = None,
+    healthy: bool = True,
 ) -> int:
     async with database.transaction():
         agent_id: int = await database.execute(
@@ -24,8 +68,15 @@ async def create_agent(
             query=tables.agent_deployment.insert().values(
                 agent_id=agent_id,
                 url=url,
-                healthy=True,
+                healthy=healthy,
                 active=False,
+                protocol=protocol,
+                speculative=speculative,
+                deterministic=deterministic,
+                batch_url=batch_url,
+                transport=transport,
+                token_hash=token_hash,
+                source=source,
             )
         )
         await database.execute(
@@ -37,11 +88,27 @@ async def create_agent(
                 errors=0,
             )
         )
+        await _notify_agent_deployment_changed(database, agent_id)
+    invalidate_agent_deployment(agent_id)
     return agent_id
 
 
 async def delete_agent(database: Database, agent_id: int) -> bool:
     async with database.transaction():
+        for table in [tables.agent_calls, tables.agent_latency, tables.agent_ratings]:
+            await database.execute(
+                query=table.delete().where(table.c.agent_id == agent_id)
+            )
+        await database.execute(
+            query=tables.agent_speculations.delete().where(
+                tables.agent_speculations.c.agent_id == agent_id
+            )
+        )
+        await database.execute(
+            query=tables.agent_responses.delete().where(
+                tables.agent_responses.c.agent_id == agent_id
+            )
+        )
         await database.execute(
             query=tables.agent_deployment.delete().where(
                 tables.agent_deployment.c.agent_id == agent_id
@@ -55,6 +122,8 @@ async def delete_agent(database: Database, agent_id: int) -> bool:
         await database.execute(
             query=tables.agents.delete().where(tables.agents.c.id == agent_id)
         )
+        await _notify_agent_deployment_changed(database, agent_id)
+    invalidate_agent_deployment(agent_id)
     return True
 
 
@@ -111,25 +180,488 @@ async def get_agent_id_for_username_and_agentname(
 
 
 async def get_agent_deployment(
-    database: Database, agent: Agent
+    database: Database, agent_id: int
 ) -> AgentDeployment | None:
-    user_id = await users.get_user_id_for_username(agent.username)
+    now = datetime.datetime.utcnow()
+    cached = _deployment_cache.get(agent_id)
+    if cached is not None:
+        cached_at, deployment = cached
+        if now - cached_at < _deployment_cache_ttl:
+            return deployment
+
     agent_deployment = await database.fetch_one(
         query="""
-        select ad.url, ad.healthy, ad.active
-        from agents a
-        join agent_deployment ad on a.id = ad.agent_id
-        where a.user_id = :user_id and a.agentname = :agentname
+        select ad.url, ad.healthy, ad.active, ad.protocol, ad.speculative,
+               ad.deterministic, ad.version, ad.batch_url, ad.transport,
+               ad.source
+        from agent_deployment ad
+        where ad.agent_id = :agent_id
         """,
-        values={"user_id": user_id, "agentname": agent.agentname},
+        values={"agent_id": agent_id},
     )
     if agent_deployment is None:
+        invalidate_agent_deployment(agent_id)
         return None
-    return AgentDeployment(
+    deployment = AgentDeployment(
+        transport=agent_deployment["transport"],
         url=agent_deployment["url"],
         healthy=agent_deployment["healthy"],
         active=agent_deployment["active"],
+        protocol=agent_deployment["protocol"],
+        speculative=agent_deployment["speculative"],
+        deterministic=agent_deployment["deterministic"],
+        version=agent_deployment["version"],
+        batch_url=agent_deployment["batch_url"],
+        source=agent_deployment["source"],
+    )
+    _deployment_cache[agent_id] = (now, deployment)
+    return deployment
+
+
+async def set_agent_healthy(database: Database, agent_id: int, healthy: bool) -> None:
+    async with database.transaction():
+        await database.execute(
+            query="""
+            update agent_deployment set healthy = :healthy
+            where agent_id = :agent_id
+            """,
+            values={"agent_id": agent_id, "healthy": healthy},
+        )
+        await _notify_agent_deployment_changed(database, agent_id)
+    invalidate_agent_deployment(agent_id)
+
+
+async def set_agent_version(
+    database: Database, agent_id: int, deterministic: bool, version: str
+) -> None:
+    """
+    Responses cached for other versions of the agent are dropped.
+    """
+    async with database.transaction():
+        await database.execute(
+            query="""
+            update agent_deployment
+            set deterministic = :deterministic, version = :version
+            where agent_id = :agent_id
+            """,
+            values={
+                "agent_id": agent_id,
+                "deterministic": deterministic,
+                "version": version,
+            },
+        )
+        await database.execute(
+            query="""
+            delete from agent_responses
+            where agent_id = :agent_id and version != :version
+            """,
+            values={"agent_id": agent_id, "version": version},
+        )
+        await _notify_agent_deployment_changed(database, agent_id)
+    invalidate_agent_deployment(agent_id)
+
+
+async def get_agent_response(
+    database: Database, agent_id: int, version: str, game: Game, position: str
+) -> Action | None:
+    action = await database.fetch_val(
+        query="""
+        select action from agent_responses
+        where agent_id = :agent_id and version = :version and position = :position
+        """,
+        values={"agent_id": agent_id, "version": version, "position": position},
+    )
+    if action is None:
+        return None
+    return common.deserialize_action(game, json.loads(action))
+
+
+async def save_agent_response(
+    database: Database, agent_id: int, version: str, position: str, action: Action
+) -> None:
+    await database.execute(
+        query="""
+        insert into agent_responses (agent_id, version, position, action, created_at)
+        values (:agent_id, :version, :position, :action, now())
+        on conflict (agent_id, version, position) do nothing
+        """,
+        values={
+            "agent_id": agent_id,
+            "version": version,
+            "position": position,
+            "action": json.dumps(common.serialize_action(action)),
+        },
+    )
+
+
+async def get_agent_socket(
+    database: Database, user_id: str, agentname: str
+) -> tuple[int, str] | None:
+    """
+    The id and token hash of a websocket agent.
+    """
+    agent_r = await database.fetch_one(
+        query="""
+        select a.id, ad.token_hash
+        from agents a
+        join agent_deployment ad on a.id = ad.agent_id
+        where a.user_id = :user_id and a.agentname = :agentname
+            and ad.transport = 'websocket' and ad.token_hash is not null
+        """,
+        values={"user_id": user_id, "agentname": agentname},
+    )
+    if agent_r is None:
+        return None
+    return agent_r["id"], agent_r["token_hash"]
+
+
+async def notify_agent_socket(database: Database, channel: str, payload: str) -> None:
+    await database.execute(
+        query="select pg_notify(:channel, :payload)",
+        values={"channel": channel, "payload": payload},
+    )
+
+
+async def update_agent_ratings(
+    database: Database,
+    game: Game,
+    agent_id_0: int,
+    agent_id_1: int,
+    winner: int | None,
+) -> None:
+    """
+    Only call in the transaction that finishes the match. Both rows are
+    locked in agent id order so matches finishing at the same time can't
+    deadlock.
+    """
+    agent_ids = sorted([agent_id_0, agent_id_1])
+    await database.execute(
+        query="""
+        insert into agent_ratings (agent_id, game, rating, games, updated_at)
+        values
+            (:agent_id_a, :game, :rating, 0, now()),
+            (:agent_id_b, :game, :rating, 0, now())
+        on conflict (agent_id) do nothing
+        """,
+        values={
+            "agent_id_a": agent_ids[0],
+            "agent_id_b": agent_ids[1],
+            "game": game,
+            "rating": ratings.initial_rating,
+        },
+    )
+    rows = await database.fetch_all(
+        query="""
+        select agent_id, rating from agent_ratings
+        where agent_id in (:agent_id_a, :agent_id_b)
+        order by agent_id
+        for update
+        """,
+        values={"agent_id_a": agent_ids[0], "agent_id_b": agent_ids[1]},
+    )
+    current = {row["agent_id"]: row["rating"] for row in rows}
+    rating_0, rating_1 = ratings.elo_update(
+        current[agent_id_0], current[agent_id_1], winner
+    )
+    for agent_id, rating in [(agent_id_0, rating_0), (agent_id_1, rating_1)]:
+        await database.execute(
+            query="""
+            update agent_ratings set
+                rating = :rating,
+                games = games + 1,
+                updated_at = now()
+            where agent_id = :agent_id
+            """,
+            values={"agent_id": agent_id, "rating": rating},
+        )
+
+
+async def list_agent_ratings(
+    database: Database, game: Game, limit: int, offset: int = 0
+) -> list[AgentRating]:
+    """
+    Best first, a range scan of the leaderboard index so it costs the same
+    however many matches were played.
+    """
+    ratings_r = await database.fetch_all(
+        query="""
+        select a.user_id, a.agentname, r.rating, r.games
+        from agent_ratings r
+        join agents a on a.id = r.agent_id
+        where r.game = :game
+        order by r.rating desc
+        limit :limit offset :offset
+        """,
+        values={"game": game, "limit": limit, "offset": offset},
+    )
+    agent_ratings = []
+    for i, rating_r in enumerate(ratings_r):
+        user = await users.get_user_by_id(rating_r["user_id"])
+        assert user is not None
+        agent_ratings.append(
+            AgentRating(
+                agent=Agent(
+                    game=game, username=user.username, agentname=rating_r["agentname"]
+                ),
+                rank=offset + i + 1,
+                rating=rating_r["rating"],
+                games=rating_r["games"],
+            )
+        )
+    return agent_ratings
+
+
+async def lock_agent_ratings(database: Database) -> None:
+    """
+    Only call in a transaction. Matches can't finish until it's over, reads
+    carry on.
+    """
+    await database.execute(query="lock table agent_ratings in exclusive mode")
+
+
+# Rows per insert, to stay under postgres' limit on query parameters.
+_ratings_batch_size = 5000
+
+
+async def replace_agent_ratings(database: Database, new: ratings.Ratings) -> None:
+    """
+    Only call in a transaction, after lock_agent_ratings. Agents that were
+    deleted since their matches are left out.
+    """
+    await database.execute(query="delete from agent_ratings")
+    rows = list(new.ratings.items())
+    for start in range(0, len(rows), _ratings_batch_size):
+        values_sql = []
+        values: dict[str, Any] = {}
+        for i, (agent_id, (game, rating, games)) in enumerate(
+            rows[start : start + _ratings_batch_size]
+        ):
+            values_sql.append(
+                f"""(
+                    cast(:agent_id_{i} as bigint),
+                    cast(:game_{i} as game),
+                    cast(:rating_{i} as double precision),
+                    cast(:games_{i} as integer)
+                )"""
+            )
+            values[f"agent_id_{i}"] = agent_id
+            values[f"game_{i}"] = game
+            values[f"rating_{i}"] = rating
+            values[f"games_{i}"] = games
+        await database.execute(
+            query=f"""
+            insert into agent_ratings (agent_id, game, rating, games, updated_at)
+            select r.agent_id, r.game, r.rating, r.games, now()
+            from (values {", ".join(values_sql)}) r(agent_id, game, rating, games)
+            join agents a on a.id = r.agent_id
+            """,
+            values=values,
+        )
+
+
+async def list_unhealthy_agents(
+    database: Database,
+) -> list[tuple[int, Agent, AgentDeployment]]:
+    agents_r = await database.fetch_all(
+        query="""
+        select a.id, a.game, a.user_id, a.agentname,
+               ad.url, ad.healthy, ad.active, ad.protocol, ad.speculative,
+               ad.deterministic, ad.version, ad.batch_url, ad.transport,
+               ad.source
+        from agents a
+        join agent_deployment ad on a.id = ad.agent_id
+        where not ad.healthy
+        """,
     )
+    unhealthy = []
+    for agent_r in agents_r:
+        user = await users.get_user_by_id(agent_r["user_id"])
+        assert user is not None
+        unhealthy.append(
+            (
+                agent_r["id"],
+                Agent(
+                    game=agent_r["game"],
+                    username=user.username,
+                    agentname=agent_r["agentname"],
+                ),
+                AgentDeployment(
+                    transport=agent_r["transport"],
+                    url=agent_r["url"],
+                    healthy=agent_r["healthy"],
+                    active=agent_r["active"],
+                    protocol=agent_r["protocol"],
+                    speculative=agent_r["speculative"],
+                    deterministic=agent_r["deterministic"],
+                    version=agent_r["version"],
+                    batch_url=agent_r["batch_url"],
+                    source=agent_r["source"],
+                ),
+            )
+        )
+    return unhealthy
+
+
+async def save_speculations(
+    database: Database,
+    match_id: int,
+    agent_id: int,
+    speculations: list[tuple[str, Action]],
+) -> None:
+    """
+    speculations are (position hash, the agent's action in that position).
+    """
+    if not speculations:
+        return
+    rows = []
+    values: dict[str, object] = {"match_id": match_id, "agent_id": agent_id}
+    for i, (position, action) in enumerate(speculations):
+        rows.append(f"(:match_id, :position_{i}, :agent_id, :action_{i}, now())")
+        values[f"position_{i}"] = position
+        values[f"action_{i}"] = json.dumps(common.serialize_action(action))
+    await database.execute(
+        query=f"""
+        insert into agent_speculations
+            (match_id, position, agent_id, action, created_at)
+        values {", ".join(rows)}
+        on conflict (match_id, position) do nothing
+        """,
+        values=values,
+    )
+
+
+async def take_speculation(
+    database: Database, match_id: int, agent_id: int, game: Game, position: str
+) -> Action | None:
+    """
+    The agent's action for the position if it was fetched ahead. Every
+    speculation for the match is dropped, the others can't come up again.
+    """
+    speculations_r = await database.fetch_all(
+        query="""
+        delete from agent_speculations
+        where match_id = :match_id
+        returning position, agent_id, action
+        """,
+        values={"match_id": match_id},
+    )
+    for speculation_r in speculations_r:
+        if (
+            speculation_r["position"] == position
+            and speculation_r["agent_id"] == agent_id
+        ):
+            return common.deserialize_action(game, json.loads(speculation_r["action"]))
+    return None
+
+
+async def add_agent_calls(
+    database: Database,
+    agent_id: int,
+    buckets: dict[int, int],
+    calls: int,
+    timeouts: int,
+    errors: int,
+    total_seconds: float,
+) -> None:
+    async with database.transaction():
+        await database.execute(
+            query="""
+            insert into agent_calls (agent_id, calls, timeouts, errors, total_seconds)
+            values (:agent_id, :calls, :timeouts, :errors, :total_seconds)
+            on conflict (agent_id) do update set
+                calls = agent_calls.calls + excluded.calls,
+                timeouts = agent_calls.timeouts + excluded.timeouts,
+                errors = agent_calls.errors + excluded.errors,
+                total_seconds = agent_calls.total_seconds + excluded.total_seconds
+            """,
+            values={
+                "agent_id": agent_id,
+                "calls": calls,
+                "timeouts": timeouts,
+                "errors": errors,
+                "total_seconds": total_seconds,
+            },
+        )
+        rows = []
+        values: dict[str, Any] = {"agent_id": agent_id}
+        for i, (le_ms, count) in enumerate(sorted(buckets.items())):
+            rows.append(f"(:agent_id, :le_ms_{i}, :count_{i})")
+            values[f"le_ms_{i}"] = le_ms
+            values[f"count_{i}"] = count
+        if rows:
+            await database.execute(
+                query=f"""
+                insert into agent_latency (agent_id, le_ms, count)
+                values {", ".join(rows)}
+                on conflict (agent_id, le_ms) do update set
+                    count = agent_latency.count + excluded.count
+                """,
+                values=values,
+            )
+
+
+async def list_agent_stats(
+    database: Database, agent_id: int | None = None
+) -> list[AgentStats]:
+    """
+    Stats for every agent, or just one.
+    """
+    agents_r = await database.fetch_all(
+        query="""
+        select a.id, a.game, a.user_id, a.agentname, ad.healthy,
+               ah.wins, ah.losses, ah.draws, ah.errors as match_errors,
+               coalesce(ac.calls, 0) as calls,
+               coalesce(ac.timeouts, 0) as timeouts,
+               coalesce(ac.errors, 0) as errors,
+               coalesce(ac.total_seconds, 0) as total_seconds
+        from agents a
+        join agent_deployment ad on a.id = ad.agent_id
+        join agent_history ah on a.id = ah.agent_id
+        left join agent_calls ac on a.id = ac.agent_id
+        where cast(:agent_id as bigint) is null or a.id = cast(:agent_id as bigint)
+        order by a.id
+        """,
+        values={"agent_id": agent_id},
+    )
+    buckets_r = await database.fetch_all(
+        query="""
+        select agent_id, le_ms, count from agent_latency
+        where cast(:agent_id as bigint) is null or agent_id = cast(:agent_id as bigint)
+        """,
+        values={"agent_id": agent_id},
+    )
+    buckets: dict[int, dict[int, int]] = defaultdict(dict)
+    for bucket_r in buckets_r:
+        buckets[bucket_r["agent_id"]][bucket_r["le_ms"]] = bucket_r["count"]
+
+    agent_stats = []
+    for agent_r in agents_r:
+        user = await users.get_user_by_id(agent_r["user_id"])
+        assert user is not None
+        agent_stats.append(
+            AgentStats(
+                agent=Agent(
+                    game=agent_r["game"],
+                    username=user.username,
+                    agentname=agent_r["agentname"],
+                ),
+                healthy=agent_r["healthy"],
+                history=AgentHistory(
+                    wins=agent_r["wins"],
+                    losses=agent_r["losses"],
+                    draws=agent_r["draws"],
+                    errors=agent_r["match_errors"],
+                ),
+                calls=stats.agent_call_stats(
+                    buckets[agent_r["id"]],
+                    agent_r["calls"],
+                    agent_r["timeouts"],
+                    agent_r["errors"],
+                    agent_r["total_seconds"],
+                ),
+            )
+        )
+    return agent_stats
 
 
 async def list_agents(database: Database) -> list[Agent]:
@@ -0,0 +1,485 @@
+"""
+Hosted agents are python modules uploaded by users that define
+    choose(state) -> column
+where state is the connect4 state as plain json types, board[column][row]
+from the bottom with " " for empty, "B" for blue and "R" for red.
+
+They're off unless HOSTED_AGENTS=1. Each call runs in one of a pool of
+separate python processes, a process only ever runs one agent's source, that
+    start with an empty environment, none of the app's secrets
+    run as HOSTED_AGENT_USER (default nobody) when the app runs as root
+    can't open files or sockets or start processes, they have no file
+        descriptors left besides their pipes to the app
+    are limited to HOSTED_AGENT_MEMORY_MB of memory and
+        HOSTED_AGENT_CPU_SECONDS of cpu time per call, with a hard limit
+        from the kernel behind the python one
+    are killed when a call misses its deadline and replaced after
+        HOSTED_AGENT_PROCESS_CALLS calls
+Agents only get public builtins and copies of a few modules without their
+private attributes. Their source can't use dunder attributes, besides
+__init__, or the ones that reach stack frames, so they can't get to os or sys
+either.
+
+The process runs this file as its script, it only uses the standard library
+and talks to the app in json lines over stdin and stdout.
+"""
+import ast
+import asyncio
+import builtins
+import hashlib
+import importlib
+import json
+import math
+import os
+import pwd
+import resource
+import signal
+import sys
+from collections import OrderedDict
+from types import FrameType, ModuleType
+from typing import Any, Callable
+
+
+class HostedAgentError(Exception):
+    pass
+
+
+class HostedAgentTimeout(HostedAgentError):
+    pass
+
+
+class _CpuTimeExceeded(BaseException):
+    """
+    Not an Exception so an agent's except Exception doesn't swallow it.
+    """
+
+
+_allowed_modules = {
+    "bisect",
+    "collections",
+    "copy",
+    "functools",
+    "heapq",
+    "itertools",
+    "math",
+    "operator",
+    "random",
+}
+# Public names that hand out arbitrary attributes by name.
+_blocked_module_attributes = {"attrgetter", "methodcaller"}
+_blocked_builtins = {
+    "breakpoint",
+    "compile",
+    "eval",
+    "exec",
+    "exit",
+    "globals",
+    "help",
+    "input",
+    "memoryview",
+    "open",
+    "quit",
+    "vars",
+}
+# Besides the dunders, attributes that lead from an agent's own objects to the
+# frames, globals and modules of the process.
+_allowed_dunders = {"__init__"}
+_blocked_attributes = {
+    "ag_await",
+    "ag_code",
+    "ag_frame",
+    "cr_await",
+    "cr_code",
+    "cr_frame",
+    "f_back",
+    "f_builtins",
+    "f_code",
+    "f_globals",
+    "f_locals",
+    "gi_code",
+    "gi_frame",
+    "gi_yieldfrom",
+    "tb_frame",
+    "tb_next",
+}
+
+
+def hosted_agents_enabled() -> bool:
+    return os.environ.get("HOSTED_AGENTS") == "1"
+
+
+def _public_module(module: ModuleType) -> ModuleType:
+    """
+    A copy of module without its private attributes or other modules, random
+    keeps os as random._os.
+    """
+    public = ModuleType(module.__name__)
+    public.__dict__.update(
+        (name, value)
+        for name, value in vars(module).items()
+        if not name.startswith("_")
+        and name not in _blocked_module_attributes
+        and not isinstance(value, ModuleType)
+    )
+    return public
+
+
+# Filled in by _serve, the modules agents can import.
+_public_modules: dict[str, ModuleType] = {}
+
+
+def _import(
+    name: str,
+    globals: Any = None,
+    locals: Any = None,
+    fromlist: Any = (),
+    level: int = 0,
+) -> Any:
+    if level != 0 or name not in _public_modules:
+        raise ImportError(f"Hosted agents can't import {name}.")
+    return _public_modules[name]
+
+
+def _check_attribute(name: str) -> None:
+    if (
+        name.startswith("__") and name not in _allowed_dunders
+    ) or name in _blocked_attributes:
+        raise AttributeError(f"Hosted agents can't use the attribute {name}.")
+
+
+def _getattr(obj: Any, name: str, *default: Any) -> Any:
+    _check_attribute(name)
+    return getattr(obj, name, *default)
+
+
+def _setattr(obj: Any, name: str, value: Any) -> None:
+    _check_attribute(name)
+    setattr(obj, name, value)
+
+
+def _delattr(obj: Any, name: str) -> None:
+    _check_attribute(name)
+    delattr(obj, name)
+
+
+def _agent_builtins() -> dict[str, Any]:
+    agent_builtins = {
+        name: value
+        for name, value in vars(builtins).items()
+        if not name.startswith("_") and name not in _blocked_builtins
+    }
+    agent_builtins["__build_class__"] = builtins.__build_class__
+    agent_builtins["__import__"] = _import
+    agent_builtins["getattr"] = _getattr
+    agent_builtins["setattr"] = _setattr
+    agent_builtins["delattr"] = _delattr
+    return agent_builtins
+
+
+def _check_source(source: str) -> None:
+    """
+    Raises HostedAgentError if the agent uses an attribute it can't, the
+    getattr family checks the ones named at runtime.
+    """
+    try:
+        tree = ast.parse(source, "<agent>")
+    except SyntaxError as e:
+        raise HostedAgentError(f"SyntaxError: {e}") from None
+    for node in ast.walk(tree):
+        match node:
+            case ast.Attribute(attr=name):
+                names = [name]
+            # Class patterns look up their keywords as attributes.
+            case ast.MatchClass(kwd_attrs=names):
+                pass
+            case _:
+                continue
+        for name in names:
+            try:
+                _check_attribute(name)
+            except AttributeError as e:
+                raise HostedAgentError(str(e)) from None
+
+
+# In each agent process, the sha256 of the one agent it runs and its choose.
+_agent: tuple[str, Callable[[dict[str, Any]], Any]] | None = None
+
+
+def _on_cpu_time_exceeded(signum: int, frame: FrameType | None) -> None:
+    raise _CpuTimeExceeded()
+
+
+def _cpu_time_used() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _choose(
+    source_hash: str, source: str, state: dict[str, Any], cpu_seconds: float
+) -> int:
+    # The kernel kills the process a second past the call's cpu time, in case
+    # the agent catches _CpuTimeExceeded every time it's raised.
+    _, process_cpu_seconds = resource.getrlimit(resource.RLIMIT_CPU)
+    call_cpu_seconds = math.ceil(_cpu_time_used() + cpu_seconds) + 1
+    resource.setrlimit(
+        resource.RLIMIT_CPU,
+        (min(call_cpu_seconds, process_cpu_seconds), process_cpu_seconds),
+    )
+    # Loading the module counts against the call's cpu time too. The timer
+    # keeps firing until the call is over.
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds, 0.05)
+    global _agent
+    try:
+        if _agent is None:
+            _check_source(source)
+            namespace: dict[str, Any] = {
+                "__builtins__": _agent_builtins(),
+                "__name__": "agent",
+            }
+            exec(compile(source, "<agent>", "exec"), namespace)
+            choose = namespace.get("choose")
+            if not callable(choose):
+                raise HostedAgentError("The agent doesn't define choose(state).")
+            _agent = (source_hash, choose)
+        elif _agent[0] != source_hash:
+            raise HostedAgentError("The process runs another agent.")
+        column = _agent[1](state)
+    except HostedAgentError:
+        raise
+    except _CpuTimeExceeded:
+        raise HostedAgentTimeout("The agent ran out of cpu time.") from None
+    except Exception as e:
+        raise HostedAgentError(f"{type(e).__name__}: {e}") from None
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+    if not isinstance(column, int):
+        raise HostedAgentError("choose(state) should return a column number.")
+    return column
+
+
+def _serve(memory_bytes: int, process_cpu_seconds: int) -> None:
+    """
+    The agent process, answers requests from stdin until it's closed.
+    """
+    # Everything an agent may import has to be loaded before the process
+    # loses its file descriptors.
+    for name in _allowed_modules:
+        _public_modules[name] = _public_module(importlib.import_module(name))
+    requests = sys.stdin.buffer
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    # Whatever the agent prints goes nowhere instead of into the responses.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+    resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    resource.setrlimit(resource.RLIMIT_CPU, (process_cpu_seconds, process_cpu_seconds))
+    # No new files or sockets, no child processes and nothing written to disk.
+    resource.setrlimit(resource.RLIMIT_NOFILE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    signal.signal(signal.SIGPROF, _on_cpu_time_exceeded)
+
+    for line in requests:
+        request = json.loads(line)
+        response: dict[str, Any]
+        try:
+            column = _choose(
+                request["source_hash"],
+                request["source"],
+                request["state"],
+                request["cpu_seconds"],
+            )
+            response = {"column": column}
+        except HostedAgentTimeout as e:
+            response = {"timeout": str(e)}
+        except HostedAgentError as e:
+            response = {"error": str(e)}
+        responses.write(json.dumps(response).encode() + b"\n")
+        responses.flush()
+
+
+class _AgentProcess:
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.calls = 0
+
+    async def call(self, request: bytes) -> dict[str, Any]:
+        assert self.process.stdin is not None and self.process.stdout is not None
+        try:
+            self.process.stdin.write(request)
+            await self.process.stdin.drain()
+            line = await self.process.stdout.readline()
+        except (ConnectionError, ValueError):
+            line = b""
+        self.calls += 1
+        if not line:
+            raise HostedAgentError(
+                "The agent crashed, it may have run out of memory or cpu time."
+            )
+        try:
+            response: dict[str, Any] = json.loads(line)
+        except ValueError:
+            raise HostedAgentError("The agent sent a bad response.")
+        return response
+
+    async def kill(self) -> None:
+        if self.process.returncode is None:
+            self.process.kill()
+        await self.process.wait()
+
+
+class _Sandbox:
+    """
+    Configured with environment variables.
+        HOSTED_AGENT_PROCESSES: number of agent processes, default the number
+            of cpus
+        HOSTED_AGENT_MEMORY_MB: memory limit of each process, default 512
+        HOSTED_AGENT_CPU_SECONDS: cpu time per call, default 1
+        HOSTED_AGENT_DEADLINE: seconds to wait for a call, including time
+            queued for a process, default 5
+        HOSTED_AGENT_PROCESS_CALLS: calls before a process is replaced,
+            default 100
+        HOSTED_AGENT_USER: user the processes run as when the app runs as
+            root, default nobody
+    """
+
+    def __init__(self) -> None:
+        processes = int(
+            os.environ.get("HOSTED_AGENT_PROCESSES", str(os.cpu_count() or 1))
+        )
+        self.memory_bytes = (
+            int(os.environ.get("HOSTED_AGENT_MEMORY_MB", "512")) * 1024 * 1024
+        )
+        self.cpu_seconds = float(os.environ.get("HOSTED_AGENT_CPU_SECONDS", "1"))
+        self.deadline = float(os.environ.get("HOSTED_AGENT_DEADLINE", "5"))
+        self.process_calls = int(os.environ.get("HOSTED_AGENT_PROCESS_CALLS", "100"))
+        self.user = os.environ.get("HOSTED_AGENT_USER", "nobody")
+        with open(__file__) as f:
+            self.source = f.read()
+        self.slots = asyncio.Semaphore(processes)
+        self.max_idle = processes
+        # An idle process for each of the most recently called agents.
+        self.idle: OrderedDict[str, _AgentProcess] = OrderedDict()
+        self.busy: set[_AgentProcess] = set()
+
+    async def _start_process(self) -> _AgentProcess:
+        # Every call can use a second past its cpu time before the kernel
+        # steps in, plus some for starting python.
+        process_cpu_seconds = math.ceil((self.cpu_seconds + 1) * self.process_calls)
+        privileges: dict[str, Any] = {}
+        if os.geteuid() == 0:
+            user = pwd.getpwnam(self.user)
+            privileges = {
+                "user": user.pw_uid,
+                "group": user.pw_gid,
+                "extra_groups": [],
+            }
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            # Isolated mode, no PYTHON* variables, user site or working
+            # directory on the path.
+            "-I",
+            "-c",
+            self.source,
+            str(self.memory_bytes),
+            str(process_cpu_seconds + 10),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            env={},
+            cwd="/",
+            start_new_session=True,
+            **privileges,
+        )
+        return _AgentProcess(process)
+
+    async def call(self, source_hash: str, request: bytes) -> dict[str, Any]:
+        """
+        Processes are never shared between agents, the agent could read or
+        replace the other one's choose.
+        """
+        async with self.slots:
+            process = self.idle.pop(source_hash, None)
+            if process is None:
+                process = await self._start_process()
+            self.busy.add(process)
+            try:
+                response = await process.call(request)
+            except BaseException:
+                # Timed out, cancelled or crashed, the agent may still be
+                # running.
+                await process.kill()
+                raise
+            finally:
+                self.busy.discard(process)
+            retired = []
+            if process.calls >= self.process_calls or source_hash in self.idle:
+                retired.append(process)
+            else:
+                self.idle[source_hash] = process
+            while len(self.idle) > self.max_idle:
+                retired.append(self.idle.popitem(last=False)[1])
+            await asyncio.gather(
+                *(retired_process.kill() for retired_process in retired)
+            )
+            return response
+
+    async def close(self) -> None:
+        processes = [*self.idle.values(), *self.busy]
+        self.idle.clear()
+        self.busy.clear()
+        await asyncio.gather(*(process.kill() for process in processes))
+
+
+_sandbox: _Sandbox | None = None
+
+
+def _get_sandbox() -> _Sandbox:
+    global _sandbox
+    if _sandbox is None:
+        _sandbox = _Sandbox()
+    return _sandbox
+
+
+async def close_sandbox() -> None:
+    global _sandbox
+    sandbox, _sandbox = _sandbox, None
+    if sandbox is not None:
+        await sandbox.close()
+
+
+async def run_hosted_agent(source: str, state: dict[str, Any]) -> int:
+    """
+    The column the agent chooses.
+    """
+    if not hosted_agents_enabled():
+        raise HostedAgentError("Hosted agents aren't enabled.")
+    sandbox = _get_sandbox()
+    source_hash = hashlib.sha256(source.encode()).hexdigest()
+    request = {
+        "source_hash": source_hash,
+        "source": source,
+        "state": state,
+        "cpu_seconds": sandbox.cpu_seconds,
+    }
+    try:
+        response = await asyncio.wait_for(
+            sandbox.call(source_hash, json.dumps(request).encode() + b"\n"),
+            sandbox.deadline,
+        )
+    except asyncio.TimeoutError:
+        raise HostedAgentTimeout("The agent didn't answer in time.")
+    match response:
+        case {"column": int(column)}:
+            return column
+        case {"timeout": str(message)}:
+            raise HostedAgentTimeout(message)
+        case {"error": str(message)}:
+            raise HostedAgentError(message)
+        case _:
+            raise HostedAgentError("The agent sent a bad response.")
+
+
+if __name__ == "__main__":
+    _serve(int(sys.argv[1]), int(sys.argv[2]))
@@ -1,10 +1,20 @@
 from pydantic import BaseModel, HttpUrl
 
+from gameplay_computer.gameplay import Agent, AgentProtocol, AgentTransport
+
 
 class AgentDeployment(BaseModel):
-    url: HttpUrl
+    transport: AgentTransport
+    url: HttpUrl | None
     active: bool
     healthy: bool
+    protocol: AgentProtocol
+    speculative: bool
+    deterministic: bool
+    version: str
+    # Where to send requests for several matches at once, optional.
+    batch_url: HttpUrl | None
+    source: str | None
 
 
 class AgentHistory(BaseModel):
@@ -12,3 +22,62 @@ class AgentHistory(BaseModel):
     losses: int
     draws: int
     errors: int
+
+
+class AgentCallStats(BaseModel):
+    calls: int
+    timeouts: int
+    # failed calls that weren't timeouts
+    errors: int
+    mean_ms: float | None
+    # upper bounds of the latency buckets, None when there were no calls or
+    # it's over the largest bucket
+    p50_ms: int | None
+    p95_ms: int | None
+    p99_ms: int | None
+
+
+class AgentStats(BaseModel):
+    agent: Agent
+    healthy: bool
+    history: AgentHistory
+    calls: AgentCallStats
+
+
+class AgentRating(BaseModel):
+    agent: Agent
+    # 1 is the best.
+    rank: int
+    rating: float
+    games: int
+
+
+class AgentClientMetrics(BaseModel):
+    requests: int
+    errors: int
+    # requests in flight per agent host
+    in_flight: dict[str, int]
+    connections: int
+    idle_connections: int
+
+
+class BulkheadMetrics(BaseModel):
+    name: str
+    limit: int
+    in_flight: int
+    waiting: int
+    acquired: int
+    rejected: int
+    # total time spent waiting for a slot
+    wait_seconds: float
+
+
+class ResponseCacheMetrics(BaseModel):
+    size: int
+    max_size: int
+    # found in this process
+    hits: int
+    # found in the database
+    shared_hits: int
+    misses: int
+    hit_rate: float
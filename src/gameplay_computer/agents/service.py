@@ -1,50 +1,116 @@
 import asyncio
-from typing import assert_never
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, assert_never
 
 import httpx
 import sentry_sdk
 from databases import Database
 from fastapi import HTTPException, status
 
-from gameplay_computer import users
-from gameplay_computer.gameplay import Action, Agent, Connect4Action, Game, Match, Turn
+from gameplay_computer import common, users
+from gameplay_computer.gameplay import (
+    Action,
+    Agent,
+    AgentProtocol,
+    AgentTransport,
+    CompactMatch,
+    Connect4Action,
+    Game,
+    Match,
+    Turn,
+)
 
 from ..games import Connect4Logic
-from . import repo
+from . import cache, health, repo, stats
+from .batching import get_agent_batcher
+from .bulkhead import agent_bulkhead
+from .errors import AgentBusy, AgentError
+from .ratings import Ratings
+from .sandbox import (
+    HostedAgentError,
+    HostedAgentTimeout,
+    hosted_agents_enabled,
+    run_hosted_agent,
+)
+from .schemas import AgentDeployment, AgentRating, AgentStats
+from .sockets import AgentSocketError, AgentSocketTimeout, request_action
+from .client import get_agent_client
 
 
-async def create_agent(
-    database: Database,
-    created_by_user_id: str,
-    game: Game,
-    agentname: str,
-    url: str,
-) -> int:
-    created_by_user = await users.get_user_by_id(created_by_user_id)
-    if created_by_user is None:
+DETERMINISTIC_HEADER = "Gameplay-Agent-Deterministic"
+VERSION_HEADER = "Gameplay-Agent-Version"
+
+
+def compact_match(match: Match) -> CompactMatch:
+    """
+    The compact/1 request for the next player. Only includes the turns since
+    that player last moved.
+    """
+    next_player = match.state.next_player
+    since = 0
+    for turn in match.turns:
+        if turn.player is not None and turn.player == next_player:
+            since = turn.number
+    return CompactMatch(
+        id=match.id,
+        game=match.state.game,
+        turn=match.turn,
+        next_player=next_player,
+        position=common.serialize_position(match.state),
+        turns=[turn for turn in match.turns if turn.number > since],
+    )
+
+
+def agent_request(protocol: AgentProtocol, match: Match) -> dict[str, Any]:
+    match protocol:
+        case "match":
+            return match.dict()
+        case "compact/1":
+            return compact_match(match).dict()
+        case _protocol as unknown:
+            assert_never(unknown)
+
+
+def _check_probe_action(fake_match: Match, load: Callable[[], Any]) -> None:
+    """
+    A 400 unless load gives a valid action for the match's game, bad json
+    included.
+    """
+    try:
+        action_json = load()
+        match fake_match.state.game:
+            case "connect4":
+                Connect4Action.parse_obj(action_json)
+            case _game as unknown:
+                assert_never(unknown)
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Unknown user.",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Agent didn't return a valid action.",
         )
 
+
+async def probe_agent(
+    client: httpx.AsyncClient,
+    agent: Agent,
+    url: str,
+    protocol: AgentProtocol,
+    batch_url: str | None = None,
+) -> None:
+    """
+    Check that an agent is online by sending it the first turn of a fake match
+    against itself. Raises if it doesn't answer with a valid action.
+    """
     turn = Turn(
         number=0,
         player=None,
         action=None,
         next_player=0,
     )
-    fake_players = [
-        Agent(
-            game=game,
-            username=created_by_user.username,
-            agentname=agentname,
-        ),
-        Agent(
-            game=game,
-            username=created_by_user.username,
-            agentname=agentname,
-        ),
-    ]
+    fake_players = [agent, agent]
     state = Connect4Logic.initial_state()
     fake_match = Match(
         id=1,
@@ -53,27 +119,152 @@ async def create_agent(
         turn=0,
         state=state,
     )
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(url, json=fake_match.dict(), timeout=1)
-        except (httpx.ReadTimeout, httpx.ConnectError):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Agent doesn't seem online.",
-            )
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Agent doesn't seem online.",
+    try:
+        response = await client.post(
+            url, json=agent_request(protocol, fake_match), timeout=1
+        )
+    except (httpx.ReadTimeout, httpx.ConnectError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Agent doesn't seem online.",
+        )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Agent doesn't seem online.",
+        )
+    _check_probe_action(fake_match, response.json)
+
+    if batch_url is None:
+        return
+    try:
+        response = await client.post(
+            batch_url, json=[agent_request(protocol, fake_match)], timeout=1
+        )
+    except (httpx.ReadTimeout, httpx.ConnectError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Agent batch url doesn't seem online.",
+        )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Agent batch url doesn't seem online.",
+        )
+    actions = response.json()
+    if not isinstance(actions, list) or len(actions) != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Agent batch url should return a list of actions.",
+        )
+    _check_probe_action(fake_match, lambda: actions[0])
+
+
+# HOSTED_AGENT_MAX_SOURCE: longest hosted agent source in characters,
+# default 64k
+hosted_agent_max_source = int(os.environ.get("HOSTED_AGENT_MAX_SOURCE", "65536"))
+
+
+async def probe_hosted_agent(source: str) -> None:
+    """
+    Check that a hosted agent loads and plays the first move of a match.
+    """
+    state = Connect4Logic.initial_state()
+    try:
+        column = await run_hosted_agent(source, json.loads(state.json()))
+        Connect4Action(column=column)
+    except (HostedAgentError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Agent doesn't work: {e}",
+        )
+
+
+async def create_agent(
+    database: Database,
+    created_by_user_id: str,
+    game: Game,
+    agentname: str,
+    url: str | None,
+    protocol: AgentProtocol = "match",
+    speculative: bool = False,
+    deterministic: bool = False,
+    batch_url: str | None = None,
+    transport: AgentTransport = "http",
+    token_hash: str | None = None,
+    source: str | None = None,
+    client: httpx.AsyncClient | None = None,
+) -> int:
+    """
+    websocket agents need the token_hash from new_agent_token, they can't be
+    probed until they connect with the token. hosted agents need their source,
+    they start unhealthy and the worker's health probe runs them, uploaded
+    code never runs in the web app.
+    """
+    created_by_user = await users.get_user_by_id(created_by_user_id)
+    if created_by_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Unknown user.",
+        )
+
+    match transport:
+        case "http":
+            if url is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Agents over http need a url.",
+                )
+            if client is None:
+                client = get_agent_client()
+            await probe_agent(
+                client,
+                Agent(
+                    game=game, username=created_by_user.username, agentname=agentname
+                ),
+                url,
+                protocol,
+                batch_url,
             )
-        match fake_match.state.game:
-            case "connect4":
-                Connect4Action(**response.json())
-            case _game as unknown:
-                assert_never(unknown)
+        case "websocket":
+            assert token_hash is not None
+            url = None
+            batch_url = None
+        case "hosted":
+            if not hosted_agents_enabled():
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Hosted agents aren't enabled.",
+                )
+            if not source:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Hosted agents need their source.",
+                )
+            if len(source) > hosted_agent_max_source:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Hosted agent source is too long.",
+                )
+            url = None
+            batch_url = None
+        case _transport as unknown:
+            assert_never(unknown)
 
     agent_id = await repo.create_agent(
-        database, created_by_user_id, game, agentname, url
+        database,
+        created_by_user_id,
+        game,
+        agentname,
+        url,
+        protocol,
+        speculative,
+        deterministic,
+        batch_url,
+        transport,
+        token_hash,
+        source,
+        healthy=transport != "hosted",
     )
     return agent_id
 
@@ -130,17 +321,42 @@ async def get_agent_id_for_username_and_agentname(
     return agent_id
 
 
+async def get_agent_deployment(database: Database, agent_id: int) -> AgentDeployment:
+    deployment = await repo.get_agent_deployment(database, agent_id)
+    if deployment is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown agent.",
+        )
+    return deployment
+
+
+_timeouts = (httpx.TimeoutException, AgentSocketTimeout, HostedAgentTimeout)
+
+
 async def get_agent_action(
     database: Database,
     client: httpx.AsyncClient,
     agent: Agent,
     match: Match,
+    agent_id: int | None = None,
 ) -> Action:
+    """
+    Ask the agent for its next action in the match.
+    Pass agent_id when calling this in a loop so the agent only gets looked up
+    once, the deployment is cached by id.
+    Raises AgentBusy if the agent already has too many requests in flight and
+    AgentError if the agent is down or didn't return a valid action.
+    """
     span = sentry_sdk.Hub.current.scope.span
     if span is not None:
         span.set_tag("agent", f"{agent.username}/{agent.agentname}")
 
-    deployment = await repo.get_agent_deployment(database, agent)
+    if agent_id is None:
+        agent_id = await get_agent_id_for_username_and_agentname(
+            database, agent.username, agent.agentname
+        )
+    deployment = await repo.get_agent_deployment(database, agent_id)
     if deployment is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -152,35 +368,264 @@ async def get_agent_action(
             detail="Wrong game.",
         )
 
-    action: Action | None = None
+    position = common.position_hash(match.state)
+    if deployment.deterministic:
+        cached_action = await cache.get_cached_action(
+            database, agent_id, deployment.version, match.state.game, position
+        )
+        if cached_action is not None:
+            return cached_action
 
-    retries = 0
-    while retries < 3:
-        try:
-            response = await client.post(deployment.url, json=match.dict())
-            response.raise_for_status()
-            match match.state.game:
-                case "connect4":
-                    action = Connect4Action(**response.json())
-                case _game as unknown:
-                    assert_never(unknown)
-            break
-        except httpx.HTTPError as e:
-            print(f"Error: {e}")
-            retries += 1
-            await asyncio.sleep(retries)
-
-    # todo: log errors
-    if action is None:
-        print("ERROR: too many agent errors")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Too many agent errors.",
+    # Fail fast if the agent has been failing, here or in another process.
+    breaker = health.get_circuit_breaker(agent_id)
+    if not deployment.healthy:
+        breaker.trip()
+    if not breaker.allow_request():
+        raise AgentError("Agent is unavailable.", turn=match.turn)
+
+    request = agent_request(deployment.protocol, match)
+
+    # One try, retries are the caller's job so nothing sleeps in here.
+    start = time.monotonic()
+    try:
+        match deployment.transport:
+            case "websocket":
+                # Every agent has its own connection, no host to share.
+                async with agent_bulkhead(agent_id, f"websocket {agent_id}"):
+                    action_json = await request_action(database, agent_id, request)
+                headers = httpx.Headers()
+            case "hosted":
+                assert deployment.source is not None
+                # Hosted agents share the worker's process pool.
+                async with agent_bulkhead(agent_id, "hosted"):
+                    column = await run_hosted_agent(
+                        deployment.source, json.loads(match.state.json())
+                    )
+                action_json, headers = {"column": column}, httpx.Headers()
+            case "http":
+                assert deployment.url is not None
+                if deployment.batch_url is not None:
+                    batcher = get_agent_batcher(agent_id, deployment.batch_url)
+                    action_json, headers = await batcher.submit(client, request)
+                else:
+                    host = httpx.URL(deployment.url).host
+                    async with agent_bulkhead(agent_id, host):
+                        response = await client.post(deployment.url, json=request)
+                    response.raise_for_status()
+                    action_json, headers = response.json(), response.headers
+            case _transport as unknown:
+                assert_never(unknown)
+        match match.state.game:
+            case "connect4":
+                # parse_obj, unlike **, fails with a ValueError on json
+                # that isn't an object.
+                action = Connect4Action.parse_obj(action_json)
+            case _game as unknown_game:
+                assert_never(unknown_game)
+    # ValueError covers bad json and invalid actions.
+    except (httpx.HTTPError, ValueError, AgentSocketError, HostedAgentError) as e:
+        stats.record_agent_call(
+            agent_id,
+            time.monotonic() - start,
+            "timeout" if isinstance(e, _timeouts) else "error",
         )
+        if breaker.record_failure():
+            await repo.set_agent_healthy(database, agent_id, False)
+        raise AgentError(f"Agent error: {e}", turn=match.turn) from e
 
+    stats.record_agent_call(agent_id, time.monotonic() - start, "ok")
+    if breaker.record_success():
+        await repo.set_agent_healthy(database, agent_id, True)
+
+    # Agents can also say they're deterministic, and which version answered,
+    # in their response headers.
+    deterministic = deployment.deterministic or (
+        headers.get(DETERMINISTIC_HEADER, "").lower() == "true"
+    )
+    version = headers.get(VERSION_HEADER, deployment.version)
+    if (deterministic, version) != (deployment.deterministic, deployment.version):
+        await repo.set_agent_version(database, agent_id, deterministic, version)
+    if deterministic:
+        await cache.cache_action(database, agent_id, version, position, action)
     return action
 
 
+async def speculate_agent_replies(
+    database: Database,
+    client: httpx.AsyncClient,
+    agent: Agent,
+    match: Match,
+    agent_id: int | None = None,
+) -> int:
+    """
+    While a user thinks, ask a speculative agent what it would play after each
+    move the user could make, so its reply can be played as soon as the user
+    moves. Returns how many replies were saved.
+    """
+    if agent_id is None:
+        agent_id = await get_agent_id_for_username_and_agentname(
+            database, agent.username, agent.agentname
+        )
+    deployment = await repo.get_agent_deployment(database, agent_id)
+    if deployment is None or not deployment.speculative or not deployment.healthy:
+        return 0
+    player = match.state.next_player
+    if match.state.over or player is None:
+        return 0
+
+    hypotheticals = []
+    for action in Connect4Logic.actions(match.state):
+        hypothetical = match.copy(deep=True)
+        Connect4Logic.turn(hypothetical.state, player, action)
+        if hypothetical.state.over:
+            continue
+        number = len(hypothetical.turns)
+        hypothetical.turns.append(
+            Turn(
+                number=number,
+                player=player,
+                action=action,
+                next_player=hypothetical.state.next_player,
+            )
+        )
+        hypothetical.turn = number
+        hypotheticals.append(hypothetical)
+
+    results = await asyncio.gather(
+        *(
+            get_agent_action(database, client, agent, hypothetical, agent_id=agent_id)
+            for hypothetical in hypotheticals
+        ),
+        return_exceptions=True,
+    )
+    speculations = []
+    for hypothetical, result in zip(hypotheticals, results):
+        # A missed speculation only means the agent gets called after the
+        # user moves, as usual.
+        if isinstance(result, (AgentBusy, AgentError)):
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        speculations.append((common.position_hash(hypothetical.state), result))
+    await repo.save_speculations(database, match.id, agent_id, speculations)
+    return len(speculations)
+
+
+async def get_speculated_action(
+    database: Database,
+    agent: Agent,
+    match: Match,
+    agent_id: int | None = None,
+) -> Action | None:
+    """
+    The agent's action for the match's current position if it was fetched
+    ahead by speculate_agent_replies.
+    """
+    if agent_id is None:
+        agent_id = await get_agent_id_for_username_and_agentname(
+            database, agent.username, agent.agentname
+        )
+    deployment = await repo.get_agent_deployment(database, agent_id)
+    if deployment is None or not deployment.speculative:
+        return None
+    return await repo.take_speculation(
+        database,
+        match.id,
+        agent_id,
+        match.state.game,
+        common.position_hash(match.state),
+    )
+
+
+async def probe_unhealthy_agents(database: Database, client: httpx.AsyncClient) -> None:
+    """
+    Try every unhealthy agent again and mark the ones that answer healthy.
+    """
+    for agent_id, agent, deployment in await repo.list_unhealthy_agents(database):
+        try:
+            match deployment.transport:
+                case "http":
+                    assert deployment.url is not None
+                    await probe_agent(
+                        client,
+                        agent,
+                        deployment.url,
+                        deployment.protocol,
+                        deployment.batch_url,
+                    )
+                case "hosted":
+                    assert deployment.source is not None
+                    await probe_hosted_agent(deployment.source)
+                case "websocket":
+                    # Marked healthy when they connect.
+                    continue
+                case _transport as unknown:
+                    assert_never(unknown)
+        except (HTTPException, httpx.HTTPError, ValueError):
+            continue
+        health.get_circuit_breaker(agent_id).reset()
+        await repo.set_agent_healthy(database, agent_id, True)
+
+
+async def flush_agent_stats(database: Database) -> None:
+    """
+    Add the agent calls recorded in this process to the totals in the
+    database.
+    """
+    for agent_id, calls in stats.take_agent_calls().items():
+        try:
+            await repo.add_agent_calls(
+                database,
+                agent_id,
+                dict(calls.buckets),
+                calls.calls,
+                calls.timeouts,
+                calls.errors,
+                calls.total_seconds,
+            )
+        except Exception:
+            logging.exception("couldn't save stats for agent %s", agent_id)
+            stats.restore_agent_calls(agent_id, calls)
+
+
+async def get_agent_stats(
+    database: Database, username: str, agentname: str
+) -> AgentStats:
+    agent_id = await get_agent_id_for_username_and_agentname(
+        database, username, agentname
+    )
+    (agent_stats,) = await repo.list_agent_stats(database, agent_id)
+    return agent_stats
+
+
+async def list_agent_stats(database: Database) -> list[AgentStats]:
+    return await repo.list_agent_stats(database)
+
+
+async def update_agent_ratings(
+    database: Database,
+    game: Game,
+    agent_id_0: int,
+    agent_id_1: int,
+    winner: int | None,
+) -> None:
+    await repo.update_agent_ratings(database, game, agent_id_0, agent_id_1, winner)
+
+
+async def list_agent_ratings(
+    database: Database, game: Game, limit: int = 100, offset: int = 0
+) -> list[AgentRating]:
+    return await repo.list_agent_ratings(database, game, limit, offset)
+
+
+async def lock_agent_ratings(database: Database) -> None:
+    await repo.lock_agent_ratings(database)
+
+
+async def replace_agent_ratings(database: Database, new: Ratings) -> None:
+    await repo.replace_agent_ratings(database, new)
+
+
 async def list_agents(database: Database) -> list[Agent]:
     agents = await repo.list_agents(database)
     return agents
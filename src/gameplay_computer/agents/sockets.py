@@ -0,0 +1,233 @@
+"""
+Agents on the websocket transport connect to the web app and stay
+connected. Agent turns are played in the worker so requests and actions are
+relayed between the two through postgres notifications:
+    worker -> agent_socket_requests -> the web process the agent is
+        connected to -> websocket -> agent
+    agent -> websocket -> web -> agent_socket_responses -> worker
+Messages on the websocket are json objects with a type:
+    agent: {"type": "register", "username", "agentname", "token"}
+    server: {"type": "registered"}
+    server: {"type": "request", "id", "request"}
+    agent: {"type": "action", "id", "action"}
+    server: {"type": "ping"}, agent: {"type": "pong"}
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import uuid
+from typing import Any
+
+from databases import Database
+from fastapi import WebSocket, WebSocketDisconnect, status
+
+from gameplay_computer import users
+
+from . import repo
+
+
+class AgentSocketError(Exception):
+    pass
+
+
+class AgentSocketTimeout(AgentSocketError):
+    pass
+
+
+# Postgres drops notifications over 8000 bytes.
+_max_payload = 7900
+# AGENT_READ_TIMEOUT: seconds to wait for an action, same as for http agents.
+_request_timeout = float(os.environ.get("AGENT_READ_TIMEOUT", "10"))
+
+
+def new_agent_token() -> tuple[str, str]:
+    """
+    A token for an agent to register with and the hash to store.
+    """
+    token = secrets.token_urlsafe(32)
+    return token, hash_agent_token(token)
+
+
+def hash_agent_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# Worker side
+
+_pending: dict[str, asyncio.Future[Any]] = {}
+
+
+async def request_action(
+    database: Database, agent_id: int, request: dict[str, Any]
+) -> Any:
+    """
+    Send a request to a connected agent and wait for its action.
+    """
+    request_id = uuid.uuid4().hex
+    payload = json.dumps({"id": request_id, "agent_id": agent_id, "request": request})
+    if len(payload) > _max_payload:
+        raise AgentSocketError(
+            "Request is too large for a websocket agent, use the compact/1 protocol."
+        )
+    future: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+    _pending[request_id] = future
+    try:
+        await repo.notify_agent_socket(database, "agent_socket_requests", payload)
+        return await asyncio.wait_for(future, _request_timeout)
+    except asyncio.TimeoutError:
+        raise AgentSocketTimeout("Agent didn't answer in time, is it connected?")
+    finally:
+        _pending.pop(request_id, None)
+
+
+def resolve_socket_response(payload: str) -> None:
+    """
+    Called for every notification on agent_socket_responses, only the
+    process that sent the request has it pending.
+    """
+    response = json.loads(payload)
+    future = _pending.get(response["id"])
+    if future is None or future.done():
+        return
+    if "error" in response:
+        future.set_exception(AgentSocketError(response["error"]))
+    else:
+        future.set_result(response["action"])
+
+
+# Web side
+
+
+class AgentConnection:
+    def __init__(self, agent_id: int, websocket: WebSocket):
+        self.agent_id = agent_id
+        self.websocket = websocket
+        # Requests sent to the agent that it hasn't answered yet.
+        self.in_flight: set[str] = set()
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, message: dict[str, Any]) -> None:
+        async with self.send_lock:
+            await self.websocket.send_json(message)
+
+
+_connections: dict[int, AgentConnection] = {}
+
+
+async def forward_socket_request(payload: str) -> None:
+    """
+    Called for every notification on agent_socket_requests, only the
+    process the agent is connected to sends it on.
+    """
+    message = json.loads(payload)
+    connection = _connections.get(message["agent_id"])
+    if connection is None:
+        return
+    connection.in_flight.add(message["id"])
+    try:
+        await connection.send(
+            {"type": "request", "id": message["id"], "request": message["request"]}
+        )
+    except (WebSocketDisconnect, RuntimeError):
+        # serve_agent_socket fails whatever is in flight when it notices.
+        pass
+
+
+async def _register(database: Database, websocket: WebSocket) -> int | None:
+    message = await websocket.receive_json()
+    if message.get("type") != "register":
+        return None
+    user_id = await users.get_user_id_for_username(message.get("username", ""))
+    if user_id is None:
+        return None
+    agent_socket = await repo.get_agent_socket(
+        database, user_id, message.get("agentname", "")
+    )
+    if agent_socket is None:
+        return None
+    agent_id, token_hash = agent_socket
+    if not hmac.compare_digest(
+        token_hash, hash_agent_token(str(message.get("token", "")))
+    ):
+        return None
+    return agent_id
+
+
+async def _heartbeat(connection: AgentConnection, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await connection.send({"type": "ping"})
+
+
+async def serve_agent_socket(database: Database, websocket: WebSocket) -> None:
+    """
+    Serve one agent connection until it closes. Configured with environment
+    variables.
+        AGENT_SOCKET_HEARTBEAT: seconds between pings, default 15. The agent
+            is disconnected if nothing comes back in two of them.
+    A reconnecting agent replaces its previous connection.
+    """
+    heartbeat = float(os.environ.get("AGENT_SOCKET_HEARTBEAT", "15"))
+
+    await websocket.accept()
+    try:
+        agent_id = await asyncio.wait_for(_register(database, websocket), heartbeat)
+    except (asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+        agent_id = None
+    if agent_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    connection = AgentConnection(agent_id, websocket)
+    previous = _connections.get(agent_id)
+    _connections[agent_id] = connection
+    if previous is not None:
+        try:
+            await previous.websocket.close()
+        except RuntimeError:
+            pass
+    await connection.send({"type": "registered"})
+    await repo.set_agent_healthy(database, agent_id, True)
+    logging.info("agent %s connected", agent_id)
+
+    heartbeat_task = asyncio.create_task(_heartbeat(connection, heartbeat))
+    try:
+        while True:
+            # Any message counts as a sign of life, pongs have nothing else
+            # to do.
+            message = await asyncio.wait_for(websocket.receive_json(), 2 * heartbeat)
+            if message.get("type") != "action":
+                continue
+            request_id = message.get("id")
+            if request_id not in connection.in_flight:
+                continue
+            connection.in_flight.discard(request_id)
+            await repo.notify_agent_socket(
+                database,
+                "agent_socket_responses",
+                json.dumps({"id": request_id, "action": message["action"]}),
+            )
+    except (asyncio.TimeoutError, ValueError, KeyError):
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass
+    except WebSocketDisconnect:
+        pass
+    finally:
+        heartbeat_task.cancel()
+        if _connections.get(agent_id) is connection:
+            del _connections[agent_id]
+        # Fail the requests it won't answer now instead of letting the worker
+        # wait them out.
+        for request_id in connection.in_flight:
+            await repo.notify_agent_socket(
+                database,
+                "agent_socket_responses",
+                json.dumps({"id": request_id, "error": "Agent disconnected."}),
+            )
+        logging.info("agent %s disconnected", agent_id)
@@ -0,0 +1,98 @@
+from collections import defaultdict
+from typing import Literal
+
+from .schemas import AgentCallStats
+
+CallOutcome = Literal["ok", "timeout", "error"]
+
+# Upper bounds of the latency buckets in milliseconds. Slower calls go in an
+# overflow bucket.
+latency_buckets_ms = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+overflow_bucket_ms = 2**31 - 1
+
+
+class AgentCalls:
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = defaultdict(int)
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def merge(self, other: "AgentCalls") -> None:
+        for le_ms, count in other.buckets.items():
+            self.buckets[le_ms] += count
+        self.calls += other.calls
+        self.timeouts += other.timeouts
+        self.errors += other.errors
+        self.total_seconds += other.total_seconds
+
+
+# Calls since the last flush, by agent id.
+_calls: dict[int, AgentCalls] = defaultdict(AgentCalls)
+
+
+def record_agent_call(agent_id: int, seconds: float, outcome: CallOutcome) -> None:
+    calls = _calls[agent_id]
+    ms = seconds * 1000
+    le_ms = next((le for le in latency_buckets_ms if ms <= le), overflow_bucket_ms)
+    calls.buckets[le_ms] += 1
+    calls.calls += 1
+    calls.total_seconds += seconds
+    match outcome:
+        case "timeout":
+            calls.timeouts += 1
+        case "error":
+            calls.errors += 1
+        case "ok":
+            pass
+
+
+def take_agent_calls() -> dict[int, AgentCalls]:
+    """
+    The calls recorded since the last time, to be saved.
+    """
+    global _calls
+    taken, _calls = _calls, defaultdict(AgentCalls)
+    return taken
+
+
+def restore_agent_calls(agent_id: int, calls: AgentCalls) -> None:
+    """
+    Put back calls that couldn't be saved.
+    """
+    _calls[agent_id].merge(calls)
+
+
+def percentile(buckets: dict[int, int], p: float) -> int | None:
+    """
+    The upper bound of the bucket the pth percentile call falls in. None if
+    there are no calls or it's in the overflow bucket.
+    """
+    total = sum(buckets.values())
+    if total == 0:
+        return None
+    seen = 0
+    for le_ms in sorted(buckets):
+        seen += buckets[le_ms]
+        if seen >= p * total:
+            return le_ms if le_ms != overflow_bucket_ms else None
+    return None
+
+
+def agent_call_stats(
+    buckets: dict[int, int],
+    calls: int,
+    timeouts: int,
+    errors: int,
+    total_seconds: float,
+) -> AgentCallStats:
+    return AgentCallStats(
+        calls=calls,
+        timeouts=timeouts,
+        errors=errors,
+        mean_ms=total_seconds * 1000 / calls if calls else None,
+        p50_ms=percentile(buckets, 0.50),
+        p95_ms=percentile(buckets, 0.95),
+        p99_ms=percentile(buckets, 0.99),
+    )
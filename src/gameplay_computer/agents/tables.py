@@ -22,9 +22,32 @@ agent_deployment = sqlalchemy.Table(
         sqlalchemy.ForeignKey("agents.id"),
         primary_key=True,
     ),
-    sqlalchemy.Column("url", sqlalchemy.String, nullable=False),
+    # Only http agents have a url.
+    sqlalchemy.Column("url", sqlalchemy.String),
     sqlalchemy.Column("healthy", sqlalchemy.Boolean, nullable=False),
     sqlalchemy.Column("active", sqlalchemy.Boolean, nullable=False),
+    sqlalchemy.Column(
+        "protocol", sqlalchemy.String, nullable=False, server_default="match"
+    ),
+    # The agent agreed to be asked ahead for its replies to each move the
+    # user could make.
+    sqlalchemy.Column(
+        "speculative", sqlalchemy.Boolean, nullable=False, server_default="false"
+    ),
+    # The agent's action only depends on the position, its responses are
+    # cached by version.
+    sqlalchemy.Column(
+        "deterministic", sqlalchemy.Boolean, nullable=False, server_default="false"
+    ),
+    sqlalchemy.Column("version", sqlalchemy.String, nullable=False, server_default=""),
+    sqlalchemy.Column("batch_url", sqlalchemy.String),
+    sqlalchemy.Column(
+        "transport", sqlalchemy.String, nullable=False, server_default="http"
+    ),
+    # sha256 of the token websocket agents register with.
+    sqlalchemy.Column("token_hash", sqlalchemy.String),
+    # Python source of hosted agents.
+    sqlalchemy.Column("source", sqlalchemy.Text),
 )
 
 agent_history = sqlalchemy.Table(
@@ -41,3 +64,95 @@ agent_history = sqlalchemy.Table(
     sqlalchemy.Column("draws", sqlalchemy.Integer, nullable=False),
     sqlalchemy.Column("errors", sqlalchemy.Integer, nullable=False),
 )
+
+
+# Agent replies fetched ahead of the user's move, keyed by the position hash
+# of the board after each move the user could make.
+agent_speculations = sqlalchemy.Table(
+    "agent_speculations",
+    metadata,
+    sqlalchemy.Column(
+        "match_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("matches.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("position", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column(
+        "agent_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("agents.id"),
+        nullable=False,
+    ),
+    sqlalchemy.Column("action", sqlalchemy.JSON, nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+)
+
+
+# Responses of deterministic agents, see agents.cache.
+agent_responses = sqlalchemy.Table(
+    "agent_responses",
+    metadata,
+    sqlalchemy.Column(
+        "agent_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("agents.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("version", sqlalchemy.String, primary_key=True),
+    # common.position_hash
+    sqlalchemy.Column("position", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("action", sqlalchemy.JSON, nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+)
+
+
+# Agent call totals, added to by agents.stats.flush_agent_stats.
+agent_calls = sqlalchemy.Table(
+    "agent_calls",
+    metadata,
+    sqlalchemy.Column(
+        "agent_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("agents.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("calls", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("timeouts", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("errors", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("total_seconds", sqlalchemy.Float, nullable=False),
+)
+
+# Agent call latency histogram, calls by bucket upper bound.
+agent_latency = sqlalchemy.Table(
+    "agent_latency",
+    metadata,
+    sqlalchemy.Column(
+        "agent_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("agents.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("le_ms", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("count", sqlalchemy.BigInteger, nullable=False),
+)
+
+# Elo ratings, updated as agent vs agent matches finish, see agents.ratings.
+# Leaderboards read this instead of the matches.
+agent_ratings = sqlalchemy.Table(
+    "agent_ratings",
+    metadata,
+    sqlalchemy.Column(
+        "agent_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("agents.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("game", game, nullable=False),
+    sqlalchemy.Column("rating", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("games", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("updated_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+    sqlalchemy.Index(
+        "agent_ratings_leaderboard", "game", sqlalchemy.text("rating desc")
+    ),
+)
@@ -3,7 +3,11 @@ from .schemas import ALogic
 from .service import (
     deserialize_action,
     deserialize_state,
+    hash_position,
+    is_valid_position,
+    position_hash,
     serialize_action,
+    serialize_position,
     serialize_state,
 )
 
@@ -14,4 +18,8 @@ __all__ = [
     "serialize_action",
     "deserialize_state",
     "deserialize_action",
+    "serialize_position",
+    "is_valid_position",
+    "hash_position",
+    "position_hash",
 ]
@@ -1,3 +1,4 @@
+import hashlib
 from typing import Any, assert_never
 
 from pydantic import Json
@@ -54,3 +55,39 @@ def deserialize_state(
             )
         case _game as unreachable:
             assert_never(unreachable)
+
+
+def serialize_position(state: State) -> str:
+    """
+    A compact canonical string for the position on the board.
+    For connect4 that's the 42 spaces column by column, bottom to top, with
+    "." for empty spaces.
+    """
+    match state.game:
+        case "connect4":
+            assert isinstance(state, Connect4State)
+            return "".join(space for col in state.board for space in col).replace(
+                " ", "."
+            )
+        case _game as unreachable:
+            assert_never(unreachable)
+
+
+def is_valid_position(game: Game, position: str) -> bool:
+    match game:
+        case "connect4":
+            return len(position) == 42 and all(space in "BR." for space in position)
+        case _game as unreachable:
+            assert_never(unreachable)
+
+
+def hash_position(game: Game, position: str) -> str:
+    """
+    Hash of a serialized position, this is what gets indexed on match_turns.
+    The backfill migration computes the same thing in sql, keep them in sync.
+    """
+    return hashlib.md5(f"{game}:{position}".encode(), usedforsecurity=False).hexdigest()
+
+
+def position_hash(state: State) -> str:
+    return hash_position(state.game, serialize_position(state))
@@ -63,9 +63,42 @@ class Turn(BaseModel):
     next_player: int | None
 
 
+# agent_error matches are over because an agent kept failing to move.
+MatchStatus = Literal["in_progress", "finished", "agent_error"]
+
+
 class Match(BaseModel):
     id: int
+    status: MatchStatus = "in_progress"
     players: list[Player]
     turns: list[Turn]
     turn: int
     state: State
+
+
+# Agents pick the request format they get at registration.
+# "match" posts the whole Match every turn.
+# "compact/1" posts a CompactMatch.
+AgentProtocol = Literal["match", "compact/1"]
+
+# http: the server posts to the agent's url.
+# websocket: the agent connects to the server at /agents/connect.
+# hosted: python source uploaded with the agent, run by the worker.
+AgentTransport = Literal["http", "websocket", "hosted"]
+
+
+class CompactMatch(BaseModel):
+    """
+    The compact/1 agent request. Stays the same size for every turn.
+    position is the board as a string, for connect4 it's the 42 spaces column
+    by column from the bottom with "." for empty ones.
+    turns only has the turns taken since the agent last moved in this match.
+    """
+
+    protocol: Literal["compact/1"] = "compact/1"
+    id: int
+    game: Game
+    turn: int
+    next_player: int | None
+    position: str
+    turns: list[Turn]
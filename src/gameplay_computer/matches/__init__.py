@@ -1,15 +1,48 @@
-from .schemas import MatchSummary
+from gameplay_computer.gameplay import MatchStatus
+
+from .schemas import (
+    ExportedTurn,
+    MatchSummary,
+    PendingTurn,
+    PositionOccurrence,
+    RatedMatch,
+)
+from .repo import match_channel
 from .service import (
+    apply_action,
     create_match,
+    export_match_turns,
+    get_agent_retry_delay,
     get_match_by_id,
+    iterate_rated_matches,
     list_match_summaries_for_user,
+    list_position_occurrences,
+    record_agent_failure,
+    save_turns,
+    set_agent_error,
+    set_agent_retry_delay,
     take_action,
 )
 
 __all__ = [
+    "ExportedTurn",
+    "MatchStatus",
     "MatchSummary",
+    "PendingTurn",
+    "PositionOccurrence",
+    "RatedMatch",
+    "apply_action",
     "create_match",
+    "export_match_turns",
+    "get_agent_retry_delay",
     "get_match_by_id",
+    "iterate_rated_matches",
     "list_match_summaries_for_user",
+    "list_position_occurrences",
+    "match_channel",
+    "record_agent_failure",
+    "save_turns",
+    "set_agent_error",
+    "set_agent_retry_delay",
     "take_action",
 ]
@@ -1,17 +1,75 @@
 import json
+from datetime import datetime
+from typing import Any, AsyncIterator
 
 import sqlalchemy
 from databases import Database
 
 from gameplay_computer import agents, common, users
-from gameplay_computer.gameplay import Action, Agent, Match, Player, State, Turn, User
+from gameplay_computer.gameplay import (
+    Action,
+    Agent,
+    Game,
+    Match,
+    MatchStatus,
+    Player,
+    State,
+    Turn,
+    User,
+)
 
 from . import tables
-from .schemas import MatchSummary
+from .schemas import (
+    ExportedTurn,
+    MatchSummary,
+    PendingTurn,
+    PositionOccurrence,
+    RatedMatch,
+)
 
 # todo: just all sql, fuck the orm
 
 
+def match_channel(match_id: int) -> str:
+    """
+    Each match notifies its own channel, web processes only listen to the
+    ones their users are watching.
+    """
+    return f"match_{match_id}"
+
+
+async def _notify_match(
+    database: Database,
+    match_id: int,
+    status: MatchStatus,
+    turns: list[PendingTurn],
+    winner: int | None = None,
+    next_player: int | None = None,
+) -> None:
+    """
+    The payload carries the new turns so the page can add them to its board
+    without reading the match again.
+    """
+    payload = {
+        "match_id": match_id,
+        "status": status,
+        "winner": winner,
+        "next_player": next_player,
+        "turns": [
+            {
+                "number": turn.number,
+                "player": turn.player,
+                "action": common.serialize_action(turn.action),
+            }
+            for turn in turns
+        ],
+    }
+    await database.execute(
+        query="select pg_notify(:channel, :payload)",
+        values={"channel": match_channel(match_id), "payload": json.dumps(payload)},
+    )
+
+
 async def create_match(
     database: Database, created_by_user_id: str, players: list[Player], state: State
 ) -> int:
@@ -65,7 +123,8 @@ async def create_match(
                 action,
                 state,
                 next_player,
-                created_at
+                created_at,
+                position
             ) values (
                 :match_id,
                 0,
@@ -73,13 +132,15 @@ async def create_match(
                 null,
                 :state,
                 :next_player,
-                now()
+                now(),
+                :position
             )
             """,
             values={
                 "match_id": match_id,
                 "state": json.dumps(common.serialize_state(state)),
                 "next_player": state.next_player,
+                "position": common.position_hash(state),
             },
         )
 
@@ -102,16 +163,66 @@ async def create_match_turn(
     This keeps us from creating double turns without making us hold a
     transaction through all the game logic.
     """
+    return await create_match_turns(
+        database,
+        match_id,
+        [PendingTurn(number=turn_number, player=player, action=action, state=state)],
+    )
+
+
+async def create_match_turns(
+    database: Database, match_id: int, turns: list[PendingTurn]
+) -> bool:
+    """
+    Adds a batch of consecutive turns to a match in one insert, with one
+    notify for the whole batch. Same rules as create_match_turn, the first
+    turn has to be the next one and the last turn can finish the match.
+    Returns False for matches that aren't in progress, a job that was queued
+    before an agent error ended the match can't play on.
+    """
+    assert len(turns) > 0
     async with database.transaction():
+        # Locked so it can't end with an agent error in between.
+        match_status = await database.fetch_val(
+            query="select status from matches where id = :match_id for update",
+            values={"match_id": match_id},
+        )
+        if match_status != "in_progress":
+            return False
+
         latest_turn = await database.fetch_val(
             query="select max(number) from match_turns where match_id = :match_id",
             values={"match_id": match_id},
         )
-        if latest_turn is not None and latest_turn + 1 != turn_number:
+        if latest_turn is not None and latest_turn + 1 != turns[0].number:
             return False
 
+        rows = []
+        values: dict[str, Any] = {"match_id": match_id}
+        for i, turn in enumerate(turns):
+            rows.append(
+                f"""(
+                    :match_id,
+                    :turn_{i},
+                    :player_{i},
+                    :action_{i},
+                    :state_{i},
+                    :next_player_{i},
+                    now(),
+                    :position_{i}
+                )"""
+            )
+            values[f"turn_{i}"] = turn.number
+            values[f"player_{i}"] = turn.player
+            values[f"action_{i}"] = json.dumps(common.serialize_action(turn.action))
+            values[f"state_{i}"] = json.dumps(common.serialize_state(turn.state))
+            values[f"next_player_{i}"] = (
+                turn.state.next_player if not turn.state.over else None
+            )
+            values[f"position_{i}"] = common.position_hash(turn.state)
+
         await database.execute(
-            query="""
+            query=f"""
             insert into match_turns (
                 match_id,
                 number,
@@ -119,27 +230,14 @@ async def create_match_turn(
                 action,
                 state,
                 next_player,
-                created_at
-            ) values (
-                :match_id,
-                :turn,
-                :player,
-                :action,
-                :state,
-                :next_player,
-                now()
-            )            
+                created_at,
+                position
+            ) values {", ".join(rows)}
             """,
-            values={
-                "match_id": match_id,
-                "turn": turn_number,
-                "player": player,
-                "action": json.dumps(common.serialize_action(action)),
-                "state": json.dumps(common.serialize_state(state)),
-                "next_player": state.next_player if not state.over else None,
-            },
+            values=values,
         )
 
+        state = turns[-1].state
         if state.over:
             await database.execute(
                 query="""
@@ -147,20 +245,169 @@ async def create_match_turn(
                     status = 'finished',
                     winner = :winner,
                     finished_at = now()
-                where id = :match_id
+                where id = :match_id and status = 'in_progress'
                 """,
                 values={"match_id": match_id, "winner": state.winner},
             )
+            await _record_agent_outcomes(database, match_id, state.winner)
+            await _record_agent_ratings(database, match_id, state.game, state.winner)
+
+        await _notify_match(
+            database,
+            match_id,
+            "finished" if state.over else "in_progress",
+            turns,
+            winner=state.winner,
+            next_player=state.next_player if not state.over else None,
+        )
 
-        # notify
+        return True
+
+
+async def _record_agent_outcomes(
+    database: Database, match_id: int, winner: int | None
+) -> None:
+    """
+    Add a finished match to its agents' wins, losses and draws. Grouped by
+    agent so an agent playing itself gets both its win and its loss.
+    """
+    await database.execute(
+        query="""
+        update agent_history ah set
+            wins = ah.wins + o.wins,
+            losses = ah.losses + o.losses,
+            draws = ah.draws + o.draws
+        from (
+            select
+                agent_id,
+                count(*) filter (where number = cast(:winner as integer)) as wins,
+                count(*) filter (
+                    where cast(:winner as integer) is not null
+                        and number != cast(:winner as integer)
+                ) as losses,
+                count(*) filter (where cast(:winner as integer) is null) as draws
+            from match_players
+            where match_id = :match_id and agent_id is not null
+            group by agent_id
+        ) o
+        where o.agent_id = ah.agent_id
+        """,
+        values={"match_id": match_id, "winner": winner},
+    )
+
+
+async def _record_agent_ratings(
+    database: Database, match_id: int, game: Game, winner: int | None
+) -> None:
+    """
+    Only agent vs agent matches are rated, not agents playing themselves.
+    """
+    players = await database.fetch_all(
+        query="""
+        select agent_id from match_players
+        where match_id = :match_id
+        order by number
+        """,
+        values={"match_id": match_id},
+    )
+    agent_ids = [player["agent_id"] for player in players]
+    if len(agent_ids) != 2 or None in agent_ids or agent_ids[0] == agent_ids[1]:
+        return
+    await agents.update_agent_ratings(
+        database, game, agent_ids[0], agent_ids[1], winner
+    )
+
+
+async def set_match_agent_error(database: Database, match_id: int) -> bool:
+    """
+    End an in progress match because an agent couldn't move.
+    Returns False if the match wasn't in progress.
+    """
+    async with database.transaction():
+        updated = await database.fetch_val(
+            query="""
+            update matches set
+                status = 'agent_error',
+                finished_at = now()
+            where id = :match_id and status = 'in_progress'
+            returning id
+            """,
+            values={"match_id": match_id},
+        )
+        if updated is None:
+            return False
+
+        # Count it against the agent whose turn it was.
         await database.execute(
-            query="select pg_notify('test', :match_id)",
-            values={"match_id": str(match_id)},
+            query="""
+            update agent_history ah set errors = ah.errors + 1
+            from match_turns mt
+            join match_players mp
+                on mp.match_id = mt.match_id and mp.number = mt.next_player
+            where mt.match_id = :match_id
+                and mt.number = (
+                    select max(number) from match_turns where match_id = :match_id
+                )
+                and mp.agent_id = ah.agent_id
+            """,
+            values={"match_id": match_id},
         )
 
+        await _notify_match(database, match_id, "agent_error", [])
         return True
 
 
+async def record_match_agent_failure(
+    database: Database, match_id: int, turn: int
+) -> int:
+    """
+    Count an agent failing to play turn, starting over if it failed on another
+    turn before. Returns how many times in a row it has failed on turn.
+    """
+    attempts = await database.fetch_val(
+        query="""
+        update matches set
+            agent_attempts = case
+                when agent_attempt_turn = :turn then agent_attempts + 1
+                else 1
+            end,
+            agent_attempt_turn = :turn
+        where id = :match_id
+        returning agent_attempts
+        """,
+        values={"match_id": match_id, "turn": turn},
+    )
+    return int(attempts or 0)
+
+
+async def set_match_agent_retry_delay(
+    database: Database, match_id: int, delay: float
+) -> None:
+    await database.execute(
+        query="""
+        update matches set
+            agent_retry_at = now() + make_interval(secs => :delay)
+        where id = :match_id
+        """,
+        values={"match_id": match_id, "delay": delay},
+    )
+
+
+async def get_match_agent_retry_delay(database: Database, match_id: int) -> float:
+    """
+    Seconds until the agents of a match should be tried again, 0 if now.
+    """
+    delay = await database.fetch_val(
+        query="""
+        select greatest(0, extract(epoch from agent_retry_at - now()))
+        from matches
+        where id = :match_id
+        """,
+        values={"match_id": match_id},
+    )
+    return float(delay or 0)
+
+
 async def list_match_summaries_for_user(
     database: Database, user_id: str
 ) -> list[MatchSummary]:
@@ -257,6 +504,198 @@ async def list_match_summaries_for_user(
     return match_summaries
 
 
+async def list_position_occurrences(
+    database: Database, position: str, limit: int
+) -> list[PositionOccurrence]:
+    """
+    Every turn, in any match, whose state has the given position hash.
+    Newest first.
+    """
+    occurrences_r = await database.fetch_all(
+        query="""
+        select
+            mt.match_id,
+            mt.number as turn,
+            m.status,
+            m.winner,
+            mt.created_at
+        from match_turns mt
+        join matches m on mt.match_id = m.id
+        where mt.position = :position
+        order by mt.created_at desc
+        limit :limit
+        """,
+        values={"position": position, "limit": limit},
+    )
+    return [
+        PositionOccurrence(
+            match_id=occurrence_r["match_id"],
+            turn=occurrence_r["turn"],
+            status=occurrence_r["status"],
+            winner=occurrence_r["winner"],
+            created_at=occurrence_r["created_at"],
+        )
+        for occurrence_r in occurrences_r
+    ]
+
+
+async def _player_name(player: dict[str, Any]) -> str:
+    if player["user_id"] is not None:
+        user = await users.get_user_by_id(player["user_id"])
+        assert user is not None
+        return user.username
+    agent_user = await users.get_user_by_id(player["agent_user_id"])
+    assert agent_user is not None
+    return f"{agent_user.username}/{player['agentname']}"
+
+
+async def iterate_match_turns(
+    database: Database,
+    game: Game | None = None,
+    agent_id: int | None = None,
+    match_status: MatchStatus | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+) -> AsyncIterator[ExportedTurn]:
+    """
+    Stream every turn of every match that passes the filters, ordered by match
+    and turn number.
+    Uses a server side cursor so memory stays constant no matter how many
+    turns there are. The players are only looked up on the first turn of each
+    match and carried forward.
+    """
+    conditions = []
+    values: dict[str, Any] = {}
+    if game is not None:
+        conditions.append("m.game = :game")
+        values["game"] = game
+    if agent_id is not None:
+        conditions.append(
+            """exists (
+                select 1 from match_players
+                where match_id = m.id and agent_id = :agent_id
+            )"""
+        )
+        values["agent_id"] = agent_id
+    if match_status is not None:
+        conditions.append("m.status = :status")
+        values["status"] = match_status
+    if created_after is not None:
+        conditions.append("m.created_at >= :created_after")
+        values["created_after"] = created_after
+    if created_before is not None:
+        conditions.append("m.created_at < :created_before")
+        values["created_before"] = created_before
+    where = " and ".join(conditions) if conditions else "true"
+
+    blue = red = ""
+    async for turn_r in database.iterate(
+        query=f"""
+        select
+            m.id as match_id,
+            m.game,
+            m.status,
+            m.winner,
+            m.created_at as match_created_at,
+            m.finished_at as match_finished_at,
+            mt.number,
+            mt.player,
+            mt.action,
+            mt.next_player,
+            mt.state,
+            mt.created_at,
+            case when mt.number = 0 then (
+                select json_agg(
+                    json_build_object(
+                        'user_id', mp.user_id,
+                        'agent_user_id', a.user_id,
+                        'agentname', a.agentname
+                    )
+                    order by mp.number
+                )
+                from match_players mp
+                left join agents a on mp.agent_id = a.id
+                where mp.match_id = m.id
+            ) end as players
+        from matches m
+        join match_turns mt on m.id = mt.match_id
+        where {where}
+        order by m.id, mt.number
+        """,
+        values=values,
+    ):
+        if turn_r["players"] is not None:
+            blue_r, red_r = json.loads(turn_r["players"])
+            blue = await _player_name(blue_r)
+            red = await _player_name(red_r)
+
+        yield ExportedTurn(
+            match_id=turn_r["match_id"],
+            game=turn_r["game"],
+            status=turn_r["status"],
+            winner=turn_r["winner"],
+            blue=blue,
+            red=red,
+            match_created_at=turn_r["match_created_at"],
+            match_finished_at=turn_r["match_finished_at"],
+            number=turn_r["number"],
+            player=turn_r["player"],
+            action=json.loads(turn_r["action"])
+            if turn_r["action"] is not None
+            else None,
+            next_player=turn_r["next_player"],
+            state=json.loads(turn_r["state"]),
+            created_at=turn_r["created_at"],
+        )
+
+
+async def iterate_rated_matches(
+    database: Database, after: tuple[datetime, int] | None = None
+) -> AsyncIterator[RatedMatch]:
+    """
+    Finished agent vs agent matches in the order they finished, after the
+    (finished_at, id) of an earlier one. Uses a server side cursor.
+    """
+    async for match_r in database.iterate(
+        query="""
+        select
+            m.id,
+            m.game,
+            m.winner,
+            m.finished_at,
+            p0.agent_id as agent_id_0,
+            p1.agent_id as agent_id_1
+        from matches m
+        join match_players p0 on p0.match_id = m.id and p0.number = 0
+        join match_players p1 on p1.match_id = m.id and p1.number = 1
+        where m.status = 'finished'
+            and p0.agent_id is not null
+            and p1.agent_id is not null
+            and p0.agent_id != p1.agent_id
+            and (
+                cast(:after_id as bigint) is null
+                or (m.finished_at, m.id) > (
+                    cast(:after_finished_at as timestamptz),
+                    cast(:after_id as bigint)
+                )
+            )
+        order by m.finished_at, m.id
+        """,
+        values={
+            "after_finished_at": after[0] if after is not None else None,
+            "after_id": after[1] if after is not None else None,
+        },
+    ):
+        yield RatedMatch(
+            id=match_r["id"],
+            game=match_r["game"],
+            winner=match_r["winner"],
+            finished_at=match_r["finished_at"],
+            agent_id_0=match_r["agent_id_0"],
+            agent_id_1=match_r["agent_id_1"],
+        )
+
+
 # Match with players, turns and state?
 
 
@@ -1,9 +1,9 @@
 from datetime import datetime
-from typing import Literal
+from typing import Any
 
 from pydantic import BaseModel
 
-from gameplay_computer.gameplay import Game
+from gameplay_computer.gameplay import Action, Game, MatchStatus, State
 
 
 class MatchSummary(BaseModel):
@@ -11,8 +11,62 @@ class MatchSummary(BaseModel):
     game_name: Game
     blue: str
     red: str
-    status: Literal["in_progress", "finished"]
+    status: MatchStatus
     winner: int | None
     last_turn_at: datetime
     next_player: int | None
     is_next_player: bool
+
+
+class PendingTurn(BaseModel):
+    """
+    A turn that's been played in memory but not saved yet.
+    state is the state after the turn.
+    """
+
+    number: int
+    player: int
+    action: Action
+    state: State
+
+
+class RatedMatch(BaseModel):
+    """
+    A finished agent vs agent match, for recomputing ratings.
+    """
+
+    id: int
+    game: Game
+    winner: int | None
+    finished_at: datetime
+    agent_id_0: int
+    agent_id_1: int
+
+
+class PositionOccurrence(BaseModel):
+    match_id: int
+    turn: int
+    status: MatchStatus
+    winner: int | None
+    created_at: datetime
+
+
+class ExportedTurn(BaseModel):
+    """
+    One turn of a match, flattened with its match for bulk export.
+    """
+
+    match_id: int
+    game: Game
+    status: MatchStatus
+    winner: int | None
+    blue: str
+    red: str
+    match_created_at: datetime
+    match_finished_at: datetime | None
+    number: int
+    player: int | None
+    action: Any
+    next_player: int | None
+    state: Any
+    created_at: datetime
@@ -1,14 +1,30 @@
-from typing import assert_never
+from datetime import datetime
+from typing import AsyncIterator, assert_never
 
 from databases import Database
 from fastapi import HTTPException, status
 
-from gameplay_computer import users
-from gameplay_computer.gameplay import Action, Agent, Game, Match, Player, User
+from gameplay_computer import common, users
+from gameplay_computer.gameplay import (
+    Action,
+    Agent,
+    Game,
+    Match,
+    MatchStatus,
+    Player,
+    Turn,
+    User,
+)
 from gameplay_computer.games.connect4 import Connect4Logic
 
 from . import repo
-from .schemas import MatchSummary
+from .schemas import (
+    ExportedTurn,
+    MatchSummary,
+    PendingTurn,
+    PositionOccurrence,
+    RatedMatch,
+)
 
 
 async def create_match(
@@ -58,9 +74,24 @@ async def create_match(
 
 
 async def get_match_by_id(
-    database: Database, match_id: int, turn: int | None = None
+    database: Database,
+    match_id: int,
+    turn: int | None = None,
+    primary: Database | None = None,
+    min_turn: int | None = None,
 ) -> Match:
+    """
+    Fetch a match by id.
+    If database is a read replica, pass the primary too. The match is re-read
+    from the primary if the replica hasn't caught up yet, either because it
+    doesn't have the match or because it doesn't have turn min_turn.
+    """
     match = await repo.get_match_by_id(database, match_id, turn)
+    if primary is not None and primary is not database:
+        if match is None or (
+            min_turn is not None and match.turns[-1].number < min_turn
+        ):
+            match = await repo.get_match_by_id(primary, match_id, turn)
     if match is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -75,13 +106,82 @@ async def list_match_summaries_for_user(
     return await repo.list_match_summaries_for_user(database, user_id)
 
 
-async def take_action(
+async def list_position_occurrences(
+    database: Database, game: Game, position: str, limit: int = 100
+) -> list[PositionOccurrence]:
+    if not common.is_valid_position(game, position):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid position.",
+        )
+    return await repo.list_position_occurrences(
+        database, common.hash_position(game, position), limit
+    )
+
+
+def export_match_turns(
     database: Database,
+    game: Game | None = None,
+    agent_id: int | None = None,
+    match_status: MatchStatus | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+) -> AsyncIterator[ExportedTurn]:
+    if (
+        created_after is not None
+        and created_before is not None
+        and created_after >= created_before
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="created_after must be before created_before.",
+        )
+    return repo.iterate_match_turns(
+        database,
+        game=game,
+        agent_id=agent_id,
+        match_status=match_status,
+        created_after=created_after,
+        created_before=created_before,
+    )
+
+
+def iterate_rated_matches(
+    database: Database, after: tuple[datetime, int] | None = None
+) -> AsyncIterator[RatedMatch]:
+    return repo.iterate_rated_matches(database, after=after)
+
+
+async def set_agent_error(database: Database, match_id: int) -> None:
+    await repo.set_match_agent_error(database, match_id)
+
+
+async def record_agent_failure(database: Database, match_id: int, turn: int) -> int:
+    return await repo.record_match_agent_failure(database, match_id, turn)
+
+
+async def set_agent_retry_delay(
+    database: Database, match_id: int, delay: float
+) -> None:
+    await repo.set_match_agent_retry_delay(database, match_id, delay)
+
+
+async def get_agent_retry_delay(database: Database, match_id: int) -> float:
+    return await repo.get_match_agent_retry_delay(database, match_id)
+
+
+def _check_action(
     match: Match,
     player: int,
     action: Action,
     actor: User | Agent,
-) -> Match:
+) -> None:
+    if match.status != "in_progress":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The match is over.",
+        )
+
     if match.state.next_player != player:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -141,7 +241,21 @@ async def take_action(
             detail="Invalid action for this game.",
         )
 
-    assert action in Connect4Logic.actions(match.state)
+    if action not in Connect4Logic.actions(match.state):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid action.",
+        )
+
+
+async def take_action(
+    database: Database,
+    match: Match,
+    player: int,
+    action: Action,
+    actor: User | Agent,
+) -> Match:
+    _check_action(match, player, action, actor)
     Connect4Logic.turn(match.state, player, action)
 
     added = await repo.create_match_turn(
@@ -155,8 +269,50 @@ async def take_action(
     if not added:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
-            detail=f"Turn {len(match.turns)} already exists.",
+            detail=f"Turn {len(match.turns)} already exists or the match is over.",
         )
 
     match = await get_match_by_id(database, match.id)
     return match
+
+
+def apply_action(
+    match: Match,
+    player: int,
+    action: Action,
+    actor: User | Agent,
+) -> PendingTurn:
+    """
+    Take a turn in memory only. The match is updated in place and the
+    returned turn has to be saved with save_turns later.
+    """
+    _check_action(match, player, action, actor)
+    Connect4Logic.turn(match.state, player, action)
+
+    number = len(match.turns)
+    match.turns.append(
+        Turn(
+            number=number,
+            player=player,
+            action=action,
+            next_player=match.state.next_player,
+        )
+    )
+    match.turn = number
+    return PendingTurn(
+        number=number,
+        player=player,
+        action=action,
+        state=match.state.copy(deep=True),
+    )
+
+
+async def save_turns(
+    database: Database, match_id: int, turns: list[PendingTurn]
+) -> None:
+    added = await repo.create_match_turns(database, match_id, turns)
+    if not added:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Turn {turns[0].number} already exists or the match is over.",
+        )
@@ -9,7 +9,7 @@ matches = sqlalchemy.Table(
     sqlalchemy.Column("game", game, nullable=False),
     sqlalchemy.Column(
         "status",
-        sqlalchemy.Enum("in_progress", "finished", name="match_status"),
+        sqlalchemy.Enum("in_progress", "finished", "agent_error", name="match_status"),
     ),
     sqlalchemy.Column(
         "winner",
@@ -22,6 +22,16 @@ matches = sqlalchemy.Table(
     ),
     sqlalchemy.Column("created_at", sqlalchemy.DateTime(timezone=True), nullable=False),
     sqlalchemy.Column("finished_at", sqlalchemy.DateTime(timezone=True)),
+    # How many times in a row an agent failed to play agent_attempt_turn and
+    # when to try it again, kept here so every job for the match sees them.
+    sqlalchemy.Column(
+        "agent_attempts", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column("agent_attempt_turn", sqlalchemy.Integer),
+    sqlalchemy.Column("agent_retry_at", sqlalchemy.DateTime(timezone=True)),
+    # For replaying matches in the order they finished, see
+    # repo.iterate_rated_matches.
+    sqlalchemy.Index("matches_finished_at", "finished_at", "id"),
 )
 
 match_players = sqlalchemy.Table(
@@ -77,4 +87,6 @@ match_turns = sqlalchemy.Table(
         sqlalchemy.Integer,
     ),
     sqlalchemy.Column("created_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+    # common.position_hash of the state
+    sqlalchemy.Column("position", sqlalchemy.String, nullable=False, index=True),
 )
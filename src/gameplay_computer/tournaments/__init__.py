@@ -0,0 +1,33 @@
+from .schemas import (
+    ScheduledMatch,
+    Standing,
+    Tournament,
+    TournamentFormat,
+    TournamentStatus,
+)
+from .service import (
+    create_tournament,
+    get_tournament,
+    list_running_matches,
+    list_running_tournaments,
+    record_match_result,
+    record_missed_results,
+    schedule_tournament,
+    shards,
+)
+
+__all__ = [
+    "ScheduledMatch",
+    "Standing",
+    "Tournament",
+    "TournamentFormat",
+    "TournamentStatus",
+    "create_tournament",
+    "get_tournament",
+    "list_running_matches",
+    "list_running_tournaments",
+    "record_match_result",
+    "record_missed_results",
+    "schedule_tournament",
+    "shards",
+]
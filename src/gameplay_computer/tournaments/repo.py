@@ -0,0 +1,451 @@
+from typing import Any
+
+import sqlalchemy
+from databases import Database
+
+from gameplay_computer import agents
+from gameplay_computer.gameplay import Game
+
+from . import tables
+from .schemas import ScheduledMatch, Standing, Tournament, TournamentFormat
+
+# Rows per insert, to stay under postgres' limit on query parameters.
+_insert_batch_size = 1000
+
+
+async def create_tournament(
+    database: Database,
+    created_by_user_id: str,
+    game: Game,
+    format: TournamentFormat,
+    agent_ids: list[int],
+    champion_agent_id: int | None,
+    rounds: int,
+    games_per_pairing: int,
+    max_matches_per_agent: int,
+) -> int:
+    async with database.transaction():
+        tournament_id: int = await database.execute(
+            query=tables.tournaments.insert().values(
+                game=game,
+                format=format,
+                status="running",
+                rounds=rounds,
+                round=1,
+                games_per_pairing=games_per_pairing,
+                max_matches_per_agent=max_matches_per_agent,
+                champion_agent_id=champion_agent_id,
+                created_by=created_by_user_id,
+                created_at=sqlalchemy.func.now(),
+                finished_at=None,
+            )
+        )
+        await database.execute_many(
+            query=tables.tournament_agents.insert(),
+            values=[
+                {"tournament_id": tournament_id, "agent_id": agent_id}
+                for agent_id in agent_ids
+            ],
+        )
+        return tournament_id
+
+
+async def add_tournament_matches(
+    database: Database,
+    tournament_id: int,
+    round: int,
+    pairings: list[tuple[int, int, int | None]],
+) -> None:
+    """
+    pairings are (agent_id_0, agent_id_1, shard), agent_id_0 goes first.
+    They're scheduled in this order.
+    """
+    for start in range(0, len(pairings), _insert_batch_size):
+        rows = []
+        values: dict[str, Any] = {"tournament_id": tournament_id, "round": round}
+        for i, (agent_id_0, agent_id_1, shard) in enumerate(
+            pairings[start : start + _insert_batch_size]
+        ):
+            rows.append(
+                f"""(
+                    :tournament_id,
+                    :round,
+                    :agent_id_0_{i},
+                    :agent_id_1_{i},
+                    'pending',
+                    cast(:shard_{i} as integer)
+                )"""
+            )
+            values[f"agent_id_0_{i}"] = agent_id_0
+            values[f"agent_id_1_{i}"] = agent_id_1
+            values[f"shard_{i}"] = shard
+        await database.execute(
+            query=f"""
+            insert into tournament_matches (
+                tournament_id,
+                round,
+                agent_id_0,
+                agent_id_1,
+                status,
+                shard
+            ) values {", ".join(rows)}
+            """,
+            values=values,
+        )
+
+
+async def lock_tournament(database: Database, tournament_id: int) -> Any:
+    """
+    Only call in a transaction. Schedulers for the same tournament wait on
+    each other here.
+    """
+    return await database.fetch_one(
+        query="select * from tournaments where id = :tournament_id for update",
+        values={"tournament_id": tournament_id},
+    )
+
+
+async def get_running_counts(database: Database, tournament_id: int) -> dict[int, int]:
+    """
+    How many of the tournament's matches each agent is in right now.
+    """
+    rows = await database.fetch_all(
+        query="""
+        select agent_id, count(*) as running
+        from (
+            select agent_id_0 as agent_id from tournament_matches
+            where tournament_id = :tournament_id and status = 'running'
+            union all
+            select agent_id_1 from tournament_matches
+            where tournament_id = :tournament_id and status = 'running'
+        ) r
+        group by agent_id
+        """,
+        values={"tournament_id": tournament_id},
+    )
+    return {row["agent_id"]: row["running"] for row in rows}
+
+
+async def list_pending_matches(
+    database: Database,
+    tournament_id: int,
+    round: int,
+    max_matches_per_agent: int,
+    limit: int,
+) -> list[Any]:
+    """
+    The round's next pending matches whose agents aren't at their cap yet.
+    """
+    return await database.fetch_all(
+        query="""
+        with busy as (
+            select agent_id, count(*) as running
+            from (
+                select agent_id_0 as agent_id from tournament_matches
+                where tournament_id = :tournament_id and status = 'running'
+                union all
+                select agent_id_1 from tournament_matches
+                where tournament_id = :tournament_id and status = 'running'
+            ) r
+            group by agent_id
+        )
+        select tm.id, tm.agent_id_0, tm.agent_id_1, tm.shard
+        from tournament_matches tm
+        left join busy b0 on b0.agent_id = tm.agent_id_0
+        left join busy b1 on b1.agent_id = tm.agent_id_1
+        where tm.tournament_id = :tournament_id
+            and tm.round = :round
+            and tm.status = 'pending'
+            and coalesce(b0.running, 0) < :max_matches_per_agent
+            and coalesce(b1.running, 0) < :max_matches_per_agent
+        order by tm.id
+        limit :limit
+        """,
+        values={
+            "tournament_id": tournament_id,
+            "round": round,
+            "max_matches_per_agent": max_matches_per_agent,
+            "limit": limit,
+        },
+    )
+
+
+async def drop_deleted_agent_matches(database: Database, tournament_id: int) -> None:
+    """
+    Matches that haven't started can't be played by agents that were deleted
+    since the tournament was created.
+    """
+    await database.execute(
+        query="""
+        delete from tournament_matches tm
+        where tm.tournament_id = :tournament_id
+            and tm.status = 'pending'
+            and (
+                not exists (select 1 from agents a where a.id = tm.agent_id_0)
+                or not exists (select 1 from agents a where a.id = tm.agent_id_1)
+            )
+        """,
+        values={"tournament_id": tournament_id},
+    )
+
+
+async def set_tournament_match_started(
+    database: Database, tournament_match_id: int, match_id: int
+) -> None:
+    await database.execute(
+        query="""
+        update tournament_matches set status = 'running', match_id = :match_id
+        where id = :id
+        """,
+        values={"id": tournament_match_id, "match_id": match_id},
+    )
+
+
+async def count_round_matches(
+    database: Database, tournament_id: int, round: int
+) -> dict[str, int]:
+    rows = await database.fetch_all(
+        query="""
+        select status, count(*) as n from tournament_matches
+        where tournament_id = :tournament_id and round = :round
+        group by status
+        """,
+        values={"tournament_id": tournament_id, "round": round},
+    )
+    return {row["status"]: row["n"] for row in rows}
+
+
+async def finish_tournament_match(database: Database, match_id: int) -> int | None:
+    """
+    Add a finished tournament match to the standings, once. Returns the
+    tournament id, None if the match isn't a tournament's, isn't over or was
+    already counted.
+    """
+    async with database.transaction():
+        row = await database.fetch_one(
+            query="""
+            update tournament_matches tm set status = 'finished'
+            from matches m
+            where tm.match_id = :match_id
+                and tm.status = 'running'
+                and m.id = tm.match_id
+                and m.status != 'in_progress'
+            returning
+                tm.tournament_id,
+                tm.agent_id_0,
+                tm.agent_id_1,
+                m.status as match_status,
+                m.winner
+            """,
+            values={"match_id": match_id},
+        )
+        if row is None:
+            return None
+
+        # outcomes[player] is (wins, losses, draws, errors)
+        outcomes: list[tuple[int, int, int, int]]
+        match row["match_status"]:
+            case "finished" if row["winner"] is None:
+                outcomes = [(0, 0, 1, 0), (0, 0, 1, 0)]
+            case "finished":
+                outcomes = [(1, 0, 0, 0), (0, 1, 0, 0)]
+                if row["winner"] == 1:
+                    outcomes.reverse()
+            case "agent_error":
+                # The agent that couldn't move loses.
+                failed_player = await database.fetch_val(
+                    query="""
+                    select next_player from match_turns
+                    where match_id = :match_id
+                    order by number desc
+                    limit 1
+                    """,
+                    values={"match_id": match_id},
+                )
+                outcomes = [(1, 0, 0, 0), (0, 1, 0, 1)]
+                if failed_player == 0:
+                    outcomes.reverse()
+            case unknown:
+                raise ValueError(f"Unexpected match status {unknown}.")
+
+        for agent_id, (wins, losses, draws, errors) in zip(
+            [row["agent_id_0"], row["agent_id_1"]], outcomes
+        ):
+            await database.execute(
+                query="""
+                update tournament_agents set
+                    wins = wins + :wins,
+                    losses = losses + :losses,
+                    draws = draws + :draws,
+                    errors = errors + :errors
+                where tournament_id = :tournament_id and agent_id = :agent_id
+                """,
+                values={
+                    "tournament_id": row["tournament_id"],
+                    "agent_id": agent_id,
+                    "wins": wins,
+                    "losses": losses,
+                    "draws": draws,
+                    "errors": errors,
+                },
+            )
+        tournament_id: int = row["tournament_id"]
+        return tournament_id
+
+
+async def list_unrecorded_match_ids(database: Database) -> list[int]:
+    """
+    Tournament matches that are over but not in the standings yet, because
+    the worker went away before it got to them.
+    """
+    rows = await database.fetch_all(
+        query="""
+        select tm.match_id
+        from tournament_matches tm
+        join matches m on m.id = tm.match_id
+        where tm.status = 'running' and m.status != 'in_progress'
+        """
+    )
+    return [row["match_id"] for row in rows]
+
+
+async def list_running_tournament_ids(database: Database) -> list[int]:
+    rows = await database.fetch_all(
+        query="select id from tournaments where status = 'running' order by id"
+    )
+    return [row["id"] for row in rows]
+
+
+async def list_running_matches(
+    database: Database, tournament_id: int
+) -> list[ScheduledMatch]:
+    rows = await database.fetch_all(
+        query="""
+        select match_id, shard from tournament_matches
+        where tournament_id = :tournament_id and status = 'running'
+        order by id
+        """,
+        values={"tournament_id": tournament_id},
+    )
+    return [
+        ScheduledMatch(match_id=row["match_id"], shard=row["shard"]) for row in rows
+    ]
+
+
+async def list_standing_rows(database: Database, tournament_id: int) -> list[Any]:
+    """
+    Best first. Agents that were deleted are left out.
+    """
+    return await database.fetch_all(
+        query="""
+        select ta.*
+        from tournament_agents ta
+        join agents a on a.id = ta.agent_id
+        where ta.tournament_id = :tournament_id
+        order by
+            ta.wins + ta.byes + ta.draws * 0.5 desc,
+            ta.errors,
+            ta.agent_id
+        """,
+        values={"tournament_id": tournament_id},
+    )
+
+
+async def list_played_pairs(
+    database: Database, tournament_id: int
+) -> set[frozenset[int]]:
+    rows = await database.fetch_all(
+        query="""
+        select distinct agent_id_0, agent_id_1 from tournament_matches
+        where tournament_id = :tournament_id
+        """,
+        values={"tournament_id": tournament_id},
+    )
+    return {frozenset([row["agent_id_0"], row["agent_id_1"]]) for row in rows}
+
+
+async def add_bye(database: Database, tournament_id: int, agent_id: int) -> None:
+    await database.execute(
+        query="""
+        update tournament_agents set byes = byes + 1
+        where tournament_id = :tournament_id and agent_id = :agent_id
+        """,
+        values={"tournament_id": tournament_id, "agent_id": agent_id},
+    )
+
+
+async def set_tournament_round(
+    database: Database, tournament_id: int, round: int
+) -> None:
+    await database.execute(
+        query="update tournaments set round = :round where id = :tournament_id",
+        values={"tournament_id": tournament_id, "round": round},
+    )
+
+
+async def finish_tournament(database: Database, tournament_id: int) -> None:
+    await database.execute(
+        query="""
+        update tournaments set status = 'finished', finished_at = now()
+        where id = :tournament_id
+        """,
+        values={"tournament_id": tournament_id},
+    )
+
+
+async def get_tournament(database: Database, tournament_id: int) -> Tournament | None:
+    tournament = await database.fetch_one(
+        query=tables.tournaments.select().where(
+            tables.tournaments.c.id == tournament_id
+        )
+    )
+    if tournament is None:
+        return None
+    counts = await database.fetch_all(
+        query="""
+        select status, count(*) as n from tournament_matches
+        where tournament_id = :tournament_id
+        group by status
+        """,
+        values={"tournament_id": tournament_id},
+    )
+    by_status = {row["status"]: row["n"] for row in counts}
+
+    standings = []
+    for row in await list_standing_rows(database, tournament_id):
+        agent = await agents.get_agent_by_id(database, row["agent_id"])
+        standings.append(
+            Standing(
+                agent=agent,
+                wins=row["wins"],
+                losses=row["losses"],
+                draws=row["draws"],
+                errors=row["errors"],
+                byes=row["byes"],
+                points=row["wins"] + row["byes"] + row["draws"] / 2,
+            )
+        )
+
+    champion = None
+    if tournament["champion_agent_id"] is not None:
+        champion = await agents.get_agent_by_id(
+            database, tournament["champion_agent_id"]
+        )
+
+    return Tournament(
+        id=tournament["id"],
+        game=tournament["game"],
+        format=tournament["format"],
+        status=tournament["status"],
+        round=tournament["round"],
+        rounds=tournament["rounds"],
+        games_per_pairing=tournament["games_per_pairing"],
+        max_matches_per_agent=tournament["max_matches_per_agent"],
+        champion=champion,
+        created_at=tournament["created_at"],
+        finished_at=tournament["finished_at"],
+        pending=by_status.get("pending", 0),
+        running=by_status.get("running", 0),
+        finished=by_status.get("finished", 0),
+        standings=standings,
+    )
@@ -0,0 +1,49 @@
+from datetime import datetime
+from typing import Literal
+
+from pydantic import BaseModel
+
+from gameplay_computer.gameplay import Agent, Game
+
+TournamentFormat = Literal["round_robin", "swiss", "gauntlet"]
+TournamentStatus = Literal["running", "finished"]
+
+
+class Standing(BaseModel):
+    agent: Agent
+    wins: int
+    losses: int
+    draws: int
+    errors: int
+    byes: int
+    # A win or bye is a point, a draw half.
+    points: float
+
+
+class Tournament(BaseModel):
+    id: int
+    game: Game
+    format: TournamentFormat
+    status: TournamentStatus
+    round: int
+    rounds: int
+    games_per_pairing: int
+    max_matches_per_agent: int
+    champion: Agent | None
+    created_at: datetime
+    finished_at: datetime | None
+    # Matches by status.
+    pending: int
+    running: int
+    finished: int
+    # Best first.
+    standings: list[Standing]
+
+
+class ScheduledMatch(BaseModel):
+    """
+    A tournament match the scheduler created, for the caller to start.
+    """
+
+    match_id: int
+    shard: int | None
@@ -0,0 +1,324 @@
+import os
+from typing import Any, assert_never
+
+from databases import Database
+from fastapi import HTTPException, status
+
+from gameplay_computer import agents, matches
+from gameplay_computer.gameplay import Agent, Game
+
+from . import repo
+from .schemas import ScheduledMatch, Tournament, TournamentFormat
+
+# Configured with environment variables.
+#   TOURNAMENT_WAVE_SIZE: most matches started by one scheduling pass, default
+#       200
+#   TOURNAMENT_SHARDS: how many batch queues tournament matches are spread
+#       over, default 1 for the shared one, see tasks.defer_ai_turns
+#   TOURNAMENT_MAX_AGENTS: default 256
+wave_size = int(os.environ.get("TOURNAMENT_WAVE_SIZE", "200"))
+shards = int(os.environ.get("TOURNAMENT_SHARDS", "1"))
+max_agents = int(os.environ.get("TOURNAMENT_MAX_AGENTS", "256"))
+
+
+def _round_robin_pairs(agent_ids: list[int]) -> list[tuple[int, int]]:
+    """
+    Every pair once, in rounds where no agent plays twice (circle method) so
+    the scheduler can start a whole round at once.
+    """
+    ids: list[int | None] = list(agent_ids)
+    if len(ids) % 2 == 1:
+        ids.append(None)
+    pairs = []
+    for r in range(len(ids) - 1):
+        for i in range(len(ids) // 2):
+            a, b = ids[i], ids[len(ids) - 1 - i]
+            if a is None or b is None:
+                continue
+            # Alternate who goes first for the fixed agent.
+            pairs.append((a, b) if i > 0 or r % 2 == 0 else (b, a))
+        ids = [ids[0], ids[-1], *ids[1:-1]]
+    return pairs
+
+
+def _swiss_pairs(
+    ranked: list[int], byes: dict[int, int], played: set[frozenset[int]]
+) -> tuple[list[tuple[int, int]], int | None]:
+    """
+    Pair each agent with the best ranked one it hasn't played yet, or the
+    next one if it played them all. With an odd number of agents the lowest
+    ranked one with the fewest byes sits out.
+    """
+    unpaired = list(ranked)
+    bye = None
+    if len(unpaired) % 2 == 1:
+        fewest = min(byes.get(agent_id, 0) for agent_id in unpaired)
+        bye = next(
+            agent_id
+            for agent_id in reversed(unpaired)
+            if byes.get(agent_id, 0) == fewest
+        )
+        unpaired.remove(bye)
+    pairs = []
+    while unpaired:
+        a = unpaired.pop(0)
+        b = next(
+            (other for other in unpaired if frozenset([a, other]) not in played),
+            unpaired[0],
+        )
+        unpaired.remove(b)
+        pairs.append((a, b))
+    return pairs, bye
+
+
+def _schedule(
+    tournament_id: int, pairs: list[tuple[int, int]], games_per_pairing: int
+) -> list[tuple[int, int, int | None]]:
+    """
+    Each pair games_per_pairing times, switching who goes first, with the
+    batch queue shard each match runs on.
+    """
+    games = [
+        (a, b) if game % 2 == 0 else (b, a)
+        for game in range(games_per_pairing)
+        for a, b in pairs
+    ]
+    return [
+        (a, b, (tournament_id + i) % shards if shards > 1 else None)
+        for i, (a, b) in enumerate(games)
+    ]
+
+
+async def create_tournament(
+    database: Database,
+    created_by_user_id: str,
+    game: Game,
+    format: TournamentFormat,
+    tournament_agents: list[Agent],
+    champion: Agent | None = None,
+    rounds: int = 1,
+    games_per_pairing: int = 2,
+    max_matches_per_agent: int = 4,
+) -> int:
+    """
+    Only sets the tournament up, schedule_tournament starts its matches.
+    rounds is only for swiss, the other formats are played in one.
+    """
+    if any(agent.game != game for agent in [*tournament_agents, champion] if agent):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"All agents have to play {game}.",
+        )
+    if games_per_pairing < 1 or max_matches_per_agent < 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Games per pairing and matches per agent have to be at least 1.",
+        )
+    agent_ids = [
+        await agents.get_agent_id_for_username_and_agentname(
+            database, agent.username, agent.agentname
+        )
+        for agent in tournament_agents
+    ]
+    champion_agent_id = None
+    if format == "gauntlet" and champion is not None:
+        champion_agent_id = await agents.get_agent_id_for_username_and_agentname(
+            database, champion.username, champion.agentname
+        )
+        if champion_agent_id in agent_ids:
+            agent_ids.remove(champion_agent_id)
+    if len(set(agent_ids)) != len(agent_ids):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Each agent can only be entered once.",
+        )
+    if not 2 <= len(agent_ids) + (champion_agent_id is not None) <= max_agents:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Tournaments need between 2 and {max_agents} agents.",
+        )
+
+    bye = None
+    match format:
+        case "round_robin":
+            rounds = 1
+            pairs = _round_robin_pairs(agent_ids)
+        case "swiss":
+            if not 1 <= rounds < len(agent_ids):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Swiss tournaments need fewer rounds than agents.",
+                )
+            # Entry order is the seeding, the top half plays the bottom half.
+            seeded = list(agent_ids)
+            if len(seeded) % 2 == 1:
+                bye = seeded.pop()
+            half = len(seeded) // 2
+            pairs = list(zip(seeded[:half], seeded[half:]))
+        case "gauntlet":
+            if champion_agent_id is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Gauntlets need a champion.",
+                )
+            rounds = 1
+            pairs = [(champion_agent_id, agent_id) for agent_id in agent_ids]
+            agent_ids = [champion_agent_id, *agent_ids]
+        case _format as unknown:
+            assert_never(unknown)
+
+    async with database.transaction():
+        tournament_id = await repo.create_tournament(
+            database,
+            created_by_user_id,
+            game,
+            format,
+            agent_ids,
+            champion_agent_id,
+            rounds,
+            games_per_pairing,
+            max_matches_per_agent,
+        )
+        await repo.add_tournament_matches(
+            database,
+            tournament_id,
+            1,
+            _schedule(tournament_id, pairs, games_per_pairing),
+        )
+        if bye is not None:
+            await repo.add_bye(database, tournament_id, bye)
+    return tournament_id
+
+
+async def _start_matches(
+    database: Database, tournament: Any, round: int
+) -> list[ScheduledMatch]:
+    """
+    Create the next wave of the round's matches, as many as the agents'
+    caps allow.
+    """
+    max_matches_per_agent = tournament["max_matches_per_agent"]
+    running = await repo.get_running_counts(database, tournament["id"])
+    candidates = await repo.list_pending_matches(
+        database,
+        tournament["id"],
+        round,
+        max_matches_per_agent,
+        # Some get skipped when earlier ones in the wave fill an agent's cap.
+        limit=wave_size * 4,
+    )
+    tournament_agents: dict[int, Agent] = {}
+    scheduled: list[ScheduledMatch] = []
+    for candidate in candidates:
+        if len(scheduled) >= wave_size:
+            break
+        agent_ids = [candidate["agent_id_0"], candidate["agent_id_1"]]
+        if any(
+            running.get(agent_id, 0) >= max_matches_per_agent for agent_id in agent_ids
+        ):
+            continue
+        for agent_id in agent_ids:
+            if agent_id not in tournament_agents:
+                tournament_agents[agent_id] = await agents.get_agent_by_id(
+                    database, agent_id
+                )
+        match_id = await matches.create_match(
+            database,
+            tournament["created_by"],
+            tournament["game"],
+            [tournament_agents[agent_id] for agent_id in agent_ids],
+        )
+        await repo.set_tournament_match_started(database, candidate["id"], match_id)
+        for agent_id in agent_ids:
+            running[agent_id] = running.get(agent_id, 0) + 1
+        scheduled.append(ScheduledMatch(match_id=match_id, shard=candidate["shard"]))
+    return scheduled
+
+
+async def _add_swiss_round(database: Database, tournament: Any, round: int) -> None:
+    rows = await repo.list_standing_rows(database, tournament["id"])
+    pairs, bye = _swiss_pairs(
+        [row["agent_id"] for row in rows],
+        {row["agent_id"]: row["byes"] for row in rows},
+        await repo.list_played_pairs(database, tournament["id"]),
+    )
+    await repo.add_tournament_matches(
+        database,
+        tournament["id"],
+        round,
+        _schedule(tournament["id"], pairs, tournament["games_per_pairing"]),
+    )
+    if bye is not None:
+        await repo.add_bye(database, tournament["id"], bye)
+    await repo.set_tournament_round(database, tournament["id"], round)
+
+
+async def schedule_tournament(
+    database: Database, tournament_id: int
+) -> list[ScheduledMatch]:
+    """
+    Start the matches that can start now, moving to the next swiss round or
+    finishing the tournament when the current round is done. Safe to call
+    any time, the caller starts the returned matches' turns.
+    """
+    async with database.transaction():
+        tournament = await repo.lock_tournament(database, tournament_id)
+        if tournament is None or tournament["status"] != "running":
+            return []
+        round = tournament["round"]
+        await repo.drop_deleted_agent_matches(database, tournament_id)
+
+        scheduled = await _start_matches(database, tournament, round)
+        if scheduled:
+            return scheduled
+        counts = await repo.count_round_matches(database, tournament_id, round)
+        if counts.get("pending", 0) > 0 or counts.get("running", 0) > 0:
+            # Waiting for matches to finish.
+            return []
+
+        if tournament["format"] == "swiss" and round < tournament["rounds"]:
+            await _add_swiss_round(database, tournament, round + 1)
+            return await _start_matches(database, tournament, round + 1)
+        await repo.finish_tournament(database, tournament_id)
+        return []
+
+
+async def record_match_result(database: Database, match_id: int) -> int | None:
+    """
+    Count a finished match in its tournament's standings. Returns the
+    tournament id if it was a tournament match that wasn't counted yet.
+    """
+    return await repo.finish_tournament_match(database, match_id)
+
+
+async def record_missed_results(database: Database) -> set[int]:
+    """
+    Count the finished matches whose worker went away before it could.
+    Returns the tournaments they're in.
+    """
+    tournament_ids = set()
+    for match_id in await repo.list_unrecorded_match_ids(database):
+        tournament_id = await repo.finish_tournament_match(database, match_id)
+        if tournament_id is not None:
+            tournament_ids.add(tournament_id)
+    return tournament_ids
+
+
+async def list_running_tournaments(database: Database) -> list[int]:
+    return await repo.list_running_tournament_ids(database)
+
+
+async def list_running_matches(
+    database: Database, tournament_id: int
+) -> list[ScheduledMatch]:
+    return await repo.list_running_matches(database, tournament_id)
+
+
+async def get_tournament(database: Database, tournament_id: int) -> Tournament:
+    tournament = await repo.get_tournament(database, tournament_id)
+    if tournament is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown tournament.",
+        )
+    return tournament
@@ -0,0 +1,84 @@
+import sqlalchemy
+
+from gameplay_computer.common.tables import game, metadata
+
+tournaments = sqlalchemy.Table(
+    "tournaments",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("game", game, nullable=False),
+    sqlalchemy.Column(
+        "format",
+        sqlalchemy.Enum("round_robin", "swiss", "gauntlet", name="tournament_format"),
+        nullable=False,
+    ),
+    sqlalchemy.Column(
+        "status",
+        sqlalchemy.Enum("running", "finished", name="tournament_status"),
+        nullable=False,
+    ),
+    # Swiss rounds, 1 for the other formats.
+    sqlalchemy.Column("rounds", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("round", sqlalchemy.Integer, nullable=False),
+    # Each pairing is played this many times, alternating who goes first.
+    sqlalchemy.Column("games_per_pairing", sqlalchemy.Integer, nullable=False),
+    # How many of the tournament's matches an agent can be in at once.
+    sqlalchemy.Column("max_matches_per_agent", sqlalchemy.Integer, nullable=False),
+    # The agent everyone plays in a gauntlet.
+    sqlalchemy.Column("champion_agent_id", sqlalchemy.BigInteger),
+    sqlalchemy.Column("created_by", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+    sqlalchemy.Column("finished_at", sqlalchemy.DateTime(timezone=True)),
+)
+
+# Standings, updated as each match finishes.
+tournament_agents = sqlalchemy.Table(
+    "tournament_agents",
+    metadata,
+    sqlalchemy.Column(
+        "tournament_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("tournaments.id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("agent_id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("wins", sqlalchemy.Integer, nullable=False, server_default="0"),
+    sqlalchemy.Column("losses", sqlalchemy.Integer, nullable=False, server_default="0"),
+    sqlalchemy.Column("draws", sqlalchemy.Integer, nullable=False, server_default="0"),
+    sqlalchemy.Column("errors", sqlalchemy.Integer, nullable=False, server_default="0"),
+    # Swiss rounds sat out with an odd number of agents, counted as wins.
+    sqlalchemy.Column("byes", sqlalchemy.Integer, nullable=False, server_default="0"),
+)
+
+# The matches a tournament will play. match_id is set when the scheduler
+# creates the match.
+tournament_matches = sqlalchemy.Table(
+    "tournament_matches",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column(
+        "tournament_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("tournaments.id"),
+        nullable=False,
+    ),
+    sqlalchemy.Column("round", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("agent_id_0", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("agent_id_1", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column(
+        "status",
+        sqlalchemy.Enum(
+            "pending", "running", "finished", name="tournament_match_status"
+        ),
+        nullable=False,
+    ),
+    sqlalchemy.Column(
+        "match_id",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("matches.id"),
+        unique=True,
+    ),
+    # Which batch queue the match's turns run on, null for the shared one.
+    sqlalchemy.Column("shard", sqlalchemy.Integer),
+    sqlalchemy.Index("tournament_matches_status", "tournament_id", "status"),
+)
@@ -1,22 +1,41 @@
 import json
 import os
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
 import databases
 import sentry_sdk
-from fastapi import Depends, FastAPI, Request, Response, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, Request, Response, HTTPException, WebSocket
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from jinja2_fragments import render_block  # type: ignore
 from jinja2_fragments.fastapi import Jinja2Blocks  # type: ignore
 from sse_starlette.sse import EventSourceResponse
 
-import gameplay_computer.gameplay
+from gameplay_computer import agents, matches, tournaments
+from gameplay_computer.gameplay import (
+    Agent,
+    CompactMatch,
+    Connect4Action,
+    Connect4State,
+    Match,
+    Turn,
+    User,
+)
 from . import service, tasks
 from .auth import AuthUser, auth
+from .fragments import FragmentCache
 from .listener import Listener
-from .schemas import AgentCreate, MatchCreate, TurnCreate
-from .tasks import app as papp
+from .schemas import (
+    AgentCreate,
+    FragmentCacheMetrics,
+    ListenerMetrics,
+    MatchCreate,
+    MatchExport,
+    QueueMetrics,
+    TournamentCreate,
+    TurnCreate,
+)
 from .tracing import setup_tracing
 
 database_url = os.environ.get("DATABASE_URL")
@@ -25,15 +44,60 @@ if database_url is None:
 assert database_url is not None
 database = databases.Database(database_url)
 
-clerk_publishable_key = os.environ.get("CLERK_PUBLISHABLE_KEY")
+# Optional read replica. Reads that can tolerate a little replication lag
+# (dashboard, match pages, sse refreshes) go here so spectators don't compete
+# with turn writes on the primary. Without one, everything uses the primary.
+read_database_url = os.environ.get("READ_DATABASE_URL")
+if read_database_url is not None:
+    read_database = databases.Database(read_database_url)
+else:
+    read_database = database
 
-listener = Listener(database_url)
+clerk_publishable_key = os.environ.get("CLERK_PUBLISHABLE_KEY")
 
 app = FastAPI()
 
 web_dir = Path(__file__).parent
 app.mount("/static", StaticFiles(directory=web_dir / "static"), name="static")
 templates = Jinja2Blocks(directory=web_dir / "templates")
+templates.env.globals["hosted_agents"] = agents.hosted_agents_enabled()
+
+# MATCH_FRAGMENT_CACHE_SIZE: rendered match states kept per process, default
+# 1000
+fragments = FragmentCache(int(os.environ.get("MATCH_FRAGMENT_CACHE_SIZE", "1000")))
+
+
+def render_match_state(match: Match, seats: tuple[int, ...]) -> str:
+    """
+    The match_state block for a viewer playing seats, rendered once per turn.
+    """
+    return fragments.get_or_render(
+        (match.id, match.turn, match.status, seats),
+        lambda: render_block(
+            templates.env,
+            "connect4_match.html",
+            "match_state",
+            match=match,
+            seats=seats,
+        ),
+    )
+
+
+async def render_spectator_state(match_id: int, turn: int | None) -> str:
+    """
+    For the listener's broadcasts. Without a turn the replica might not have
+    the change yet, read the primary.
+    """
+    if turn is None:
+        match = await service.get_match(database, match_id)
+    else:
+        match = await service.get_match(
+            read_database, match_id, primary=database, min_turn=turn
+        )
+    return render_match_state(match, ())
+
+
+listener = Listener(database_url, render_spectator_state)
 
 
 def view(
@@ -54,11 +118,53 @@ def view(
     )
 
 
+def match_view(request: Request, user: AuthUser, match: Match) -> Any:
+    """
+    Updates of a match page share the render of everyone in the same seats.
+    """
+    seats = service.get_viewer_seats(match, user.username)
+    if request.headers.get("hx-target") == "match_state":
+        return HTMLResponse(render_match_state(match, seats))
+    return view(request, "connect4_match.html", user=user, match=match, seats=seats)
+
+
 @app.get("/health", response_class=HTMLResponse)
 async def check_health(request: Request) -> Any:
     return Response(status_code=200)
 
 
+# Optional bearer token for the metrics endpoints.
+metrics_token = os.environ.get("METRICS_TOKEN")
+
+
+def check_metrics_token(request: Request) -> None:
+    if metrics_token is None:
+        return
+    if request.headers.get("authorization") != f"Bearer {metrics_token}":
+        raise HTTPException(status_code=401, detail="Bad metrics token")
+
+
+@app.get("/metrics/queues", dependencies=[Depends(check_metrics_token)])
+async def get_queue_metrics() -> list[QueueMetrics]:
+    """
+    For autoscaling workers, on how many jobs are waiting and for how long.
+    """
+    return await service.get_queue_metrics(database)
+
+
+@app.get("/metrics/listener", dependencies=[Depends(check_metrics_token)])
+async def get_listener_metrics() -> ListenerMetrics:
+    """
+    Match page subscribers of this web process.
+    """
+    return listener.metrics()
+
+
+@app.get("/metrics/fragments", dependencies=[Depends(check_metrics_token)])
+async def get_fragment_metrics() -> FragmentCacheMetrics:
+    return fragments.metrics()
+
+
 @app.get("/", response_class=HTMLResponse)
 async def get_root(request: Request) -> Any:
     return view(request, "index.html")
@@ -66,8 +172,8 @@ async def get_root(request: Request) -> Any:
 
 @app.get("/app", response_class=HTMLResponse)
 async def get_app(request: Request, user: AuthUser = Depends(auth)) -> Any:
-    matches = await service.get_matches(database, user.user_id)
-    agents = await service.get_agents(database)
+    matches = await service.get_matches(read_database, user.user_id)
+    agents = await service.get_agents(read_database)
     return view(request, "app.html", user=user, matches=matches, agents=agents)
 
 
@@ -81,7 +187,7 @@ async def create_match(
     match_id = await service.create_match(database, user.user_id, new_match)
 
     traceparent = sentry_sdk.Hub.current.scope.transaction.to_traceparent()
-    await tasks.run_ai_turns.defer_async(traceparent=traceparent, match_id=match_id)
+    await tasks.defer_ai_turns(traceparent, match_id, interactive=new_match.interactive)
 
     # todo: If there is any error, I return the form again with the error message filled
     # in like this, the form just posts and replaces itself
@@ -133,7 +239,7 @@ async def get_create_match_selects(
                     </select>
                     """
         case "agent":
-            agents = await service.get_agents(database)
+            agents = await service.get_agents(read_database)
             options = [
                 f'<option value="{agent.username}/{agent.agentname}">'
                 + f"{agent.username}/{agent.agentname}</option>"
@@ -149,12 +255,33 @@ async def get_create_match_selects(
             return None
 
 
+@app.get("/app/matches/export", response_class=StreamingResponse)
+async def export_matches(
+    request: Request,
+    user: AuthUser = Depends(auth),
+    export: MatchExport = Depends(MatchExport.as_query),
+) -> Any:
+    media_type = {"ndjson": "application/x-ndjson", "csv": "text/csv"}[export.format]
+    return StreamingResponse(
+        await service.export_matches(read_database, export),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="matches.{export.format}"'
+        },
+    )
+
+
 @app.get("/app/matches/{match_id}", response_class=HTMLResponse)
 async def get_match(
-    request: Request, match_id: int, user: AuthUser = Depends(auth)
+    request: Request,
+    match_id: int,
+    min_turn: int | None = None,
+    user: AuthUser = Depends(auth),
 ) -> Any:
-    match = await service.get_match(database, match_id)
-    return view(request, "connect4_match.html", user=user, match=match)
+    match = await service.get_match(
+        read_database, match_id, primary=database, min_turn=min_turn
+    )
+    return match_view(request, user, match)
 
 
 @app.get("/app/matches/{match_id}/changes", response_class=EventSourceResponse)
@@ -173,13 +300,22 @@ async def create_turn(
     user: AuthUser = Depends(auth),
     new_turn: TurnCreate = Depends(TurnCreate.as_form),
 ) -> Any:
-    await service.take_turn(database, match_id, new_turn, user.user_id)
+    match = await service.take_turn(database, match_id, new_turn, user.user_id)
+    match = await service.take_speculated_ai_turn(database, match)
 
     traceparent = sentry_sdk.Hub.current.scope.transaction.to_traceparent()
-    await tasks.run_ai_turns.defer_async(traceparent=traceparent, match_id=match_id)
+    await tasks.defer_ai_turns(traceparent, match_id)
 
-    match = await service.get_match(database, match_id)
-    return view(request, "connect4_match.html", user=user, match=match)
+    return match_view(request, user, match)
+
+
+@app.get("/app/positions/{position}")
+async def get_position_occurrences(
+    position: str, limit: int = 100, user: AuthUser = Depends(auth)
+) -> list[matches.PositionOccurrence]:
+    return await service.get_position_occurrences(
+        read_database, position, limit=min(limit, 1000)
+    )
 
 
 @app.post("/app/agents/create_agent", response_class=HTMLResponse)
@@ -190,13 +326,16 @@ async def create_agent(
     new_agent: AgentCreate = Depends(AgentCreate.as_form),
 ) -> Any:
     create_agent_errors = None
+    agent_token = None
 
     try:
-        await service.create_agent(database, user.user_id, new_agent)
+        _, agent_token = await service.create_agent(database, user.user_id, new_agent)
     except Exception as e:
         create_agent_errors = [str(e)]
 
-    response.headers["hx-trigger"] = "AgentUpdate"
+    # Reloading the page would hide the token before it's copied.
+    if agent_token is None:
+        response.headers["hx-trigger"] = "AgentUpdate"
 
     return view(
         request,
@@ -204,11 +343,121 @@ async def create_agent(
         block_name="create_agent",
         user=user,
         create_agent_errors=create_agent_errors,
+        agent_token=agent_token,
     )
 
 
+@app.get("/app/agents", response_class=HTMLResponse)
+async def get_agents(request: Request, user: AuthUser = Depends(auth)) -> Any:
+    agent_stats = await service.list_agent_stats(read_database)
+    return view(request, "agents.html", user=user, agent_stats=agent_stats)
+
+
+@app.get("/app/agents/{username}/{agentname}/stats")
+async def get_agent_stats(
+    username: str, agentname: str, user: AuthUser = Depends(auth)
+) -> agents.AgentStats:
+    return await service.get_agent_stats(read_database, username, agentname)
+
+
+leaderboard_page_size = 50
+
+
+@app.get("/app/leaderboard", response_class=HTMLResponse)
+async def get_leaderboard(
+    request: Request,
+    game: Literal["connect4"] = "connect4",
+    offset: int = 0,
+    user: AuthUser = Depends(auth),
+) -> Any:
+    offset = max(offset, 0)
+    agent_ratings = await service.list_agent_ratings(
+        read_database, game, limit=leaderboard_page_size, offset=offset
+    )
+    return view(
+        request,
+        "leaderboard.html",
+        user=user,
+        game=game,
+        agent_ratings=agent_ratings,
+        offset=offset,
+        page_size=leaderboard_page_size,
+    )
+
+
+@app.get("/app/ratings")
+async def get_agent_ratings(
+    game: Literal["connect4"] = "connect4",
+    limit: int = 100,
+    offset: int = 0,
+    user: AuthUser = Depends(auth),
+) -> list[agents.AgentRating]:
+    return await service.list_agent_ratings(
+        read_database, game, limit=min(limit, 1000), offset=max(offset, 0)
+    )
+
+
+@app.get("/app/tournaments", response_class=HTMLResponse)
+async def get_tournaments(request: Request, user: AuthUser = Depends(auth)) -> Any:
+    agents = await service.get_agents(read_database)
+    return view(request, "tournaments.html", user=user, agents=agents)
+
+
+@app.post("/app/tournaments/create_tournament", response_class=HTMLResponse)
+async def create_tournament(
+    request: Request,
+    response: Response,
+    user: AuthUser = Depends(auth),
+    new_tournament: TournamentCreate = Depends(TournamentCreate.as_form),
+) -> Any:
+    create_tournament_errors = None
+    try:
+        tournament_id = await service.create_tournament(
+            database, user.user_id, new_tournament
+        )
+    except HTTPException as e:
+        create_tournament_errors = [e.detail]
+    else:
+        traceparent = sentry_sdk.Hub.current.scope.transaction.to_traceparent()
+        await tasks.defer_schedule_tournament(traceparent, tournament_id)
+        location = json.dumps(
+            {"path": f"/app/tournaments/{tournament_id}", "target": "#main"}
+        )
+        response.headers["hx-location"] = location
+
+    agents = await service.get_agents(read_database)
+    return view(
+        request,
+        "tournaments.html",
+        block_name="create_tournament",
+        user=user,
+        agents=agents,
+        create_tournament_errors=create_tournament_errors,
+    )
+
+
+@app.get("/app/tournaments/{tournament_id}", response_class=HTMLResponse)
+async def get_tournament(
+    request: Request, tournament_id: int, user: AuthUser = Depends(auth)
+) -> Any:
+    tournament = await service.get_tournament(read_database, tournament_id)
+    return view(request, "tournament.html", user=user, tournament=tournament)
+
+
+@app.get("/app/tournaments/{tournament_id}/standings")
+async def get_tournament_standings(
+    tournament_id: int, user: AuthUser = Depends(auth)
+) -> tournaments.Tournament:
+    return await service.get_tournament(read_database, tournament_id)
+
+
+@app.websocket("/agents/connect")
+async def connect_agent(websocket: WebSocket) -> None:
+    await service.serve_agent_socket(database, websocket)
+
+
 @app.delete("/app/agents/{username}/{agentname}", response_class=HTMLResponse)
-async def create_agent(
+async def delete_agent(
     request: Request,
     response: Response,
     username: str,
@@ -223,17 +472,6 @@ async def create_agent(
         raise HTTPException(status_code=404, detail="Agent not found")
 
 
-from gameplay_computer.gameplay import (
-    Match,
-    Action,
-    Connect4Action,
-    Connect4State,
-    User,
-    Agent,
-    Turn,
-)
-
-
 @app.get("/example_match")
 async def example_match() -> Match:
     return Match(
@@ -266,6 +504,12 @@ async def example_match() -> Match:
     )
 
 
+@app.get("/example_compact_match")
+async def example_compact_match() -> CompactMatch:
+    match = await example_match()
+    return agents.compact_match(match)
+
+
 @app.get("/example_action")
 async def example_action() -> Connect4Action:
     return Connect4Action(column=3)
@@ -274,11 +518,20 @@ async def example_action() -> Connect4Action:
 @app.on_event("startup")
 async def startup() -> None:
     await database.connect()
-    await papp.open_async()
+    if read_database is not database:
+        await read_database.connect()
+    agents.open_agent_client()
+    listener.start()
+    await tasks.open_backend()
     setup_tracing()
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    await listener.stop()
     await database.disconnect()
-    await papp.close_async()
+    if read_database is not database:
+        await read_database.disconnect()
+    await agents.close_agent_client()
+    await agents.close_sandbox()
+    await tasks.close_backend()
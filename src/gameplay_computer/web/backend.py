@@ -0,0 +1,213 @@
+"""
+Where deferred tasks run, picked with TASK_BACKEND.
+    procrastinate (default): jobs go through postgres to gameplay_worker.
+    memory: jobs run in the web process on asyncio tasks, for tests,
+        benchmarks and single machine deployments without a worker. Jobs
+        waiting when the process exits are lost, resume_tournaments picks
+        tournaments back up but user matches wait for the next move.
+Both take the same tasks, the procrastinate ones in tasks.py.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, Protocol
+
+import procrastinate
+
+Slots = list[tuple[list[str] | None, int]]
+
+
+class TaskBackend(Protocol):
+    async def open(self) -> None:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+    async def defer(
+        self,
+        task: procrastinate.tasks.Task,
+        queue: str | None = None,
+        lock: str | None = None,
+        queueing_lock: str | None = None,
+        delay: float | None = None,
+        **kwargs: Any,
+    ) -> bool:
+        """
+        Run task(**kwargs) on queue, the task's own queue if None, after delay
+        seconds. Jobs with the same lock run one at a time. Returns False
+        without deferring if a job with the same queueing lock is waiting, or
+        for the memory backend if the queue is full.
+        """
+        ...
+
+
+class ProcrastinateBackend:
+    def __init__(self, app: procrastinate.App):
+        self.app = app
+
+    async def open(self) -> None:
+        await self.app.open_async()
+
+    async def close(self) -> None:
+        await self.app.close_async()
+
+    async def defer(
+        self,
+        task: procrastinate.tasks.Task,
+        queue: str | None = None,
+        lock: str | None = None,
+        queueing_lock: str | None = None,
+        delay: float | None = None,
+        **kwargs: Any,
+    ) -> bool:
+        configured = task.configure(
+            queue=queue,
+            lock=lock,
+            queueing_lock=queueing_lock,
+            schedule_at=(
+                datetime.now(timezone.utc) + timedelta(seconds=delay)
+                if delay is not None
+                else None
+            ),
+        )
+        try:
+            await configured.defer_async(**kwargs)
+        except procrastinate.exceptions.AlreadyEnqueued:
+            return False
+        return True
+
+
+class _Job:
+    def __init__(
+        self,
+        task: procrastinate.tasks.Task,
+        lock: str | None,
+        queueing_lock: str | None,
+        kwargs: dict[str, Any],
+    ):
+        self.task = task
+        self.lock = lock
+        self.queueing_lock = queueing_lock
+        self.kwargs = kwargs
+
+
+class MemoryBackend:
+    """
+    Each group of slots (see tasks.worker_slots) gets a queue of at most
+    queue_size jobs and as many consumers as it has slots. Deferring to a
+    full queue drops the job, waiting for room would deadlock a consumer
+    deferring to its own queue. A job waiting on another's lock holds its
+    consumer, at most one per match or tournament because of the queueing
+    locks. The periodic tasks are deferred every period seconds.
+    Every queue in queues, the ones jobs can be deferred to, needs a group.
+    It's checked up front, deferring to a queue without one fails after the
+    work that led to it is committed.
+    """
+
+    def __init__(
+        self,
+        slots: Slots,
+        queue_size: int,
+        periodic: list[procrastinate.tasks.Task],
+        period: float = 60,
+        queues: Iterable[str] = (),
+    ):
+        self.slots = slots
+        self.queues: list[asyncio.Queue[_Job]] = [
+            asyncio.Queue(maxsize=queue_size) for _ in slots
+        ]
+        self.periodic = periodic
+        self.period = period
+        # Queueing locks of the jobs that haven't started.
+        self.queued: set[str] = set()
+        # Only kept while a job holds or waits on them.
+        self.locks: weakref.WeakValueDictionary[
+            str, asyncio.Lock
+        ] = weakref.WeakValueDictionary()
+        self.consumers: list[asyncio.Task[None]] = []
+        for queue_name in queues:
+            self._queue_for(queue_name)
+
+    async def open(self) -> None:
+        for queue, (_, concurrency) in zip(self.queues, self.slots):
+            for _ in range(concurrency):
+                self.consumers.append(asyncio.create_task(self._consume(queue)))
+        if self.periodic:
+            self.consumers.append(asyncio.create_task(self._defer_periodic()))
+
+    async def close(self) -> None:
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.consumers = []
+
+    def _queue_for(self, queue_name: str) -> asyncio.Queue[_Job]:
+        for queue, (queue_names, _) in zip(self.queues, self.slots):
+            if queue_names is None or queue_name in queue_names:
+                return queue
+        raise ValueError(f"No slots for queue {queue_name}.")
+
+    async def defer(
+        self,
+        task: procrastinate.tasks.Task,
+        queue: str | None = None,
+        lock: str | None = None,
+        queueing_lock: str | None = None,
+        delay: float | None = None,
+        **kwargs: Any,
+    ) -> bool:
+        target = self._queue_for(queue or task.queue)
+        if queueing_lock is not None:
+            if queueing_lock in self.queued:
+                return False
+            self.queued.add(queueing_lock)
+        job = _Job(task, lock, queueing_lock, kwargs)
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._put_later, target, job)
+            return True
+        try:
+            target.put_nowait(job)
+        except asyncio.QueueFull:
+            if queueing_lock is not None:
+                self.queued.discard(queueing_lock)
+            logging.warning("task %s dropped, its queue is full", task.name)
+            return False
+        return True
+
+    def _put_later(self, target: asyncio.Queue[_Job], job: _Job) -> None:
+        try:
+            target.put_nowait(job)
+        except asyncio.QueueFull:
+            asyncio.get_running_loop().call_later(1, self._put_later, target, job)
+
+    async def _consume(self, queue: asyncio.Queue[_Job]) -> None:
+        while True:
+            job = await queue.get()
+            if job.queueing_lock is not None:
+                self.queued.discard(job.queueing_lock)
+            try:
+                if job.lock is None:
+                    await job.task.func(**job.kwargs)
+                else:
+                    lock = self.locks.get(job.lock)
+                    if lock is None:
+                        lock = self.locks[job.lock] = asyncio.Lock()
+                    async with lock:
+                        await job.task.func(**job.kwargs)
+            except Exception:
+                logging.exception("task %s failed", job.task.name)
+            finally:
+                queue.task_done()
+
+    async def _defer_periodic(self) -> None:
+        while True:
+            for task in self.periodic:
+                await self.defer(
+                    task,
+                    queueing_lock=task.queueing_lock,
+                    timestamp=int(time.time()),
+                )
+            await asyncio.sleep(self.period)
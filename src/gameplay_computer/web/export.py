@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import get_args
+
+import databases
+
+from gameplay_computer.matches import MatchStatus
+from gameplay_computer.web import service
+from gameplay_computer.web.schemas import MatchExport
+
+
+async def async_main(export: MatchExport, output: str | None) -> None:
+    # Exports are big reads, use the replica if there is one.
+    database_url = os.environ.get("READ_DATABASE_URL")
+    if database_url is None:
+        database_url = os.environ.get("DATABASE_URL")
+    assert database_url is not None
+
+    database = databases.Database(database_url)
+    await database.connect()
+    try:
+        # Checked before the output file is created.
+        chunks = await service.export_matches(database, export)
+        out = open(output, "w", newline="") if output is not None else sys.stdout
+        try:
+            async for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    finally:
+        await database.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export match history.")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--game", choices=["connect4"])
+    parser.add_argument("--agent", help="username/agentname")
+    parser.add_argument("--status", choices=get_args(MatchStatus))
+    parser.add_argument("--created-after", type=datetime.fromisoformat)
+    parser.add_argument("--created-before", type=datetime.fromisoformat)
+    parser.add_argument("--output", help="file to write to, defaults to stdout")
+    args = parser.parse_args()
+
+    export = MatchExport(
+        format=args.format,
+        game=args.game,
+        agent=args.agent,
+        status=args.status,
+        created_after=args.created_after,
+        created_before=args.created_before,
+    )
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(async_main(export, args.output))
+
+
+if __name__ == "__main__":
+    main()
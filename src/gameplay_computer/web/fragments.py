@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from typing import Callable
+
+from gameplay_computer.gameplay import MatchStatus
+
+from .schemas import FragmentCacheMetrics
+
+# (match id, turn, status, the seats the viewer plays). An agent error ends
+# a match without a new turn.
+FragmentKey = tuple[int, int, MatchStatus, tuple[int, ...]]
+
+
+class FragmentCache:
+    """
+    Least recently used match_state blocks of connect4_match.html. The block
+    only depends on the match turn and status and which seats the viewer
+    plays, so everyone watching a turn shares one render.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.fragments: OrderedDict[FragmentKey, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key: FragmentKey, render: Callable[[], str]) -> str:
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            self.hits += 1
+            self.fragments.move_to_end(key)
+            return fragment
+        self.misses += 1
+        fragment = self.fragments[key] = render()
+        while len(self.fragments) > self.max_size:
+            self.fragments.popitem(last=False)
+        return fragment
+
+    def metrics(self) -> FragmentCacheMetrics:
+        lookups = self.hits + self.misses
+        return FragmentCacheMetrics(
+            size=len(self.fragments),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+        )
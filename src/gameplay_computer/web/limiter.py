@@ -0,0 +1,88 @@
+import asyncio
+import contextlib
+import math
+import time
+from typing import AsyncIterator
+
+
+class AdaptiveLimiter:
+    """
+    Limits how many jobs run at once, with a limit that follows how much of a
+    job is spent waiting (on agents mostly) versus using the worker's cpu.
+    By Little's law jobs that took W wall seconds and C cpu seconds over the
+    same time use a core at C / W per job in flight, so to use target_cpu of
+    a core the limit should be about
+        target_cpu * W / C
+    retune() moves the limit halfway there each time it's called.
+    """
+
+    def __init__(
+        self, limit: int, min_limit: int, max_limit: int, target_cpu: float
+    ) -> None:
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_cpu = target_cpu
+        self.in_flight = 0
+        self.waiting = 0
+        # cpu use of the process over the last retune, 1 is a whole core.
+        self.cpu = 0.0
+        self._condition = asyncio.Condition()
+        # Since the last retune.
+        self._job_seconds = 0.0
+        self._cpu_at = time.process_time()
+        self._wall_at = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._job_seconds += time.monotonic() - started
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    async def retune(self) -> int:
+        cpu_at = time.process_time()
+        wall_at = time.monotonic()
+        cpu_seconds = cpu_at - self._cpu_at
+        wall_seconds = wall_at - self._wall_at
+        job_seconds = self._job_seconds
+        self._cpu_at, self._wall_at, self._job_seconds = cpu_at, wall_at, 0.0
+        if wall_seconds <= 0:
+            return self.limit
+        self.cpu = cpu_seconds / wall_seconds
+
+        if cpu_seconds > 0 and job_seconds > 0:
+            ideal = self.target_cpu * job_seconds / cpu_seconds
+        elif self.waiting > 0:
+            # Nothing finished but jobs are held back, most likely slow
+            # agents.
+            ideal = self.limit * 2
+        else:
+            return self.limit
+        limit = math.ceil((self.limit + ideal) / 2)
+        if limit > self.limit and self.waiting == 0:
+            # Only grow while there are jobs to run.
+            return self.limit
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        async with self._condition:
+            self._condition.notify_all()
+        return self.limit
+
+    def summary(self) -> dict[str, float | int]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "cpu": round(self.cpu, 2),
+        }
@@ -1,58 +1,296 @@
 import asyncio
+import json
+import logging
 from asyncio import Queue
-from collections import defaultdict
-from typing import AsyncIterator, Callable
+from typing import Any, AsyncGenerator, Awaitable, Callable
 
+import asyncpg  # type: ignore
 import asyncpg_listen
 
+from gameplay_computer import agents, matches
+
+from .schemas import ListenerMetrics
+
+Notification = dict[str, Any]
+# The match_state block spectators see at match_id's turn, or the latest turn.
+RenderMatchState = Callable[[int, int | None], Awaitable[str]]
+
+
+def _latest_turn(notification: Notification) -> int | None:
+    if notification.get("turns"):
+        number: int = notification["turns"][-1]["number"]
+        return number
+    return notification.get("turn")
+
+
+def _merge(pending: Notification, notification: Notification) -> Notification:
+    """
+    One notification with the turns of both. A new state replaces whatever
+    was pending, anything else that can't be merged becomes a refresh.
+    """
+    if "state" in notification:
+        return notification
+    if "turns" in pending and "turns" in notification:
+        return {**notification, "turns": pending["turns"] + notification["turns"]}
+    turns = [
+        turn
+        for turn in [_latest_turn(pending), _latest_turn(notification)]
+        if turn is not None
+    ]
+    return {
+        "match_id": notification["match_id"],
+        "refresh": True,
+        "turn": max(turns) if turns else None,
+    }
+
 
 class Listener:
-    def __init__(self, database_url: str):
+    """
+    Each subscriber to a match gets a queue of one notification. A new one
+    is merged into the one a slow client hasn't read yet, so memory stays
+    bounded and a slow client can't hold up the others.
+    Match notifications come on per match channels, LISTENed to on a
+    connection of their own while the match has subscribers.
+    When every page needs the whole match again, the match ended or turns
+    might have been missed, the match is read and rendered once with
+    render_match_state and the same html goes to every subscriber. Without
+    it each page reads it itself.
+    """
+
+    def __init__(
+        self, database_url: str, render_match_state: RenderMatchState | None = None
+    ):
         self.database_url = database_url
-        self.queues: dict[int, dict[int, Queue[str]]] = defaultdict(dict)
+        self.render_match_state = render_match_state
+        self.broadcast_tasks: set[asyncio.Task[None]] = set()
+        self.broadcasts = 0
+        self.queues: dict[int, dict[int, Queue[Notification]]] = {}
         self.running = False
+        self.listener_connection: asyncpg.Connection | None = None
+        self.notifications = 0
+        self.merged = 0
+        # Set when the matches with subscribers change.
+        self.channels_changed = asyncio.Event()
+
+    def start(self) -> None:
+        """
+        Start listening. Happens on the first listen() too but processes that
+        cache agents need to start it right away to get invalidations.
+        """
+        self._start()
 
     def _start(self) -> None:
         if not self.running:
             # @note: listener makes its own connections to the database
             # and doesn't use the pool that route handlers use.
-            self.listener = asyncpg_listen.NotificationListener(
-                asyncpg_listen.connect_func(self.database_url)
-            )
+            self.listener = asyncpg_listen.NotificationListener(self._connect_listener)
             self.listener_task = asyncio.create_task(
                 self.listener.run(
-                    {"test": self.handle_test},
+                    {
+                        "agent_deployments": self.handle_agent_deployments,
+                        "agent_socket_requests": self.handle_agent_socket_requests,
+                        "agent_socket_responses": self.handle_agent_socket_responses,
+                    },
                     policy=asyncpg_listen.ListenPolicy.ALL,
                 )
             )
+            self.match_task = asyncio.create_task(self._listen_matches())
             self.running = True
 
-    async def handle_test(
+    async def stop(self) -> None:
+        """
+        Stop listening and close the connections.
+        """
+        if not self.running:
+            return
+        self.running = False
+        running = [self.listener_task, self.match_task, *self.broadcast_tasks]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        # asyncpg_listen closes its connection in a task of its own that
+        # nothing waits for.
+        if self.listener_connection is not None:
+            self.listener_connection.terminate()
+            self.listener_connection = None
+
+    async def _connect_listener(self) -> asyncpg.Connection:
+        self.listener_connection = await asyncpg.connect(self.database_url)
+        return self.listener_connection
+
+    async def _listen_matches(self) -> None:
+        """
+        Keep the match connection listening to the matches with subscribers.
+        Subscribers get a refresh after a reconnect, they might have missed
+        turns.
+        """
+        delay = 1.0
+        reconnecting = False
+        while True:
+            try:
+                connection = await asyncpg.connect(self.database_url)
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("match listener: can't connect")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1.0
+            connection.add_termination_listener(lambda _: self.channels_changed.set())
+            if reconnecting:
+                for match_id in list(self.queues):
+                    self._resync(match_id)
+            reconnecting = True
+
+            listening: set[int] = set()
+            try:
+                while not connection.is_closed():
+                    self.channels_changed.clear()
+                    wanted = set(self.queues)
+                    for match_id in wanted - listening:
+                        await connection.add_listener(
+                            matches.match_channel(match_id), self.handle_match
+                        )
+                    for match_id in listening - wanted:
+                        await connection.remove_listener(
+                            matches.match_channel(match_id), self.handle_match
+                        )
+                    listening = wanted
+                    await self.channels_changed.wait()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                logging.exception("match listener: connection lost")
+            finally:
+                if not connection.is_closed():
+                    connection.terminate()
+
+    def handle_match(
+        self, connection: Any, pid: int, channel: str, payload: str
+    ) -> None:
+        self.notifications += 1
+        notification = json.loads(payload)
+        match_id = notification["match_id"]
+        if notification["status"] != "in_progress":
+            turns = notification["turns"]
+            self._resync(match_id, turns[-1]["number"] if turns else None)
+            return
+        for queue in self.queues.get(match_id, {}).values():
+            self._publish(queue, notification)
+
+    def _resync(self, match_id: int, turn: int | None = None) -> None:
+        """
+        Give every subscriber the whole match, at least at turn.
+        """
+        if self.render_match_state is None:
+            self._refresh(match_id, turn)
+        else:
+            task = asyncio.create_task(self._broadcast(match_id, turn))
+            self.broadcast_tasks.add(task)
+            task.add_done_callback(self.broadcast_tasks.discard)
+
+    async def _broadcast(self, match_id: int, turn: int | None) -> None:
+        assert self.render_match_state is not None
+        try:
+            state = await self.render_match_state(match_id, turn)
+        except Exception:
+            logging.exception("match %s: couldn't render the state", match_id)
+            self._refresh(match_id, turn)
+            return
+        self.broadcasts += 1
+        for queue in self.queues.get(match_id, {}).values():
+            self._publish(queue, {"match_id": match_id, "state": state})
+
+    def _refresh(self, match_id: int, turn: int | None = None) -> None:
+        """
+        Have every subscriber read the match again, at least at turn so a
+        replica that's behind doesn't give it an old one.
+        """
+        for queue in self.queues.get(match_id, {}).values():
+            self._publish(queue, {"match_id": match_id, "refresh": True, "turn": turn})
+
+    def _publish(self, queue: Queue[Notification], notification: Notification) -> None:
+        if queue.full():
+            notification = _merge(queue.get_nowait(), notification)
+            self.merged += 1
+        queue.put_nowait(notification)
+
+    async def handle_agent_deployments(
+        self, notification: asyncpg_listen.NotificationOrTimeout
+    ) -> None:
+        if isinstance(notification, asyncpg_listen.Notification):
+            if notification.payload is not None:
+                agents.invalidate_agent_deployment(int(notification.payload))
+
+    async def handle_agent_socket_requests(
         self, notification: asyncpg_listen.NotificationOrTimeout
     ) -> None:
         if isinstance(notification, asyncpg_listen.Notification):
-            print(f"got notification: {notification.channel} {notification.payload}")
             if notification.payload is not None:
-                match_id = int(notification.payload)
-                for _, queue in self.queues[match_id].items():
-                    queue.put_nowait(notification.payload)
-        elif isinstance(notification, asyncpg_listen.Timeout):
-            pass
-            # print(f"got timeout: {notification.channel}")
-
-    def listen(self, match_id: int) -> Callable[[], AsyncIterator[str]]:
+                await agents.forward_socket_request(notification.payload)
+
+    async def handle_agent_socket_responses(
+        self, notification: asyncpg_listen.NotificationOrTimeout
+    ) -> None:
+        if isinstance(notification, asyncpg_listen.Notification):
+            if notification.payload is not None:
+                agents.resolve_socket_response(notification.payload)
+
+    def listen(
+        self, match_id: int
+    ) -> Callable[[], AsyncGenerator[dict[str, str], None]]:
+        """
+        Server sent events for a match, "turn" with the new turns, "state"
+        with the match_state block spectators see or "refresh" with the
+        turn the page has to read the match again at, if known.
+        """
         self._start()
-        queue: Queue[str] = Queue()
-        self.queues[match_id][id(queue)] = queue
 
-        async def listener() -> AsyncIterator[str]:
+        async def listener() -> AsyncGenerator[dict[str, str], None]:
+            # Subscribe once streaming starts, a generator that never starts
+            # never runs its finally. However the client goes away after
+            # that, cancelled, an error sending or the generator closed, its
+            # queue goes too.
+            queue: Queue[Notification] = Queue(maxsize=1)
+            self._subscribe(match_id, queue)
             try:
                 while True:
-                    item = await queue.get()
-                    yield item
-            except asyncio.CancelledError as e:
-                if id(queue) in self.queues[match_id]:
-                    del self.queues[match_id][id(queue)]
-                raise e
+                    notification = await queue.get()
+                    if "state" in notification:
+                        yield {"event": "state", "data": notification["state"]}
+                    elif notification.get("refresh"):
+                        yield {
+                            "event": "refresh",
+                            "data": json.dumps({"turn": notification["turn"]}),
+                        }
+                    else:
+                        yield {"event": "turn", "data": json.dumps(notification)}
+            finally:
+                self._unsubscribe(match_id, queue)
 
         return listener
+
+    def _subscribe(self, match_id: int, queue: Queue[Notification]) -> None:
+        if match_id not in self.queues:
+            self.channels_changed.set()
+        self.queues.setdefault(match_id, {})[id(queue)] = queue
+
+    def _unsubscribe(self, match_id: int, queue: Queue[Notification]) -> None:
+        subscribers = self.queues.get(match_id)
+        if subscribers is None:
+            return
+        subscribers.pop(id(queue), None)
+        if not subscribers:
+            del self.queues[match_id]
+            self.channels_changed.set()
+
+    def metrics(self) -> ListenerMetrics:
+        return ListenerMetrics(
+            matches=len(self.queues),
+            subscribers=sum(len(subscribers) for subscribers in self.queues.values()),
+            queued=sum(
+                queue.qsize()
+                for subscribers in self.queues.values()
+                for queue in subscribers.values()
+            ),
+            notifications=self.notifications,
+            merged=self.merged,
+            broadcasts=self.broadcasts,
+        )
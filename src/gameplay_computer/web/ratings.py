@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import databases
+
+from gameplay_computer.web import service
+
+
+async def async_main() -> None:
+    # The catch up at the end writes, so this has to be the primary.
+    database_url = os.environ.get("DATABASE_URL")
+    assert database_url is not None
+
+    database = databases.Database(database_url)
+    await database.connect()
+    try:
+        start = time.monotonic()
+        replayed = await service.recompute_ratings(database)
+        logging.info("replayed %s matches in %.1fs", replayed, time.monotonic() - start)
+    finally:
+        await database.disconnect()
+
+
+def main() -> None:
+    argparse.ArgumentParser(
+        description="Recompute every agent's rating from the match history."
+    ).parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
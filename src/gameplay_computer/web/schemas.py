@@ -1,8 +1,13 @@
+from datetime import datetime
 from typing import Literal, Self
 
-from fastapi import Form
+from fastapi import Form, Query
 from pydantic import BaseModel, HttpUrl
 
+from gameplay_computer.gameplay import AgentProtocol, AgentTransport
+from gameplay_computer.matches import MatchStatus
+from gameplay_computer.tournaments import TournamentFormat
+
 
 class MatchCreate(BaseModel):
     game: Literal["connect4"]
@@ -28,6 +33,13 @@ class MatchCreate(BaseModel):
             player_name_2=player_name_2,
         )
 
+    @property
+    def interactive(self) -> bool:
+        """
+        A user is playing, not just agents.
+        """
+        return "agent" != self.player_type_1 or "agent" != self.player_type_2
+
 
 class TurnCreate(BaseModel):
     player: int
@@ -45,13 +57,133 @@ class TurnCreate(BaseModel):
 class AgentCreate(BaseModel):
     game: Literal["connect4"]
     agentname: str
-    url: HttpUrl
+    transport: AgentTransport = "http"
+    url: HttpUrl | None = None
+    protocol: AgentProtocol = "match"
+    speculative: bool = False
+    deterministic: bool = False
+    batch_url: HttpUrl | None = None
+    source: str | None = None
 
     @classmethod
     def as_form(
         cls,
         game: Literal["connect4"] = Form(...),
         agentname: str = Form(...),
-        url: HttpUrl = Form(...),
+        transport: AgentTransport = Form("http"),
+        # Empty for websocket agents.
+        url: str = Form(""),
+        protocol: AgentProtocol = Form("match"),
+        speculative: bool = Form(False),
+        deterministic: bool = Form(False),
+        # Empty when the agent has no batch url.
+        batch_url: str = Form(""),
+        # Only for hosted agents.
+        source: str = Form(""),
+    ) -> Self:
+        return cls(
+            game=game,
+            agentname=agentname,
+            transport=transport,
+            url=url or None,
+            protocol=protocol,
+            speculative=speculative,
+            deterministic=deterministic,
+            batch_url=batch_url or None,
+            source=source or None,
+        )
+
+
+class TournamentCreate(BaseModel):
+    game: Literal["connect4"]
+    format: TournamentFormat
+    # username/agentname, empty for every agent of the game.
+    agents: list[str] = []
+    # username/agentname, only for gauntlets.
+    champion: str | None = None
+    rounds: int = 1
+    games_per_pairing: int = 2
+    max_matches_per_agent: int = 4
+
+    @classmethod
+    def as_form(
+        cls,
+        game: Literal["connect4"] = Form(...),
+        format: TournamentFormat = Form(...),
+        agents: list[str] = Form([]),
+        champion: str = Form(""),
+        rounds: int = Form(1),
+        games_per_pairing: int = Form(2),
+        max_matches_per_agent: int = Form(4),
+    ) -> Self:
+        return cls(
+            game=game,
+            format=format,
+            agents=agents,
+            champion=champion or None,
+            rounds=rounds,
+            games_per_pairing=games_per_pairing,
+            max_matches_per_agent=max_matches_per_agent,
+        )
+
+
+class MatchExport(BaseModel):
+    format: Literal["ndjson", "csv"] = "ndjson"
+    game: Literal["connect4"] | None = None
+    # username/agentname
+    agent: str | None = None
+    status: MatchStatus | None = None
+    created_after: datetime | None = None
+    created_before: datetime | None = None
+
+    @classmethod
+    def as_query(
+        cls,
+        format: Literal["ndjson", "csv"] = Query("ndjson"),
+        game: Literal["connect4"] | None = Query(None),
+        agent: str | None = Query(None),
+        status: MatchStatus | None = Query(None),
+        created_after: datetime | None = Query(None),
+        created_before: datetime | None = Query(None),
     ) -> Self:
-        return cls(game=game, agentname=agentname, url=url)
+        return cls(
+            format=format,
+            game=game,
+            agent=agent,
+            status=status,
+            created_after=created_after,
+            created_before=created_before,
+        )
+
+
+class QueueMetrics(BaseModel):
+    queue: str
+    # Jobs due that no worker has picked up yet.
+    waiting: int
+    # Jobs deferred to later, like retries.
+    scheduled: int
+    running: int
+    # How long the oldest waiting job has been due, 0 with none waiting.
+    oldest_waiting_seconds: float
+
+
+class ListenerMetrics(BaseModel):
+    # Matches with at least one subscriber.
+    matches: int
+    subscribers: int
+    # Notifications waiting for slow subscribers, at most one each.
+    queued: int
+    # Since the process started.
+    notifications: int
+    # Notifications merged into one the subscriber hadn't read yet.
+    merged: int
+    # Match states rendered once and sent to every subscriber.
+    broadcasts: int
+
+
+class FragmentCacheMetrics(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    hit_rate: float
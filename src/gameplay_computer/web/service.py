@@ -1,12 +1,24 @@
-from typing import assert_never
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator, assert_never
 
 from databases import Database
+from fastapi import HTTPException, WebSocket, status
 from httpx import AsyncClient
 
-from gameplay_computer import agents, matches, users
-from gameplay_computer.gameplay import Agent, Connect4Action, Match, User
+from gameplay_computer import agents, matches, tournaments, users
+from gameplay_computer.gameplay import Agent, Connect4Action, Game, Match, User
 
-from .schemas import AgentCreate, MatchCreate, TurnCreate
+from .schemas import (
+    AgentCreate,
+    MatchCreate,
+    MatchExport,
+    QueueMetrics,
+    TournamentCreate,
+    TurnCreate,
+)
 
 
 async def get_users() -> list[users.FullUser]:
@@ -19,13 +31,40 @@ async def get_agents(
     return await agents.list_agents(database)
 
 
+async def get_agent_stats(
+    database: Database, username: str, agentname: str
+) -> agents.AgentStats:
+    return await agents.get_agent_stats(database, username, agentname)
+
+
+async def list_agent_stats(database: Database) -> list[agents.AgentStats]:
+    return await agents.list_agent_stats(database)
+
+
 async def create_agent(
     database: Database, created_by_user_id: str, new_agent: AgentCreate
-) -> int:
+) -> tuple[int, str | None]:
+    """
+    Returns the token websocket agents connect with, it can't be shown again.
+    """
+    token = token_hash = None
+    if new_agent.transport == "websocket":
+        token, token_hash = agents.new_agent_token()
     agent_id = await agents.create_agent(
-        database, created_by_user_id, new_agent.game, new_agent.agentname, new_agent.url
+        database,
+        created_by_user_id,
+        new_agent.game,
+        new_agent.agentname,
+        new_agent.url,
+        protocol=new_agent.protocol,
+        speculative=new_agent.speculative,
+        deterministic=new_agent.deterministic,
+        batch_url=new_agent.batch_url,
+        transport=new_agent.transport,
+        token_hash=token_hash,
+        source=new_agent.source,
     )
-    return agent_id
+    return agent_id, token
 
 
 async def delete_agent(
@@ -34,17 +73,164 @@ async def delete_agent(
     return await agents.delete_agent(database, deleted_by_user_id, username, agentname)
 
 
+async def serve_agent_socket(database: Database, websocket: WebSocket) -> None:
+    await agents.serve_agent_socket(database, websocket)
+
+
+async def get_queue_metrics(database: Database) -> list[QueueMetrics]:
+    """
+    Depth and age of the worker queues, from procrastinate's jobs table. A
+    job's due time is when it was scheduled for, or deferred if it wasn't.
+    """
+    queues_r = await database.fetch_all(
+        query="""
+        with jobs as (
+            select
+                j.queue_name,
+                j.status,
+                coalesce(j.scheduled_at, e.at) as due_at
+            from procrastinate_jobs j
+            left join procrastinate_events e
+                on e.job_id = j.id and e.type = 'deferred'
+            where j.status in ('todo', 'doing')
+        )
+        select
+            queue_name,
+            count(*) filter (
+                where status = 'todo' and (due_at is null or due_at <= now())
+            ) as waiting,
+            count(*) filter (where status = 'todo' and due_at > now()) as scheduled,
+            count(*) filter (where status = 'doing') as running,
+            coalesce(
+                extract(epoch from now() - min(due_at) filter (
+                    where status = 'todo' and due_at <= now()
+                )),
+                0
+            ) as oldest_waiting_seconds
+        from jobs
+        group by queue_name
+        order by queue_name
+        """
+    )
+    return [
+        QueueMetrics(
+            queue=queue_r["queue_name"],
+            waiting=queue_r["waiting"],
+            scheduled=queue_r["scheduled"],
+            running=queue_r["running"],
+            oldest_waiting_seconds=float(queue_r["oldest_waiting_seconds"]),
+        )
+        for queue_r in queues_r
+    ]
+
+
 async def get_matches(database: Database, user_id: str) -> list[matches.MatchSummary]:
     return await matches.list_match_summaries_for_user(database, user_id)
 
 
 async def get_match(
-    database: Database, match_id: int, turn: int | None = None
+    database: Database,
+    match_id: int,
+    turn: int | None = None,
+    primary: Database | None = None,
+    min_turn: int | None = None,
 ) -> Match:
-    match = await matches.get_match_by_id(database, match_id, turn=turn)
+    match = await matches.get_match_by_id(
+        database, match_id, turn=turn, primary=primary, min_turn=min_turn
+    )
     return match
 
 
+def get_viewer_seats(match: Match, username: str) -> tuple[int, ...]:
+    """
+    The players of match the user plays, none for spectators.
+    """
+    return tuple(
+        number
+        for number, player in enumerate(match.players)
+        if player.kind == "user" and player.username == username
+    )
+
+
+_EXPORT_CSV_COLUMNS = [
+    "match_id",
+    "game",
+    "status",
+    "winner",
+    "blue",
+    "red",
+    "match_created_at",
+    "match_finished_at",
+    "number",
+    "player",
+    "action",
+    "next_player",
+    "state",
+    "created_at",
+]
+
+
+async def export_matches(database: Database, export: MatchExport) -> AsyncIterator[str]:
+    """
+    Stream match turns as ndjson (one turn per line) or csv (one turn per row).
+    The export is checked here, before anything is streamed, errors once the
+    response has started can only cut it short.
+    """
+    agent_id = None
+    if export.agent is not None:
+        username, _, agentname = export.agent.partition("/")
+        if not username or not agentname:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="agent has to be username/agentname.",
+            )
+        agent_id = await agents.get_agent_id_for_username_and_agentname(
+            database, username, agentname
+        )
+
+    exported_turns = matches.export_match_turns(
+        database,
+        game=export.game,
+        agent_id=agent_id,
+        match_status=export.status,
+        created_after=export.created_after,
+        created_before=export.created_before,
+    )
+    return _format_exported_turns(export, exported_turns)
+
+
+async def _format_exported_turns(
+    export: MatchExport, exported_turns: AsyncIterator[matches.ExportedTurn]
+) -> AsyncIterator[str]:
+    match export.format:
+        case "ndjson":
+            async for exported_turn in exported_turns:
+                yield exported_turn.json() + "\n"
+        case "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(_EXPORT_CSV_COLUMNS)
+            yield buffer.getvalue()
+            async for exported_turn in exported_turns:
+                buffer.seek(0)
+                buffer.truncate()
+                row = exported_turn.dict()
+                row["action"] = json.dumps(row["action"])
+                row["state"] = json.dumps(row["state"])
+                writer.writerow(row[column] for column in _EXPORT_CSV_COLUMNS)
+                yield buffer.getvalue()
+        case _format as unknown:
+            assert_never(unknown)
+
+
+async def get_position_occurrences(
+    database: Database, position: str, limit: int = 100
+) -> list[matches.PositionOccurrence]:
+    return await matches.list_position_occurrences(
+        database, "connect4", position, limit=limit
+    )
+
+
 async def create_match(
     database: Database, created_by_user_id: str, new_match: MatchCreate
 ) -> int:
@@ -101,8 +287,202 @@ async def take_turn(
     )
 
 
-async def take_ai_turns(database: Database, client: AsyncClient, match_id: int) -> None:
+async def take_speculated_ai_turn(database: Database, match: Match) -> Match:
+    """
+    Play the agent's reply right away if it was fetched while the user was
+    thinking. Otherwise the match is returned as is for run_ai_turns.
+    """
+    player = match.state.next_player
+    if match.status != "in_progress" or match.state.over or player is None:
+        return match
+    agent = match.players[player]
+    if not isinstance(agent, Agent):
+        return match
+    action = await agents.get_speculated_action(database, agent, match)
+    if action is None:
+        return match
+    return await matches.take_action(database, match, player, action, actor=agent)
+
+
+async def get_speculative_agent(database: Database, match: Match) -> Agent | None:
+    """
+    The agent that moves after the user whose turn it is, if it can be asked
+    for its replies ahead.
+    """
+    player = match.state.next_player
+    if match.status != "in_progress" or match.state.over or player is None:
+        return None
+    if not isinstance(match.players[player], User):
+        return None
+    agent = match.players[(player + 1) % len(match.players)]
+    if not isinstance(agent, Agent):
+        return None
+    agent_id = await agents.get_agent_id_for_username_and_agentname(
+        database, agent.username, agent.agentname
+    )
+    deployment = await agents.get_agent_deployment(database, agent_id)
+    if not deployment.speculative:
+        return None
+    return agent
+
+
+async def speculate_ai_turns(
+    database: Database, client: AsyncClient, match_id: int, turn: int
+) -> int:
     match = await get_match(database, match_id)
+    if match.turn != turn:
+        # The user already moved.
+        return 0
+    agent = await get_speculative_agent(database, match)
+    if agent is None:
+        return 0
+    return await agents.speculate_agent_replies(database, client, agent, match)
+
+
+async def list_agent_ratings(
+    database: Database, game: Game, limit: int, offset: int
+) -> list[agents.AgentRating]:
+    return await agents.list_agent_ratings(database, game, limit=limit, offset=offset)
+
+
+async def recompute_ratings(database: Database) -> int:
+    """
+    Replay every rated match and replace the ratings. Most of the matches are
+    read without holding anything up, then the ones that finished meanwhile
+    are caught up on with the ratings table locked. Returns how many matches
+    were replayed.
+    """
+    ratings = agents.Ratings()
+    after = None
+    replayed = 0
+    async for match in matches.iterate_rated_matches(database):
+        ratings.add_match(match.game, match.agent_id_0, match.agent_id_1, match.winner)
+        after = (match.finished_at, match.id)
+        replayed += 1
+
+    async with database.transaction():
+        await agents.lock_agent_ratings(database)
+        async for match in matches.iterate_rated_matches(database, after=after):
+            ratings.add_match(
+                match.game, match.agent_id_0, match.agent_id_1, match.winner
+            )
+            replayed += 1
+        await agents.replace_agent_ratings(database, ratings)
+    return replayed
+
+
+async def create_tournament(
+    database: Database, created_by_user_id: str, new_tournament: TournamentCreate
+) -> int:
+    """
+    With no agents picked every agent that plays the game is entered.
+    """
+    tournament_agents = []
+    for name in new_tournament.agents:
+        username, agentname = name.split("/")
+        tournament_agents.append(
+            await agents.get_agent_by_username_and_agentname(
+                database, username, agentname
+            )
+        )
+    if not tournament_agents:
+        tournament_agents = [
+            agent
+            for agent in await agents.list_agents(database)
+            if agent.game == new_tournament.game
+        ]
+    champion = None
+    if new_tournament.champion is not None:
+        username, agentname = new_tournament.champion.split("/")
+        champion = await agents.get_agent_by_username_and_agentname(
+            database, username, agentname
+        )
+    return await tournaments.create_tournament(
+        database,
+        created_by_user_id,
+        new_tournament.game,
+        new_tournament.format,
+        tournament_agents,
+        champion=champion,
+        rounds=new_tournament.rounds,
+        games_per_pairing=new_tournament.games_per_pairing,
+        max_matches_per_agent=new_tournament.max_matches_per_agent,
+    )
+
+
+async def get_tournament(
+    database: Database, tournament_id: int
+) -> tournaments.Tournament:
+    return await tournaments.get_tournament(database, tournament_id)
+
+
+async def schedule_tournament(
+    database: Database, tournament_id: int
+) -> list[tournaments.ScheduledMatch]:
+    return await tournaments.schedule_tournament(database, tournament_id)
+
+
+async def record_tournament_result(database: Database, match_id: int) -> int | None:
+    return await tournaments.record_match_result(database, match_id)
+
+
+async def record_missed_tournament_results(database: Database) -> set[int]:
+    return await tournaments.record_missed_results(database)
+
+
+async def list_running_tournaments(database: Database) -> list[int]:
+    return await tournaments.list_running_tournaments(database)
+
+
+async def list_running_tournament_matches(
+    database: Database, tournament_id: int
+) -> list[tournaments.ScheduledMatch]:
+    return await tournaments.list_running_matches(database, tournament_id)
+
+
+async def set_agent_error(database: Database, match_id: int) -> None:
+    await matches.set_agent_error(database, match_id)
+
+
+async def record_agent_failure(database: Database, match_id: int, turn: int) -> int:
+    return await matches.record_agent_failure(database, match_id, turn)
+
+
+async def set_agent_retry_delay(
+    database: Database, match_id: int, delay: float
+) -> None:
+    await matches.set_agent_retry_delay(database, match_id, delay)
+
+
+async def get_agent_retry_delay(database: Database, match_id: int) -> float:
+    return await matches.get_agent_retry_delay(database, match_id)
+
+
+async def _get_agent_id(
+    database: Database, agent_ids: dict[int, int], player: int, agent: Agent
+) -> int:
+    # Look up each agent once per match, not once per turn.
+    if player not in agent_ids:
+        agent_ids[player] = await agents.get_agent_id_for_username_and_agentname(
+            database, agent.username, agent.agentname
+        )
+    return agent_ids[player]
+
+
+async def take_ai_turns(
+    database: Database, client: AsyncClient, match_id: int
+) -> Match:
+    """
+    Play agent turns until it's a user's turn or the match is over.
+    """
+    match = await get_match(database, match_id)
+    if match.status != "in_progress":
+        # A job deferred before the match ended.
+        return match
+    if all(isinstance(player, Agent) for player in match.players):
+        return await _take_agent_vs_agent_turns(database, client, match)
+
+    agent_ids: dict[int, int] = {}
     while True:
         if (
             match is not None
@@ -114,7 +494,15 @@ async def take_ai_turns(database: Database, client: AsyncClient, match_id: int)
             agent = match.players[match.state.next_player]
             assert isinstance(agent, Agent)
 
-            gp_action = await agents.get_agent_action(database, client, agent, match)
+            gp_action = await agents.get_agent_action(
+                database,
+                client,
+                agent,
+                match,
+                agent_id=await _get_agent_id(
+                    database, agent_ids, match.state.next_player, agent
+                ),
+            )
             action = Connect4Action(column=gp_action.column)
 
             match = await matches.take_action(
@@ -126,3 +514,48 @@ async def take_ai_turns(database: Database, client: AsyncClient, match_id: int)
             )
         else:
             break
+    return match
+
+
+# Agent vs agent turns are played in memory and saved this many at a time.
+ai_turn_batch_size = int(os.environ.get("AI_TURN_BATCH_SIZE", "8"))
+
+
+async def _take_agent_vs_agent_turns(
+    database: Database, client: AsyncClient, match: Match
+) -> Match:
+    """
+    Nobody has to wait on the database between agent turns so the match is
+    kept in memory and turns are written in batches. Spectators get a notify
+    for every batch. Whatever's been played is saved if an agent fails.
+    """
+    agent_ids: dict[int, int] = {}
+    pending: list[matches.PendingTurn] = []
+    try:
+        while (
+            match.status == "in_progress"
+            and match.state.over is False
+            and match.state.next_player is not None
+        ):
+            player = match.state.next_player
+            agent = match.players[player]
+            assert isinstance(agent, Agent)
+
+            gp_action = await agents.get_agent_action(
+                database,
+                client,
+                agent,
+                match,
+                agent_id=await _get_agent_id(database, agent_ids, player, agent),
+            )
+            action = Connect4Action(column=gp_action.column)
+            pending.append(matches.apply_action(match, player, action, actor=agent))
+
+            if len(pending) >= ai_turn_batch_size:
+                batch, pending = pending, []
+                await matches.save_turns(database, match.id, batch)
+    finally:
+        if pending:
+            batch, pending = pending, []
+            await matches.save_turns(database, match.id, batch)
+    return match
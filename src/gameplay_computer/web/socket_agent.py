@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+from typing import Any
+
+import websockets
+
+
+def choose_column(request: dict[str, Any]) -> int:
+    """
+    A random open column, from either protocol's request.
+    """
+    if "position" in request:
+        # compact/1, column by column from the bottom, "." for empty.
+        position = request["position"]
+        open_columns = [i for i in range(7) if position[i * 6 + 5] == "."]
+    else:
+        board = request["state"]["board"]
+        open_columns = [i for i in range(7) if board[i][5] == " "]
+    return random.choice(open_columns)
+
+
+async def run_agent(url: str, username: str, agentname: str, token: str) -> None:
+    """
+    Connect, register and answer requests, reconnecting when the connection
+    drops.
+    """
+    delay = 1.0
+    while True:
+        try:
+            async with websockets.connect(url) as websocket:
+                await websocket.send(
+                    json.dumps(
+                        {
+                            "type": "register",
+                            "username": username,
+                            "agentname": agentname,
+                            "token": token,
+                        }
+                    )
+                )
+                message = json.loads(await websocket.recv())
+                assert message["type"] == "registered"
+                logging.info("registered as %s/%s", username, agentname)
+                delay = 1.0
+                async for raw in websocket:
+                    message = json.loads(raw)
+                    match message["type"]:
+                        case "ping":
+                            await websocket.send(json.dumps({"type": "pong"}))
+                        case "request":
+                            column = choose_column(message["request"])
+                            await websocket.send(
+                                json.dumps(
+                                    {
+                                        "type": "action",
+                                        "id": message["id"],
+                                        "action": {"column": column},
+                                    }
+                                )
+                            )
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is not None and e.rcvd.code == 1008:
+                raise SystemExit("Registration refused, check the token.")
+            logging.info("connection closed: %s", e)
+        except OSError as e:
+            logging.info("can't connect: %s", e)
+        logging.info("reconnecting in %.0fs", delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="A random connect4 agent on the websocket transport."
+    )
+    parser.add_argument(
+        "--url", default="ws://localhost:8000/agents/connect", help="server url"
+    )
+    parser.add_argument("username")
+    parser.add_argument("agentname")
+    parser.add_argument("token")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_agent(args.url, args.username, args.agentname, args.token))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,21 @@
+import asyncio
+import contextlib
+import logging
 import os
+import random
+import time
+from collections import defaultdict, deque
+from typing import AsyncContextManager
 
 import databases
-import httpx
 import procrastinate
 import sentry_sdk
 
+from gameplay_computer import agents, tournaments
+
 from . import service
+from .backend import MemoryBackend, ProcrastinateBackend, TaskBackend
+from .limiter import AdaptiveLimiter
 
 database_url = os.environ.get("DATABASE_URL")
 if database_url is None:
@@ -21,11 +31,390 @@ async def test_task() -> None:
     print("Hello world")
 
 
-@app.task(queue="run_ai_turns")  # type: ignore
-async def run_ai_turns(traceparent: str, match_id: int) -> None:
+# Failed agent calls are retried by deferring a new job with exponential
+# backoff, nothing sleeps in a worker slot. After AGENT_MAX_ATTEMPTS failures
+# on the same turn the match ends with an agent error.
+max_attempts = int(os.environ.get("AGENT_MAX_ATTEMPTS", "5"))
+retry_base_delay = float(os.environ.get("AGENT_RETRY_BASE_DELAY", "1"))
+retry_max_delay = float(os.environ.get("AGENT_RETRY_MAX_DELAY", "60"))
+
+
+def retry_delay(attempt: int) -> float:
+    """
+    Exponential backoff with jitter, between half and all of the full delay.
+    """
+    delay = min(retry_max_delay, retry_base_delay * 2.0**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Matches with a user playing go to their own queue so the reply to a user's
+# move doesn't wait behind agent vs agent matches. The worker gives each
+# queue its own slots (see worker.worker_slots).
+interactive_queue = "ai_turns_interactive"
+batch_queue = "ai_turns_batch"
+
+
+def ai_turns_queue(interactive: bool, shard: int | None = None) -> str:
+    """
+    Tournaments can spread their matches over sharded batch queues,
+    ai_turns_batch_0, ai_turns_batch_1... so each shard can be given to
+    different workers.
+    """
+    if interactive:
+        return interactive_queue
+    if shard is None:
+        return batch_queue
+    return f"{batch_queue}_{shard}"
+
+
+def ai_turns_queues() -> list[str]:
+    """
+    Every queue ai_turns_queue can pick, for the tournament shards too.
+    """
+    queues = [interactive_queue, batch_queue]
+    if tournaments.shards > 1:
+        queues += [ai_turns_queue(False, shard) for shard in range(tournaments.shards)]
+    return queues
+
+
+def worker_slots() -> list[tuple[list[str] | None, int]]:
+    """
+    Which queues get how many job slots, from WORKER_SLOTS. Groups are
+    separated by ";", each one is comma separated queues, a ":" and how many
+    of their jobs can run at once. "*" is every queue.
+    The default keeps slots for users' matches that batch work can't take,
+    the batch queue and the tournament shards share theirs.
+    With TOURNAMENT_SHARDS set, tournament matches go to ai_turns_batch_0,
+    ai_turns_batch_1... instead, give each worker its shards, like
+    WORKER_SLOTS="ai_turns_interactive:20;ai_turns_batch,ai_turns_batch_0:10;..."
+    Without WORKER_SLOTS, WORKER_CONCURRENCY is one group for every queue.
+    Either way WORKER_QUEUES, comma separated, narrows the worker down to
+    some queues, so different machines can run different queues.
+    """
+    slots = os.environ.get("WORKER_SLOTS")
+    if slots is None:
+        worker_concurrency = os.environ.get("WORKER_CONCURRENCY")
+        if worker_concurrency is not None:
+            slots = f"*:{worker_concurrency}"
+        else:
+            batch_queues = ",".join(
+                queue for queue in ai_turns_queues() if queue != interactive_queue
+            )
+            slots = (
+                f"{interactive_queue}:20;"
+                f"{batch_queues}:10;"
+                "speculate_ai_turns,agent_health,tournaments,run_ai_turns,test:5"
+            )
+    groups: list[tuple[list[str] | None, int]] = []
+    for group in slots.split(";"):
+        names, size = group.rsplit(":", 1)
+        groups.append((None if names == "*" else names.split(","), int(size)))
+
+    only = os.environ.get("WORKER_QUEUES")
+    if only is None:
+        return groups
+    wanted = only.split(",")
+    narrowed: list[tuple[list[str] | None, int]] = []
+    for queues, concurrency in groups:
+        kept = wanted if queues is None else [q for q in queues if q in wanted]
+        if kept:
+            narrowed.append((kept, concurrency))
+    return narrowed
+
+
+class QueueLatency:
+    """
+    How long the last jobs of a queue waited between being due and starting.
+    """
+
+    def __init__(self, size: int = 1000):
+        self.waits: deque[float] = deque(maxlen=size)
+        self.jobs = 0
+
+    def record(self, wait: float) -> None:
+        self.waits.append(wait)
+        self.jobs += 1
+
+    def summary(self) -> dict[str, float | int]:
+        waits = sorted(self.waits)
+        if not waits:
+            return {"jobs": self.jobs}
+        return {
+            "jobs": self.jobs,
+            "p50": waits[len(waits) // 2],
+            "p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))],
+            "max": waits[-1],
+        }
+
+
+queue_latency: dict[str, QueueLatency] = defaultdict(QueueLatency)
+
+# Set by the worker when it tunes how many batch matches run at once itself,
+# see worker.async_main.
+batch_limiter: AdaptiveLimiter | None = None
+
+
+def _ai_turns_slot(interactive: bool) -> AsyncContextManager[None]:
+    if interactive or batch_limiter is None:
+        return contextlib.nullcontext()
+    return batch_limiter.slot()
+
+
+async def defer_ai_turns(
+    traceparent: str,
+    match_id: int,
+    interactive: bool = True,
+    delay: float | None = None,
+    shard: int | None = None,
+) -> None:
+    """
+    interactive is for matches with a user playing, shard for tournament
+    matches.
+    At most one job runs and one waits per match. The lock keeps a second
+    job from running until the first is done, the queueing lock makes
+    deferring a third one a no op, the waiting job plays whatever it would
+    have. Failed attempts and the retry delay are kept with the match so the
+    waiting job doesn't start them over.
+    """
+    deferred = await backend.defer(
+        run_ai_turns,
+        queue=ai_turns_queue(interactive, shard),
+        lock=f"match:{match_id}",
+        queueing_lock=f"match:{match_id}",
+        delay=delay,
+        traceparent=traceparent,
+        match_id=match_id,
+        interactive=interactive,
+        due_at=time.time() + (delay or 0),
+        shard=shard,
+    )
+    if not deferred:
+        logging.info("match %s: already has a job waiting", match_id)
+
+
+@app.task(queue=interactive_queue)  # type: ignore
+async def run_ai_turns(
+    traceparent: str,
+    match_id: int,
+    interactive: bool = True,
+    due_at: float | None = None,
+    shard: int | None = None,
+) -> None:
+    """
+    due_at is when the job was meant to start, to measure queue latency.
+    """
+    if due_at is not None:
+        queue_latency[ai_turns_queue(interactive, shard)].record(
+            max(0.0, time.time() - due_at)
+        )
     tx = sentry_sdk.tracing.Transaction.continue_from_headers(
         {"sentry-trace": traceparent}, op="task", name="run_ai_turns"
     )
     with sentry_sdk.start_transaction(tx):
-        async with httpx.AsyncClient() as client:
-            await service.take_ai_turns(database, client, match_id)
+        # A job that was already waiting when an agent failed runs as soon as
+        # the failed one is done, it waits out the retry delay instead.
+        delay = await service.get_agent_retry_delay(database, match_id)
+        if delay > 0:
+            await defer_ai_turns(
+                traceparent,
+                match_id,
+                interactive=interactive,
+                delay=delay,
+                shard=shard,
+            )
+            return
+        try:
+            async with _ai_turns_slot(interactive):
+                match = await service.take_ai_turns(
+                    database, agents.get_agent_client(), match_id
+                )
+        except agents.AgentBusy as e:
+            # Give the slot back and pick the match up again in a bit instead
+            # of waiting on a slow agent. Doesn't count as an attempt.
+            logging.info("match %s: %s, deferring", match_id, e)
+            await defer_ai_turns(
+                traceparent,
+                match_id,
+                interactive=interactive,
+                delay=1 + random.random(),
+                shard=shard,
+            )
+        except agents.AgentError as e:
+            # Starts over if the agent made progress since the last failure.
+            attempt = await service.record_agent_failure(database, match_id, e.turn)
+            if attempt >= max_attempts:
+                logging.warning("match %s: %s, giving up", match_id, e)
+                await service.set_agent_error(database, match_id)
+                await _record_tournament_result(traceparent, match_id)
+                return
+            delay = retry_delay(attempt)
+            logging.info("match %s: %s, retry %s in %.1fs", match_id, e, attempt, delay)
+            await service.set_agent_retry_delay(database, match_id, delay)
+            await defer_ai_turns(
+                traceparent,
+                match_id,
+                interactive=interactive,
+                delay=delay,
+                shard=shard,
+            )
+        else:
+            if match.status == "finished":
+                await _record_tournament_result(traceparent, match_id)
+            # The user is up next, get the agent's replies ready if it allows
+            # it.
+            elif await service.get_speculative_agent(database, match) is not None:
+                await backend.defer(
+                    speculate_ai_turns,
+                    traceparent=traceparent,
+                    match_id=match_id,
+                    turn=match.turn,
+                )
+
+
+async def _record_tournament_result(traceparent: str, match_id: int) -> None:
+    tournament_id = await service.record_tournament_result(database, match_id)
+    if tournament_id is not None:
+        # An agent has room for another match.
+        await defer_schedule_tournament(traceparent, tournament_id)
+
+
+async def defer_schedule_tournament(traceparent: str, tournament_id: int) -> None:
+    """
+    One scheduling pass runs at a time per tournament and at most one more
+    waits, it picks up everything that finished in the meantime.
+    """
+    deferred = await backend.defer(
+        schedule_tournament,
+        lock=f"tournament:{tournament_id}",
+        queueing_lock=f"tournament:{tournament_id}",
+        traceparent=traceparent,
+        tournament_id=tournament_id,
+    )
+    if not deferred:
+        logging.info("tournament %s: already has a scheduler waiting", tournament_id)
+
+
+@app.task(queue="tournaments")  # type: ignore
+async def schedule_tournament(traceparent: str, tournament_id: int) -> None:
+    tx = sentry_sdk.tracing.Transaction.continue_from_headers(
+        {"sentry-trace": traceparent}, op="task", name="schedule_tournament"
+    )
+    with sentry_sdk.start_transaction(tx):
+        scheduled = await service.schedule_tournament(database, tournament_id)
+        for match in scheduled:
+            await defer_ai_turns(
+                traceparent, match.match_id, interactive=False, shard=match.shard
+            )
+        if scheduled:
+            logging.info(
+                "tournament %s: started %s matches", tournament_id, len(scheduled)
+            )
+
+
+@app.periodic(cron="* * * * *")  # type: ignore
+@app.task(queue="tournaments", queueing_lock="resume_tournaments")  # type: ignore
+async def resume_tournaments(timestamp: int) -> None:
+    """
+    Picks up whatever a worker that went away left behind. Counts finished
+    matches it didn't get to, restarts the turns of running matches (a no op
+    for the ones that have a job) and schedules every running tournament.
+    """
+    with sentry_sdk.start_transaction(op="task", name="resume_tournaments") as tx:
+        traceparent = tx.to_traceparent()
+        await service.record_missed_tournament_results(database)
+        for tournament_id in await service.list_running_tournaments(database):
+            for match in await service.list_running_tournament_matches(
+                database, tournament_id
+            ):
+                await defer_ai_turns(
+                    traceparent, match.match_id, interactive=False, shard=match.shard
+                )
+            await defer_schedule_tournament(traceparent, tournament_id)
+
+
+@app.task(queue="speculate_ai_turns")  # type: ignore
+async def speculate_ai_turns(traceparent: str, match_id: int, turn: int) -> None:
+    tx = sentry_sdk.tracing.Transaction.continue_from_headers(
+        {"sentry-trace": traceparent}, op="task", name="speculate_ai_turns"
+    )
+    with sentry_sdk.start_transaction(tx):
+        await service.speculate_ai_turns(
+            database, agents.get_agent_client(), match_id, turn
+        )
+
+
+@app.periodic(cron="* * * * *")  # type: ignore
+@app.task(queue="agent_health", queueing_lock="probe_unhealthy_agents")  # type: ignore
+async def probe_unhealthy_agents(timestamp: int) -> None:
+    await agents.probe_unhealthy_agents(database, agents.get_agent_client())
+
+
+def _task_backend() -> TaskBackend:
+    """
+    See backend.py. The memory backend's queues hold at most
+    TASK_QUEUE_SIZE jobs each, default 10000.
+    """
+    match os.environ.get("TASK_BACKEND", "procrastinate"):
+        case "procrastinate":
+            return ProcrastinateBackend(app)
+        case "memory":
+            return MemoryBackend(
+                worker_slots(),
+                queue_size=int(os.environ.get("TASK_QUEUE_SIZE", "10000")),
+                periodic=[probe_unhealthy_agents, resume_tournaments],
+                queues=[
+                    *ai_turns_queues(),
+                    *(task.queue for task in app.tasks.values()),
+                ],
+            )
+        case unknown:
+            raise ValueError(f"Unknown TASK_BACKEND {unknown}.")
+
+
+backend = _task_backend()
+
+
+async def log_agent_metrics() -> None:
+    """
+    Every minute, log the agent and queue metrics and write the agent calls
+    recorded in this process to the database. Runs wherever agents are
+    called, the worker or the web process with the memory backend.
+    """
+    while True:
+        await asyncio.sleep(60)
+        logging.info("agent client: %s", agents.agent_client_metrics().json())
+        for bulkhead in agents.bulkhead_metrics():
+            logging.info("bulkhead: %s", bulkhead.json())
+        logging.info("response cache: %s", agents.response_cache_metrics().json())
+        await agents.flush_agent_stats(database)
+        for queue, latency in queue_latency.items():
+            logging.info("queue %s latency: %s", queue, latency.summary())
+        if batch_limiter is not None:
+            logging.info("batch limiter: %s", batch_limiter.summary())
+
+
+_metrics_task: asyncio.Task[None] | None = None
+
+
+async def open_backend() -> None:
+    """
+    For the web process. With the memory backend the tasks run here too and
+    need their database, and their agent stats flushed.
+    """
+    global _metrics_task
+    if isinstance(backend, MemoryBackend):
+        await database.connect()
+        _metrics_task = asyncio.create_task(log_agent_metrics())
+    await backend.open()
+
+
+async def close_backend() -> None:
+    global _metrics_task
+    await backend.close()
+    if isinstance(backend, MemoryBackend):
+        if _metrics_task is not None:
+            _metrics_task.cancel()
+            await asyncio.gather(_metrics_task, return_exceptions=True)
+            _metrics_task = None
+        await agents.flush_agent_stats(database)
+        await database.disconnect()
@@ -1,10 +1,63 @@
 import asyncio
 import logging
+import multiprocessing
 import os
+import signal
+from types import FrameType
 
 import sentry_sdk
 
+from gameplay_computer import agents
 from gameplay_computer.web import tasks
+from gameplay_computer.web.backend import ProcrastinateBackend
+from gameplay_computer.web.limiter import AdaptiveLimiter
+from gameplay_computer.web.listener import Listener
+
+
+def _is_batch_group(queues: list[str] | None) -> bool:
+    return queues is not None and all(
+        queue.startswith(tasks.batch_queue) for queue in queues
+    )
+
+
+def autotune_slots(
+    groups: list[tuple[list[str] | None, int]]
+) -> list[tuple[list[str] | None, int]]:
+    """
+    With WORKER_AUTOTUNE=1, the batch groups (only batch queues) take up to
+    WORKER_AUTOTUNE_MAX jobs and tasks.batch_limiter decides how many of them
+    play at once, starting from the configured concurrency. Every
+    WORKER_AUTOTUNE_INTERVAL seconds it aims for WORKER_AUTOTUNE_CPU of a
+    core, default 0.7. Users' matches keep their fixed slots.
+    """
+    if os.environ.get("WORKER_AUTOTUNE") != "1":
+        return groups
+    batch_concurrency = sum(
+        concurrency for queues, concurrency in groups if _is_batch_group(queues)
+    )
+    if batch_concurrency == 0:
+        return groups
+    max_limit = int(os.environ.get("WORKER_AUTOTUNE_MAX", "200"))
+    tasks.batch_limiter = AdaptiveLimiter(
+        limit=batch_concurrency,
+        min_limit=1,
+        max_limit=max_limit,
+        target_cpu=float(os.environ.get("WORKER_AUTOTUNE_CPU", "0.7")),
+    )
+    return [
+        (queues, max_limit if _is_batch_group(queues) else concurrency)
+        for queues, concurrency in groups
+    ]
+
+
+async def retune_batch_limiter(limiter: AdaptiveLimiter) -> None:
+    interval = float(os.environ.get("WORKER_AUTOTUNE_INTERVAL", "10"))
+    while True:
+        await asyncio.sleep(interval)
+        before = limiter.limit
+        after = await limiter.retune()
+        if after != before:
+            logging.info("batch limiter: %s", limiter.summary())
 
 
 async def async_main() -> None:
@@ -18,18 +71,86 @@ async def async_main() -> None:
             traces_sample_rate=1.0,
         )
 
+    if not isinstance(tasks.backend, ProcrastinateBackend):
+        raise SystemExit(
+            "The worker only runs procrastinate jobs, with TASK_BACKEND=memory"
+            " tasks run in the web process."
+        )
+
     # Start the worker
     await tasks.database.connect()
-    async with tasks.app.open_async():
-        await tasks.app.run_worker_async(concurrency=30)
-    await tasks.database.disconnect()
+    agents.open_agent_client()
+    # Hears about agent changes and the actions of websocket agents.
+    listener = Listener(str(tasks.database.url))
+    listener.start()
+    metrics_task = asyncio.create_task(tasks.log_agent_metrics())
+    slots = autotune_slots(tasks.worker_slots())
+    retune_task = None
+    if tasks.batch_limiter is not None:
+        retune_task = asyncio.create_task(retune_batch_limiter(tasks.batch_limiter))
+    try:
+        async with tasks.app.open_async():
+            await asyncio.gather(
+                *(
+                    tasks.app.run_worker_async(
+                        queues=queues,
+                        concurrency=concurrency,
+                        name=",".join(queues) if queues is not None else "all",
+                    )
+                    for queues, concurrency in slots
+                )
+            )
+    finally:
+        metrics_task.cancel()
+        if retune_task is not None:
+            retune_task.cancel()
+        await listener.stop()
+        await agents.flush_agent_stats(tasks.database)
+        await agents.close_agent_client()
+        await agents.close_sandbox()
+        await tasks.database.disconnect()
 
 
-def main() -> None:
+def run_worker() -> None:
     logging.basicConfig(level=logging.INFO)
     logging.info("Starting Worker")
     asyncio.run(async_main())
 
 
+def _run_forked_worker() -> None:
+    # Out of the terminal's process group so a ctrl-c only reaches the parent,
+    # which passes it on once.
+    os.setpgrp()
+    run_worker()
+
+
+def main() -> None:
+    """
+    WORKER_PROCESSES, default 1, forks that many workers to use more than one
+    core of a machine. They share nothing but the database.
+    """
+    processes = int(os.environ.get("WORKER_PROCESSES", "1"))
+    if processes <= 1:
+        run_worker()
+        return
+
+    # Fork before there's an event loop or any threads.
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_run_forked_worker) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum: int, frame: FrameType | None) -> None:
+        # Each worker finishes its jobs and exits.
+        for worker in workers:
+            if worker.pid is not None and worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.join()
+
+
 if __name__ == "__main__":
     main()
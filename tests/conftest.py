@@ -5,12 +5,15 @@ from unittest import mock
 
 import databases
 import pytest
-from fastapi import FastAPI
-from httpx import AsyncClient
+from fastapi import FastAPI, HTTPException, Request, status
+from httpx import ASGITransport, AsyncClient
 
+from gameplay_computer import users
 from gameplay_computer.gameplay import Action, Connect4Action, Connect4State, Match
 from gameplay_computer.users.repo import ClerkEmailAddress, ClerkUser
-from gameplay_computer.web.app_old import Auth, Listener, build_app
+from gameplay_computer.web.app import app
+from gameplay_computer.web.auth import AuthUser, auth
+from gameplay_computer.web.listener import Listener
 
 
 @pytest.fixture(autouse=True)
@@ -92,21 +95,62 @@ async def database(database_url: str) -> AsyncIterator[databases.Database]:
     return
 
 
+@pytest.fixture
+def read_database_url(database_url: str) -> str:
+    # A second local postgres can stand in for a replica. Without one, a
+    # separate connection to the test database works too, the force_rollback
+    # writes on the primary are never visible to it, just like replica lag.
+    return os.environ.get("TEST_READ_DATABASE_URL", database_url)
+
+
+@pytest.fixture
+async def read_database(read_database_url: str) -> AsyncIterator[databases.Database]:
+    read_database = databases.Database(read_database_url)
+    await read_database.connect()
+    assert read_database.is_connected
+    yield read_database
+    await read_database.disconnect()
+    assert not read_database.is_connected
+    return
+
+
 @pytest.fixture
 def listener(database_url: str) -> Listener:
     listener = Listener(database_url)
     return listener
 
 
+async def header_auth(request: Request) -> AuthUser:
+    """
+    Stands in for the Clerk session cookie, the Authorization header is the
+    user id.
+    """
+    user_id = request.headers.get("Authorization")
+    user = await users.get_user_by_id(user_id) if user_id else None
+    if user_id is None or user is None:
+        raise HTTPException(
+            status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+            headers={"Location": "/"},
+        )
+    return AuthUser(user_id=user_id, username=user.username)
+
+
 @pytest.fixture
 async def api(
-    database: databases.Database, listener: Listener
+    database: databases.Database,
+    listener: Listener,
+    monkeypatch: pytest.MonkeyPatch,
 ) -> AsyncIterator[AsyncClient]:
-    auth = Auth(None)
-
-    app = build_app(database, listener, auth)
-    async with AsyncClient(app=app, base_url="http://test") as api:
+    # The routes use the app module's database and listener, the client
+    # doesn't run the startup handler that would connect them.
+    monkeypatch.setattr("gameplay_computer.web.app.database", database)
+    monkeypatch.setattr("gameplay_computer.web.app.read_database", database)
+    monkeypatch.setattr("gameplay_computer.web.app.listener", listener)
+    app.dependency_overrides[auth] = header_auth
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as api:
         yield api
+    app.dependency_overrides.clear()
     return
 
 
@@ -130,6 +174,9 @@ async def build_test_agent_app() -> FastAPI:
 @pytest.fixture
 async def agent_api() -> AsyncIterator[AsyncClient]:
     agent_app = await build_test_agent_app()
-    async with AsyncClient(app=agent_app, base_url="http://test-agents.com") as api:
+    transport = ASGITransport(app=agent_app)
+    async with AsyncClient(
+        transport=transport, base_url="http://test-agents.com"
+    ) as api:
         yield api
     return
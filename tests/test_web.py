@@ -1,10 +1,34 @@
+import asyncio
+import json
+from typing import cast
+
 import databases
+import procrastinate
 import pytest
 from fastapi import HTTPException
 from httpx import AsyncClient
 
-from gameplay_computer import agents, matches, users
-from gameplay_computer.gameplay import Connect4Action
+from gameplay_computer import agents, matches, tournaments, users
+from gameplay_computer.agents import sockets
+from gameplay_computer.agents.cache import ResponseCache
+from gameplay_computer.agents.health import CircuitBreaker, CircuitState
+from gameplay_computer.agents.ratings import Ratings, elo_update
+from gameplay_computer.agents.stats import overflow_bucket_ms, percentile
+from gameplay_computer.tournaments.service import _round_robin_pairs, _swiss_pairs
+from gameplay_computer.web import service, tasks
+from gameplay_computer.web.backend import MemoryBackend
+from gameplay_computer.web.fragments import FragmentCache, FragmentKey
+from gameplay_computer.web.limiter import AdaptiveLimiter
+from gameplay_computer.web.listener import Listener
+from gameplay_computer.web.schemas import MatchExport
+from gameplay_computer.gameplay import (
+    Agent,
+    Connect4Action,
+    Connect4State,
+    Match,
+    Turn,
+    User,
+)
 
 
 async def test_database(database: databases.Database) -> None:
@@ -27,49 +51,46 @@ async def test_a_match(database: databases.Database, user_steve: str) -> None:
     match_id = await matches.create_match(
         database, user_steve, "connect4", [steve, steve]
     )
+    match = await matches.get_match_by_id(database, match_id)
     with pytest.raises(HTTPException):
         # player 0 goes first, not 1
         await matches.take_action(
             database,
-            match_id,
+            match,
             1,
             Connect4Action(column=0),
-            acting_user_id=user_steve,
+            actor=steve,
         )
-    await matches.take_action(
+    match = await matches.take_action(
         database,
-        match_id,
+        match,
         0,
         Connect4Action(column=0),
-        acting_user_id=user_steve,
+        actor=steve,
     )
-    await matches.take_action(
+    match = await matches.take_action(
         database,
-        match_id,
+        match,
         1,
         Connect4Action(column=1),
-        acting_user_id=user_steve,
+        actor=steve,
     )
-    match = await matches.get_match_by_id(database, match_id)
-    assert match is not None
     assert match.state.next_player == 0
     for _ in range(3):
-        await matches.take_action(
+        match = await matches.take_action(
             database,
-            match_id,
+            match,
             0,
             Connect4Action(column=2),
-            acting_user_id=user_steve,
+            actor=steve,
         )
-        await matches.take_action(
+        match = await matches.take_action(
             database,
-            match_id,
+            match,
             1,
             Connect4Action(column=1),
-            acting_user_id=user_steve,
+            actor=steve,
         )
-    match = await matches.get_match_by_id(database, match_id)
-    assert match is not None
     assert match.state.over is True
     assert match.state.winner == 1
     assert match.state.next_player is None
@@ -89,37 +110,38 @@ async def test_your_turn(
     match_id = await matches.create_match(
         database, user_steve, "connect4", [steve, gabe]
     )
-    await matches.take_action(
+    match = await matches.get_match_by_id(database, match_id)
+    match = await matches.take_action(
         database,
-        match_id,
+        match,
         0,
         Connect4Action(column=0),
-        acting_user_id=user_steve,
+        actor=steve,
     )
-    await matches.take_action(
+    match = await matches.take_action(
         database,
-        match_id,
+        match,
         1,
         Connect4Action(column=1),
-        acting_user_id=user_gabe,
+        actor=gabe,
     )
     with pytest.raises(HTTPException):
         # gabe tries to go again, no no gabe
         await matches.take_action(
             database,
-            match_id,
+            match,
             1,
             Connect4Action(column=1),
-            acting_user_id=user_gabe,
+            actor=gabe,
         )
     with pytest.raises(HTTPException):
         # gabe tries to go for steve, no way gabe
         await matches.take_action(
             database,
-            match_id,
+            match,
             0,
             Connect4Action(column=1),
-            acting_user_id=user_gabe,
+            actor=gabe,
         )
 
 
@@ -132,6 +154,7 @@ async def test_agents(
         "connect4",
         "random",
         "http://test-agents.com/connect4_random",
+        client=agent_api,
     )
     rand_agent = await agents.get_agent_by_id(database, agent_id)
     match_id = await matches.create_match(
@@ -150,3 +173,474 @@ async def test_agents(
             actor=rand_agent,
         )
         player = 1 if player == 0 else 0
+
+    # It played itself, both sides of the result count.
+    await agents.flush_agent_stats(database)
+    stats = await agents.get_agent_stats(database, "steve", "random")
+    history = stats.history
+    assert history.wins + history.losses + history.draws == 2
+    assert history.wins == history.losses
+    assert stats.calls.calls >= match.turn
+
+
+async def test_read_replica_fallback(
+    database: databases.Database, read_database: databases.Database, user_steve: str
+) -> None:
+    steve = await users.get_user_by_id(user_steve)
+    assert steve is not None
+    match_id = await matches.create_match(
+        database, user_steve, "connect4", [steve, steve]
+    )
+    match = await matches.get_match_by_id(database, match_id)
+    match = await matches.take_action(
+        database, match, 0, Connect4Action(column=3), actor=steve
+    )
+    # The replica hasn't seen the match, so it's read from the primary.
+    replica_match = await matches.get_match_by_id(
+        read_database, match_id, primary=database, min_turn=match.turn
+    )
+    assert replica_match.turn == match.turn
+    assert replica_match.state.board == match.state.board
+
+
+async def test_export_match_turns(
+    database: databases.Database, user_steve: str
+) -> None:
+    steve = await users.get_user_by_id(user_steve)
+    assert steve is not None
+    match_id = await matches.create_match(
+        database, user_steve, "connect4", [steve, steve]
+    )
+    match = await matches.get_match_by_id(database, match_id)
+    await matches.take_action(database, match, 0, Connect4Action(column=3), actor=steve)
+
+    exported = [
+        exported_turn
+        async for exported_turn in matches.export_match_turns(
+            database, game="connect4", match_status="in_progress"
+        )
+        if exported_turn.match_id == match_id
+    ]
+    assert [t.number for t in exported] == [0, 1]
+    assert all(t.blue == "steve" and t.red == "steve" for t in exported)
+    assert exported[1].action == 3
+
+    # Bad exports are turned down before the response starts.
+    for agent in ["steve", "steve/unknown"]:
+        with pytest.raises(HTTPException):
+            await service.export_matches(database, MatchExport(agent=agent))
+
+
+async def test_position_occurrences(
+    database: databases.Database, user_steve: str
+) -> None:
+    steve = await users.get_user_by_id(user_steve)
+    assert steve is not None
+    match_ids = [
+        await matches.create_match(database, user_steve, "connect4", [steve, steve])
+        for _ in range(2)
+    ]
+    for match_id in match_ids:
+        match = await matches.get_match_by_id(database, match_id)
+        await matches.take_action(
+            database, match, 0, Connect4Action(column=3), actor=steve
+        )
+
+    position = "." * 18 + "B" + "." * 23
+    occurrences = await matches.list_position_occurrences(
+        database, "connect4", position
+    )
+    assert {(o.match_id, o.turn) for o in occurrences} >= {
+        (match_id, 1) for match_id in match_ids
+    }
+
+
+def test_compact_match() -> None:
+    match = Match(
+        id=1,
+        players=[
+            User(username="steve"),
+            Agent(game="connect4", username="steve", agentname="random"),
+        ],
+        turns=[
+            Turn(number=0, player=None, action=None, next_player=0),
+            Turn(number=1, player=0, action=Connect4Action(column=3), next_player=1),
+            Turn(number=2, player=1, action=Connect4Action(column=2), next_player=0),
+            Turn(number=3, player=0, action=Connect4Action(column=3), next_player=1),
+        ],
+        turn=3,
+        state=Connect4State(
+            over=False,
+            winner=None,
+            next_player=1,
+            board=[[" "] * 6, [" "] * 6, ["R"] + [" "] * 5, ["B", "B"] + [" "] * 4]
+            + [[" "] * 6] * 3,
+        ),
+    )
+    compact = agents.compact_match(match)
+    assert compact.position == "." * 12 + "R" + "." * 5 + "BB" + "." * 22
+    assert [turn.number for turn in compact.turns] == [3]
+
+
+def test_circuit_breaker() -> None:
+    breaker = CircuitBreaker(window=60, min_requests=3, error_rate=0.5, cooldown=0)
+    assert breaker.record_success() is False
+    assert breaker.record_failure() is False
+    # 2 of 3 failed, over the error rate
+    assert breaker.record_failure() is True
+    assert breaker.state == CircuitState.OPEN
+    # cooldown is over right away, a trial call is let through
+    assert breaker.allow_request() is True
+    # mypy keeps the state narrowed to OPEN across the call.
+    assert breaker.state == CircuitState.HALF_OPEN  # type: ignore[comparison-overlap]
+    assert breaker.record_success() is True
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_response_cache() -> None:
+    cache = ResponseCache(max_size=2)
+    cache.put((1, "", "a"), Connect4Action(column=0))
+    cache.put((1, "", "b"), Connect4Action(column=1))
+    # a is now the most recently used
+    assert cache.get((1, "", "a")) == Connect4Action(column=0)
+    cache.put((1, "", "c"), Connect4Action(column=2))
+    assert cache.get((1, "", "b")) is None
+    assert cache.get((1, "", "a")) is not None
+    # another version of the agent doesn't share responses
+    assert cache.get((1, "v2", "a")) is None
+
+
+async def test_agent_socket_relay(database: databases.Database) -> None:
+    # The worker's side, the response would come through the listener.
+    request = asyncio.create_task(
+        sockets.request_action(database, 1, {"position": "." * 42})
+    )
+    while not sockets._pending:
+        await asyncio.sleep(0)
+    (request_id,) = sockets._pending
+    agents.resolve_socket_response(
+        json.dumps({"id": request_id, "action": {"column": 3}})
+    )
+    assert await request == {"column": 3}
+    assert not sockets._pending
+
+
+async def test_hosted_agent(monkeypatch: pytest.MonkeyPatch) -> None:
+    with pytest.raises(HTTPException):
+        await agents.probe_hosted_agent("def choose(state):\n    return 0\n")
+    monkeypatch.setenv("HOSTED_AGENTS", "1")
+    await agents.probe_hosted_agent(
+        "import random\n"
+        "def choose(state):\n"
+        "    open_columns = [i for i in range(7) if state['board'][i][5] == ' ']\n"
+        "    return random.choice(open_columns)\n"
+    )
+    with pytest.raises(HTTPException):
+        await agents.probe_hosted_agent("import os\ndef choose(state):\n    return 0\n")
+    with pytest.raises(HTTPException):
+        await agents.probe_hosted_agent("def choose(state):\n    while True: pass\n")
+    with pytest.raises(HTTPException):
+        await agents.probe_hosted_agent(
+            "def choose(state):\n"
+            "    while True:\n"
+            "        try:\n"
+            "            while True: pass\n"
+            "        except BaseException: pass\n"
+        )
+    # The process's modules, with the other agents if it ran any, are out of
+    # reach.
+    with pytest.raises(HTTPException):
+        await agents.probe_hosted_agent(
+            "import random\n"
+            "def choose(state):\n"
+            "    return len(random._os.sys.modules['__main__']._agent)\n"
+        )
+    with pytest.raises(HTTPException):
+        await agents.probe_hosted_agent(
+            "def choose(state):\n"
+            "    return len(choose.__globals__['__builtins__'])\n"
+        )
+    await agents.close_sandbox()
+
+
+def test_latency_percentiles() -> None:
+    buckets = {10: 50, 100: 45, 1000: 4, overflow_bucket_ms: 1}
+    assert percentile(buckets, 0.50) == 10
+    assert percentile(buckets, 0.95) == 100
+    assert percentile(buckets, 0.99) == 1000
+    assert percentile(buckets, 1.0) is None
+    assert percentile({}, 0.5) is None
+
+
+def test_elo() -> None:
+    assert elo_update(1500, 1500, None) == (1500, 1500)
+    winner, loser = elo_update(1500, 1500, 0)
+    assert winner == 1516 and loser == 1484
+    # Beating a much weaker agent barely moves the ratings.
+    winner, loser = elo_update(2000, 1200, 0)
+    assert 0 < winner - 2000 < 1 and winner + loser == pytest.approx(3200)
+
+    ratings = Ratings()
+    ratings.add_match("connect4", 1, 2, 1)
+    ratings.add_match("connect4", 2, 3, None)
+    assert ratings.ratings[1] == ("connect4", 1484, 1)
+    assert ratings.ratings[2][2] == 2
+
+
+async def test_adaptive_limiter() -> None:
+    limiter = AdaptiveLimiter(limit=2, min_limit=1, max_limit=8, target_cpu=0.7)
+    release = asyncio.Event()
+    running = 0
+
+    async def job() -> None:
+        nonlocal running
+        async with limiter.slot():
+            running += 1
+            await release.wait()
+
+    jobs = [asyncio.create_task(job()) for _ in range(6)]
+    await asyncio.sleep(0.01)
+    assert running == 2 and limiter.waiting == 4
+
+    # Jobs held back with nothing finished and no cpu used, it grows.
+    assert await limiter.retune() == 3
+    await asyncio.sleep(0.01)
+    assert running == 3
+
+    release.set()
+    await asyncio.gather(*jobs)
+    assert limiter.in_flight == 0
+
+
+async def test_memory_backend() -> None:
+    ran: list[int] = []
+
+    class Record:
+        name = "record"
+        queue = "test"
+        queueing_lock = None
+
+        @staticmethod
+        async def func(n: int) -> None:
+            await asyncio.sleep(0.01)
+            ran.append(n)
+
+    # Only the attributes the backend uses.
+    Task = cast(procrastinate.tasks.Task, Record)
+
+    backend = MemoryBackend([(["test"], 4)], queue_size=10, periodic=[])
+    await backend.open()
+    try:
+        assert await backend.defer(Task, lock="a", queueing_lock="a", n=1)
+        # The first one hasn't started, the second is a no op.
+        assert not await backend.defer(Task, lock="a", queueing_lock="a", n=2)
+        await asyncio.sleep(0)
+        # Started, so the third waits for the lock.
+        assert await backend.defer(Task, lock="a", queueing_lock="a", n=3)
+        assert await backend.defer(Task, delay=0.05, n=4)
+        await asyncio.sleep(0.1)
+        assert ran == [1, 3, 4]
+        with pytest.raises(ValueError):
+            await backend.defer(Task, queue="unknown", n=5)
+    finally:
+        await backend.close()
+
+    # Nothing consumes this one, deferring to it once it's full doesn't wait.
+    full = MemoryBackend([(["test"], 1)], queue_size=1, periodic=[])
+    assert await full.defer(Task, n=6)
+    assert not await full.defer(Task, queueing_lock="b", n=7)
+    assert "b" not in full.queued
+
+
+def test_memory_backend_shards(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(tournaments, "shards", 3)
+    for name in ["WORKER_SLOTS", "WORKER_CONCURRENCY", "WORKER_QUEUES"]:
+        monkeypatch.delenv(name, raising=False)
+    queues = tasks.ai_turns_queues()
+    assert "ai_turns_batch_2" in queues
+    # The default slots have room for every shard.
+    MemoryBackend(tasks.worker_slots(), queue_size=1, periodic=[], queues=queues)
+    # Slots that leave shards out are refused before anything is deferred.
+    with pytest.raises(ValueError):
+        MemoryBackend(
+            [(["ai_turns_interactive", "ai_turns_batch"], 1)],
+            queue_size=1,
+            periodic=[],
+            queues=queues,
+        )
+
+
+async def test_listener_merges_turns() -> None:
+    listener = Listener("postgresql://unused")
+    # Don't connect.
+    listener.running = True
+
+    slow = listener.listen(1)()
+    fast = listener.listen(1)()
+    slow_next = asyncio.ensure_future(slow.__anext__())
+    fast_next = asyncio.ensure_future(fast.__anext__())
+    await asyncio.sleep(0)
+    assert listener.metrics().subscribers == 2
+
+    # Nobody reads in between, the turns pile up in one event.
+    for number in [1, 2, 3]:
+        listener.handle_match(
+            None,
+            0,
+            "match_1",
+            json.dumps(
+                {
+                    "match_id": 1,
+                    "status": "in_progress",
+                    "winner": None,
+                    "next_player": number % 2,
+                    "turns": [
+                        {"number": number, "player": 1 - number % 2, "action": 3}
+                    ],
+                }
+            ),
+        )
+    for event in [await slow_next, await fast_next]:
+        assert event["event"] == "turn"
+        notification = json.loads(event["data"])
+        assert [turn["number"] for turn in notification["turns"]] == [1, 2, 3]
+        assert notification["next_player"] == 1
+    assert listener.metrics().merged == 4
+
+    # Read again at least at the turn it was sent for.
+    listener._refresh(1, 3)
+    assert await slow.__anext__() == {"event": "refresh", "data": '{"turn": 3}'}
+
+    await slow.aclose()
+    await fast.aclose()
+    assert listener.queues == {}
+
+
+async def test_listener_broadcasts_state() -> None:
+    renders = []
+
+    async def render_match_state(match_id: int, turn: int | None) -> str:
+        renders.append((match_id, turn))
+        return "<div>Blue Wins!</div>"
+
+    listener = Listener("postgresql://unused", render_match_state)
+    listener.running = True
+    spectators = [listener.listen(1)() for _ in range(3)]
+    events = [asyncio.ensure_future(spectator.__anext__()) for spectator in spectators]
+    await asyncio.sleep(0)
+
+    listener.handle_match(
+        None,
+        0,
+        "match_1",
+        json.dumps(
+            {
+                "match_id": 1,
+                "status": "finished",
+                "winner": 0,
+                "next_player": None,
+                "turns": [{"number": 7, "player": 0, "action": 3}],
+            }
+        ),
+    )
+    for event in events:
+        assert await event == {"event": "state", "data": "<div>Blue Wins!</div>"}
+    assert renders == [(1, 7)]
+    for spectator in spectators:
+        await spectator.aclose()
+
+
+def test_fragment_cache() -> None:
+    cache = FragmentCache(max_size=2)
+    renders = []
+
+    def render(html: str) -> str:
+        renders.append(html)
+        return html
+
+    playing: FragmentKey = (1, 5, "in_progress", ())
+    assert cache.get_or_render(playing, lambda: render("a")) == "a"
+    assert cache.get_or_render(playing, lambda: render("b")) == "a"
+    # Same turn, the match ended with an agent error.
+    assert cache.get_or_render((1, 5, "agent_error", ()), lambda: render("c")) == "c"
+    assert cache.get_or_render((1, 6, "in_progress", ()), lambda: render("d")) == "d"
+    # The least recently used one went.
+    assert cache.get_or_render(playing, lambda: render("e")) == "e"
+    assert renders == ["a", "c", "d", "e"]
+    assert cache.metrics().hits == 1
+
+
+def test_tournament_pairings() -> None:
+    pairs = _round_robin_pairs(list(range(7)))
+    assert len(pairs) == 21
+    assert len({frozenset(pair) for pair in pairs}) == 21
+    # The first 3 pairs make a round, nobody plays twice.
+    assert len({agent_id for pair in pairs[:3] for agent_id in pair}) == 6
+
+    pairs, bye = _swiss_pairs([1, 2, 3, 4, 5], {5: 1}, {frozenset([1, 2])})
+    assert bye == 4
+    assert pairs == [(1, 3), (2, 5)]
+
+
+async def test_save_turns(database: databases.Database, user_steve: str) -> None:
+    steve = await users.get_user_by_id(user_steve)
+    assert steve is not None
+    match_id = await matches.create_match(
+        database, user_steve, "connect4", [steve, steve]
+    )
+    match = await matches.get_match_by_id(database, match_id)
+    pending = [
+        matches.apply_action(match, i % 2, Connect4Action(column=i), actor=steve)
+        for i in range(4)
+    ]
+    await matches.save_turns(database, match_id, pending)
+
+    saved = await matches.get_match_by_id(database, match_id)
+    assert saved.turn == 4
+    assert saved.state.board == match.state.board
+    with pytest.raises(HTTPException):
+        # already saved
+        await matches.save_turns(database, match_id, pending)
+
+
+async def test_agent_error_ends_match(
+    database: databases.Database, user_steve: str
+) -> None:
+    steve = await users.get_user_by_id(user_steve)
+    assert steve is not None
+    match_id = await matches.create_match(
+        database, user_steve, "connect4", [steve, steve]
+    )
+    # Played in memory by a job that started before the match ended.
+    match = await matches.get_match_by_id(database, match_id)
+    pending = [matches.apply_action(match, 0, Connect4Action(column=0), actor=steve)]
+    await matches.set_agent_error(database, match_id)
+
+    with pytest.raises(HTTPException):
+        await matches.save_turns(database, match_id, pending)
+    ended = await matches.get_match_by_id(database, match_id)
+    assert ended.status == "agent_error"
+    assert ended.turn == 0
+    with pytest.raises(HTTPException):
+        await matches.take_action(
+            database, ended, 0, Connect4Action(column=0), actor=steve
+        )
+
+
+async def test_agent_failures_kept_with_match(
+    database: databases.Database, user_steve: str
+) -> None:
+    steve = await users.get_user_by_id(user_steve)
+    assert steve is not None
+    match_id = await matches.create_match(
+        database, user_steve, "connect4", [steve, steve]
+    )
+    assert await matches.get_agent_retry_delay(database, match_id) == 0
+    assert await matches.record_agent_failure(database, match_id, 0) == 1
+    # Another job for the match doesn't start the count over.
+    assert await matches.record_agent_failure(database, match_id, 0) == 2
+    await matches.set_agent_retry_delay(database, match_id, 30)
+    assert 0 < await matches.get_agent_retry_delay(database, match_id) <= 30
+
+    # The agent got past turn 0.
+    assert await matches.record_agent_failure(database, match_id, 1) == 1